@@ -9,7 +9,7 @@ import numpy
 import os
 import time
 import psycopg2 
-from progressor import progressor
+from bulk_loader import cursor_rows, load_table
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
 
@@ -69,11 +69,6 @@ createTable     = '''
                           fieldl[3],fieldt[3],
                           fieldl[4],fieldt[4])
 
-queryPartA      = '''
-  INSERT INTO {} VALUES 
-  '''.format(sqlTableName)
-sqlChunkify     = 500
-
 
 # OUTPUT PROCESS
 print("Commencing task: {} at {}".format(task,time.strftime("%Y%m%d-%H%M%S")))
@@ -124,23 +119,8 @@ conn.commit()
 # Expected denominator (metro urban parcel count) - for progress tracking
 denom  = int(arcpy.GetCount_management(outfc).getOutput(0))
 try:     
-  startCount = time.time()  
-
-  with arcpy.da.SearchCursor(outfc, fields) as cursor:
-    count = 0
-    chunkedLines = list()
-    progressor(count,denom,startCount,sqlTableName)  
-    for row in cursor:
-      count += 1
-      chunkedLines.append("($${}$$,{},$${}$$,{},$${}$$)".format(row[0],row[1],row[2],row[3],row[4]))
-      if(count % sqlChunkify == 0):
-        curs.execute(queryPartA + ','.join(rowOfChunk for rowOfChunk in chunkedLines))
-        conn.commit()
-        chunkedLines = list()
-      progressor(count,denom,startCount,sqlTableName)
-    if(count % sqlChunkify != 0):
-      curs.execute(queryPartA + ','.join(rowOfChunk for rowOfChunk in chunkedLines))
-      conn.commit()
+  # stream linkage codes to the table with COPY (see bulk_loader.py)
+  load_table(conn, sqlTableName, fieldl, cursor_rows(outfc, fields), total = denom)
   
 finally:
   conn.close()      
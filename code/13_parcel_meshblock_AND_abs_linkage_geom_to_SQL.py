@@ -11,7 +11,7 @@ import os
 import time
 import psycopg2 
 from shutil import copytree,rmtree
-from progressor import progressor
+from bulk_loader import cursor_rows, load_table
 
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
@@ -48,14 +48,11 @@ create_parcelmb_Table     = '''
   ({} varchar(15) NOT NULL ,
    MB_CODE11 bigint NOT NULL,
    point_count integer NOT NULL);'''.format(parcel_mb_table,pointsID)
-   
-queryPartA1      = "INSERT INTO {} VALUES ".format(parcel_mb_table)
-sqlChunkify     = 500
 
 
-fields = ['MB_CODE11','SA1_7DIG11','SA2_NAME11','SA3_NAME11','STE_NAME11','dwellings','Shape@WKT']
+fields = ['MB_CODE11','SA1_7DIG11','SA2_NAME11','SA3_NAME11','STE_NAME11','dwellings','SHAPE@WKB']
 
-# note - the list below intentionally doesn't include the geom type for shape@wkt, as we specify this manually renamed as 'geom'
+# note - the list below intentionally doesn't include the geom type for shape@wkb, as we specify this manually renamed as 'geom'
 fieldt = ['bigint','integer','varchar','varchar','varchar','integer']
 fieldl = [x.lower() for x in fields]
 
@@ -76,10 +73,6 @@ create_abslinkage_Table     = '''
 						  fieldl[4],fieldt[4],
 						  fieldl[5],fieldt[5])
 
-queryPartA2      = '''
-  INSERT INTO {} VALUES 
-  '''.format(abs_linkage_table)
-
 
 # OUTPUT PROCESS
 task = 'Extract parcel PFI and meshblock code from {}, and create ABS linkage table.'.format(A_points)
@@ -96,45 +89,19 @@ conn.commit()
 
 
 try:
-  with arcpy.da.SearchCursor(A_points, [pointsID, 'MB_CODE11','COUNT_OBJECTID']) as cursor:
-    count = 0
-    chunkedLines = list()
-    for row in cursor:
-      count += 1
-      chunkedLines.append("('{}',{},{})".format(row[0],row[1],row[2]))
-      if(count % sqlChunkify == 0):
-        curs.execute(queryPartA1 + ','.join(rowOfChunk for rowOfChunk in chunkedLines))
-        conn.commit()
-        chunkedLines = list()
-    if(count % sqlChunkify != 0):
-      curs.execute(queryPartA1 + ','.join(rowOfChunk for rowOfChunk in chunkedLines))
-      conn.commit()
-    print("Parcel-meshblock linkage table created.  Now creating abs_linkage table")
+  # tables are loaded by streaming rows with COPY, with geometry as EWKB (see bulk_loader.py)
+  load_table(conn, parcel_mb_table, [pointsID, 'mb_code11', 'point_count'],
+             cursor_rows(A_points, [pointsID, 'MB_CODE11','COUNT_OBJECTID']))
+  print("Parcel-meshblock linkage table created.  Now creating abs_linkage table")
   
   curs.execute("DROP TABLE IF EXISTS {};".format(abs_linkage_table))
   conn.commit()  
   curs.execute(create_abslinkage_Table)
   conn.commit()
   
-  startCount = time.time()  
   denom  = int(arcpy.GetCount_management("MB2011_DwellingPersons").getOutput(0))
-  with arcpy.da.SearchCursor("MB2011_DwellingPersons", fields) as cursor:
-    count = 0
-    chunkedLines = list()
-    progressor(count,denom,startCount,abs_linkage_table)
-    
-    for row in cursor:
-      count += 1
-      wkt = "ST_GeometryFromText('{}', {})".format(row[6].encode('utf-8').replace(' NAN','').replace(' M ',''),srid)
-      chunkedLines.append("({},{},$${}$$,$${}$$,$${}$$,{},{})".format(row[0],row[1],row[2],row[3],row[4],row[5],wkt))
-      if(count % sqlChunkify == 0):
-        curs.execute(queryPartA2 + ','.join(rowOfChunk for rowOfChunk in chunkedLines))
-        conn.commit()
-        chunkedLines = list()
-      progressor(count,denom,startCount,abs_linkage_table)
-    if(count % sqlChunkify != 0):
-      curs.execute(queryPartA2 + ','.join(rowOfChunk for rowOfChunk in chunkedLines))
-      conn.commit()
+  load_table(conn, abs_linkage_table, fieldl[:6] + ['geom'],
+             cursor_rows("MB2011_DwellingPersons", fields, srid), total = denom)
   
       
 finally:
@@ -7,7 +7,8 @@ import arcpy
 import os
 import time
 import psycopg2 
-from progressor import progressor
+from bulk_loader import cursor_rows, load_table
+from table_lifecycle import unlogged, finish_table
 
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
@@ -57,13 +58,11 @@ sqlDBName   = parser.get('postgresql', 'database')
 sqlUserName = parser.get('postgresql', 'user')
 sqlPWD      = parser.get('postgresql', 'password')
 
-#  Size of tuple chunk sent to postgresql 
-sqlChunkify = 500
-
 # Define query to create table
+#   -- tables are loaded without keys, which are built once loaded (see table_lifecycle.py)
 createTableParcel     = '''
   CREATE TABLE {0}
-  ({1} {2} PRIMARY KEY,
+  ({1} {2} NOT NULL,
    x  double precision NOT NULL ,
    y double precision NOT NULL,
    geom geometry NOT NULL); 
@@ -75,8 +74,7 @@ createTableDest     = '''
    {3} {2} NOT NULL,
    x  double precision NOT NULL ,
    y double precision NOT NULL,
-   geom geometry NOT NULL,
-   CONSTRAINT {0}_key PRIMARY KEY({1},{3})
+   geom geometry NOT NULL
   ); 
   '''.format(features[1],featureID[1].split('_')[0].lower(),featureID_type[1],featureID[1].split('_')[1].lower())
 
@@ -92,6 +90,7 @@ createTableDest     = '''
 
 # tables = [createTableParcel,createTableDest,createTablePOS]
 tables = [createTableParcel,createTableDest]
+keys   = [featureID[0].lower(), [x.lower() for x in featureID[1].split('_')]]
   
 
 
@@ -99,61 +98,24 @@ tables = [createTableParcel,createTableDest]
 def coordsToSQL(featureName, feature,featureID,featureID_type='num', featureID_delimiter='',feature_query='',SpatialRef='',SQLconnection=''):
 
   ''' Extracts coordinates from feature according to given spatial reference
-      and attempts to insert these into a table of the same name as supplied 
-      feature in a postgresql database.  Feature will be indexed using supplied
+      and streams these to a table of the same name as supplied feature in a
+      postgresql database (see bulk_loader.py).  Feature will be indexed using supplied
       identifier: if this has a compound identifier, specify the mode of delimitation
       (e.g. for comma use ',') else leave blank or specify  ''  .'''
-  def is_number(s):
-    try:
-        float(s)
-        return True
-    except ValueError:
-        return False  
+  def coords(row):
+    if len(featureID_delimiter) > 0:
+      id = row[0].split(featureID_delimiter)
+    else:
+      id = [row[0]]
+    x, y = row[1]
+    return tuple(id) + (x, y, row[2])
   
   try:
     print("Extracting coordinates from {}".format(featureName))
-    queryPartA = '''
-      INSERT INTO {} VALUES 
-      '''.format(featureName)
     denom = int(arcpy.GetCount_management(feature).getOutput(0))
-    startCount = time.time()   
-    with arcpy.da.SearchCursor(feature, [featureID,"SHAPE@XY","SHAPE@WKT"],where_clause = feature_query, spatial_reference=SpatialRef) as cursor:
-      count = 0
-      chunkedLines = list()
-      if len(featureID_delimiter) > 0:    
-        for row in cursor:
-          count += 1
-          id = row[0].split(featureID_delimiter)
-          
-          # make sure id is encased in quotes if string
-          for el in id:
-            if is_number(el) == False:
-              id[id.index(el)] = "'{}'".format(el)
-          x, y = row[1]
-          wkt = row[2].encode('utf-8').replace(' NAN','').replace(' M ','')
-          chunkedLines.append("({},{},{},{},ST_GeometryFromText('{}', {}))".format(id[0],id[1],x,y,wkt,srid)) 
-          if (count % sqlChunkify == 0) :
-            curs.execute(queryPartA + ','.join(rowOfChunk for rowOfChunk in chunkedLines)+' ON CONFLICT DO NOTHING')
-            conn.commit()
-            chunkedLines = list() 
-      else:
-        for row in cursor:
-          id = row[0]
-          
-          # make sure id is encased in quotes if string
-          if is_number(id) == False:
-            id = "'{}'".format(id)          
-          x, y = row[1]
-          wkt = row[2].encode('utf-8').replace(' NAN','').replace(' M ','')
-          chunkedLines.append("({},{},{},ST_GeometryFromText('{}', {}))".format(id, x, y, wkt, srid) )     
-          if (count % sqlChunkify == 0) :
-            curs.execute(queryPartA + ','.join(rowOfChunk for rowOfChunk in chunkedLines)+' ON CONFLICT DO NOTHING')
-            conn.commit()
-            chunkedLines = list()      
-      if(count % sqlChunkify != 0):
-       curs.execute(queryPartA + ','.join(rowOfChunk for rowOfChunk in chunkedLines)+' ON CONFLICT DO NOTHING')
-       conn.commit()
-    
+    rows = cursor_rows(feature, [featureID,"SHAPE@XY","SHAPE@WKB"], srid, where_clause = feature_query,
+                       convert = coords, spatial_reference=SpatialRef)
+    load_table(SQLconnection, featureName, None, rows, total = denom)
 
   except:
     print("ERROR: "+str(sys.exc_info()[0]))
@@ -179,12 +141,16 @@ try:
     
     print("create table {}... ".format(feature)),
     subTaskStart = time.time()
-    curs.execute(tables[idx])
+    curs.execute(unlogged(tables[idx]))
     conn.commit()
     print("{:4.2f} mins.".format((time.time() - start)/60))	
     
     coordsToSQL(feature,featureLocation[idx],featureID[idx],featureID_type[idx],featureID_delimiter[idx],feature_query[idx],SpatialRef,conn)
     
+    # build key (keeping the first row loaded for any duplicated identifier) and spatial index
+    finish_table(curs, feature, key = keys[idx], gist = 'geom', dedupe = True)
+    conn.commit()
+    
 except:
   print("Error {}".format(time.strftime("%Y%m%d-%H%M%S")) )
   print(sys.exc_info()[0])
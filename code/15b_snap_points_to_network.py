@@ -0,0 +1,103 @@
+# Purpose: Locate parcels and destinations on the pedestrian network, once, for use by all
+#          open source network stages (16b, 17b and 18b)
+#          -- points are located at their closest position along a network edge within the
+#             search tolerance, as an edge index and offset along the edge (see network_snap.py)
+#          -- locations are bulk loaded to the network_snaps table using COPY; point_type is
+#             'parcel' (point_id as per parcel id, with hex) or 'destination' (point_id as 'dest,oid',
+#             as per Dest_OID, e.g. '03,42')
+#          -- the network component of each location is recorded; points located on islands
+#             disconnected from the main network are listed in network_disconnected_points (along
+#             with the size of their component, see network_components), and are excluded by the
+#             network stages
+#          -- edge indices refer to the cached network graph (network_cache.py), so
+#             this script should be re-run if the pedestrian network is modified
+# Input:   requires parcel points, destination_xy table (14_extract_coords.py) and network edges
+# Author:  Carl Higgs
+
+import os
+import time
+import sys
+import psycopg2
+import numpy as np
+
+from network_graph import read_point_features, connected_components
+from network_cache import cached_graph
+from network_snap import build_segment_index, snap_points, write_snaps, write_components, snap_table, createTable_snaps, createTable_disconnected, disconnected_table
+from script_running_log import script_running_log
+from ConfigParser import SafeConfigParser
+
+parser = SafeConfigParser()
+parser.read(os.path.join(sys.path[0],'config.ini'))
+
+# simple timer for log file
+start = time.time()
+script = os.path.basename(sys.argv[0])
+task = 'Locate parcels and destinations on the pedestrian network ({})'.format(snap_table)
+
+# INPUT PARAMETERS
+folderPath = parser.get('data', 'folderPath')
+urbanGdb   = os.path.join(folderPath,parser.get('data', 'workspace'))
+
+A_points = parser.get('parcels', 'parcel_dwellings')
+A_pointsID = parser.get('parcels', 'parcel_id')
+
+## Network settings
+network_edges = parser.get('roads', 'pedestrian_road_edges')
+graph_cache = os.path.join(folderPath,parser.get('network', 'graph_cache'))
+searchTolerance = float(parser.get('network', 'tolerance'))
+
+dest_table = "destination_xy"
+
+# SQL Settings
+sqlDBName   = parser.get('postgresql', 'database')
+sqlUserName = parser.get('postgresql', 'user')
+sqlPWD      = parser.get('postgresql', 'password')
+
+# MAIN PROCESS
+if __name__ == '__main__':
+  print("Commencing task: {} at {}".format(task,time.strftime("%Y%m%d-%H%M%S")))
+  conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
+  curs = conn.cursor()
+  curs.execute(createTable_snaps)
+  conn.commit()
+
+  print("Loading network graph for {} and building segment index... ".format(network_edges)),
+  graph, edge_fid = cached_graph(graph_cache, urbanGdb, network_edges)
+  index = build_segment_index(graph)
+  print("Done ({} nodes, {} edges, {} segments).".format(len(graph.node_x), len(graph.edge_u), len(index.edge)))
+
+  print("Labelling connected components of network... "),
+  node_component = connected_components(graph)
+  edge_component = node_component[graph.edge_u]
+  write_components(curs, graph, node_component)
+  conn.commit()
+  print("Done ({} components; main network has {} of {} nodes).".format(node_component.max() + 1, (node_component == 0).sum(), len(node_component)))
+
+  print("Locating parcels on network... "),
+  A_values, A_x, A_y = read_point_features(urbanGdb, A_points, [A_pointsID,'HEX_ID'])
+  A_edge, A_offset, A_snap = snap_points(index, A_x, A_y, searchTolerance)
+  located = write_snaps(curs, 'parcel', A_values[0], A_values[1], A_edge, A_offset, A_snap, edge_component)
+  conn.commit()
+  print("Done ({} of {} located).".format(located, len(A_edge)))
+
+  print("Locating destinations on network... "),
+  curs.execute("SELECT dest, oid, x, y FROM {}".format(dest_table))
+  B = list(curs)
+  B_edge, B_offset, B_snap = snap_points(index, [b[2] for b in B], [b[3] for b in B], searchTolerance)
+  located = write_snaps(curs, 'destination', ['{:02},{}'.format(b[0],b[1]) for b in B], [None]*len(B), B_edge, B_offset, B_snap, edge_component)
+  conn.commit()
+  print("Done ({} of {} located).".format(located, len(B_edge)))
+
+  curs.execute("ANALYZE {};".format(snap_table))
+  conn.commit()
+
+  print("Listing points located off the main network... "),
+  curs.execute(createTable_disconnected)
+  curs.execute("SELECT point_type, count(*) FROM {} GROUP BY point_type".format(disconnected_table))
+  disconnected = dict(list(curs))
+  conn.commit()
+  print("Done ({} parcels and {} destinations excluded; see {}).".format(disconnected.get('parcel', 0), disconnected.get('destination', 0), disconnected_table))
+
+  # output to completion log
+  script_running_log(script, task, start)
+  conn.close()
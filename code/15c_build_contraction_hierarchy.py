@@ -0,0 +1,55 @@
+# Purpose: Build a contraction hierarchy over the pedestrian network graph, and save it for re-use
+#          (see network_ch.py)
+#          -- this optional preprocessing stage allows 17b_createodmatrix_csr_closestab.py (in closest
+#             facility mode) to sweep the network for each destination type using PHAST queries,
+#             which are much faster than a Dijkstra search over the full graph
+#          -- the hierarchy only depends on the network, so it may be re-used for any destination
+#             list, or study region analysed on the same network; it is checked against the network
+#             graph when loaded, and should be rebuilt if the network is modified
+# Input:   requires network edges; the output file is specified by contraction_hierarchy in config.ini
+# Author:  Carl Higgs
+
+import os
+import time
+import sys
+
+from network_cache import cached_graph
+from network_ch import build_ch, save_ch
+from script_running_log import script_running_log
+from ConfigParser import SafeConfigParser
+
+parser = SafeConfigParser()
+parser.read(os.path.join(sys.path[0],'config.ini'))
+
+# simple timer for log file
+start = time.time()
+script = os.path.basename(sys.argv[0])
+
+# INPUT PARAMETERS
+folderPath = parser.get('data', 'folderPath')
+urbanGdb   = os.path.join(folderPath,parser.get('data', 'workspace'))
+
+## Network settings
+network_edges = parser.get('roads', 'pedestrian_road_edges')
+graph_cache = os.path.join(folderPath,parser.get('network', 'graph_cache'))
+ch_file = os.path.join(folderPath,parser.get('network', 'contraction_hierarchy'))
+
+task = 'Build contraction hierarchy for road network {} ({})'.format(network_edges,ch_file)
+
+# MAIN PROCESS
+if __name__ == '__main__':
+  print("Commencing task: {} at {}".format(task,time.strftime("%Y%m%d-%H%M%S")))
+
+  print("Loading network graph for {} (building cache if required)... ".format(network_edges)),
+  graph, edge_fid = cached_graph(graph_cache, urbanGdb, network_edges)
+  print("Done ({} nodes, {} edges).".format(len(graph.node_x), len(graph.edge_u)))
+
+  print("Contracting network graph... "),
+  ch = build_ch(graph)
+  print("Done ({} upward arcs, {} levels; {:.1f} mins).".format(len(ch.up_indices), len(ch.sweep_ptr) - 1, (time.time()-start)/60))
+
+  save_ch(ch_file, ch)
+  print("Saved to {}.".format(ch_file))
+
+  # output to completion log
+  script_running_log(script, task, start)
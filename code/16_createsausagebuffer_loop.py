@@ -1,6 +1,7 @@
 # Purpose: This script creates sausage buffers for specified input distance.  
 # It:
-#  -- iterates over hexes not previously processed
+#  -- iterates over hexes not previously processed (hexes with more than split_parcels parcels
+#     are processed as sub-tasks, i.e. ranges of parcel ids; see hex_scheduler.py)
 #  -- it loops over points within hexes not previously processed
 #  -- outputs the lines from a network service area of specified route length
 #  -- the final line feature which is stored in the project postgresql database
@@ -23,7 +24,13 @@ import sys
 import psycopg2 
 import numpy as np
 from shutil import copytree,rmtree,ignore_patterns
-from progressor import progressor
+from progress_tracker import start_progress, stop_progress, progress_init, report_progress
+from hex_scheduler import pool_size, plan_hexes, run_largest_first, hex_task, task_part, subtask_sql
+from result_writer import start_writers, stop_writers, check_writes, writer_init, writing, write_rows, write_sql
+from task_runner import guarded, exclude_quarantined, stage_summary
+from parcel_shards import build_shards, load_shards, hex_rows, shard_layer
+from bulk_loader import ewkb
+from resume import completed_set, pending_items
 
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
@@ -42,7 +49,9 @@ arcpy.env.workspace = destGdb
 
 ## specify locations
 points =  parser.get('parcels','parcel_dwellings')
-denominator = int(arcpy.GetCount_management(points).getOutput(0))
+
+# parcel ids and coordinates by hex (see parcel_shards.py)
+shard_cache = os.path.join(folderPath,parser.get('network', 'parcel_shards'))
 
 # specify the unique location identifier 
 pointsID = parser.get('parcels', 'parcel_id')
@@ -81,6 +90,9 @@ objectFloor = 0
 # point chunk size (for looping within polygon)
 group_by = 200
 
+# hexes with more parcels than this are split into sub-tasks
+split_parcels = int(parser.get('parallel', 'split_parcels'))
+
 ## Log file details (including header row)
 log_table = 'log_hex_sausage_buffer'
 
@@ -94,7 +106,7 @@ if not os.path.exists(tempdir):
 pid = multiprocessing.current_process().name
 study_region = parser.get('data', 'study_region')
 
-if pid !='MainProcess':
+if 'PoolWorker' in pid:
   # any new processes commencing must be reassigned to work from one of 5 scratch gdb
   if int(pid[-1]) > 5:
     multiprocessing.current_process().name = 'PoolWorker-{}'.format(np.random.randint(1,6))
@@ -165,9 +177,9 @@ createTable_sausageBuffer = '''
      geom geometry);  
   '''.format(sausage_buffer_table,pointsID.lower())
 
-queryInsertSausage      = '''
-  INSERT INTO {} VALUES
-  '''.format(sausage_buffer_table)  
+# sausage buffer lines are written (via the result writer) as hex encoded EWKB, and buffered on insert
+sausageColumns = (pointsID.lower(), 'hex', 'geom')
+sausageSelect  = [pointsID.lower(), 'hex', 'ST_Buffer(ST_SnapToGrid(geom,0.001),{})'.format(line_buffer)]
 
 createTable_nh1600m = '''
   CREATE TABLE IF NOT EXISTS {0} AS
@@ -189,9 +201,13 @@ def writeLog(hex = 0,parcel_count = 0,status = 'NULL',mins = 0, create = log_tab
       # print to screen regardless
       # print('{:9.0f} {:14.0f}  {:>19s} {:>14s}   {:9.2f}'.format(hex, parcel_count, status, moment, mins))
       
-      # write to sql table
-      curs.execute("{0} ({1},{2},'{3}','{4}',{5}) {6};".format(queryInsert,hex, parcel_count, status, moment, mins, queryUpdate))
-      conn.commit()
+      # write to sql table (via the result writer, from worker processes)
+      statement = "{0} ({1},{2},'{3}','{4}',{5}) {6};".format(queryInsert,hex, parcel_count, status, moment, mins, queryUpdate)
+      if writing():
+        write_sql(statement)
+      else:
+        curs.execute(statement)
+        conn.commit()
       
   except:
     print('''Issue with log file using parameters:
@@ -227,18 +243,35 @@ def renameSkinny(is_geo, in_obj, out_obj, keep_fields_list=[''], rename_fields_l
           return out_obj
 
 # Worker/Child PROCESS
-def CreateSausageBufferFunction(hex): 
+# Log the status of a hex, or of a sub-task (logging the hex once all of its parts have this status)
+def logStatus(hex, part, parts, row_count, status, mins):
+  if parts > 1:
+    write_sql(subtask_sql(log_table, hex, '', part, parts, row_count, status, mins, log_table,
+                          ['hex', 'sum(parcel_count)', 'status', "'{}'".format(time.strftime("%Y%m%d-%H%M%S")), 'sum(mins)'], queryUpdate))
+  else:
+    writeLog(hex,row_count, status,mins, log_table)
+
+# Worker process initialiser: result writer and progress queues, and parcel shards
+def worker_init(queues, progress, shard_dir):
+  global shards, spatialReference
+  writer_init(queues)
+  progress_init(progress)
+  shards = load_shards(shard_dir)
+  spatialReference = arcpy.Describe(points).spatialReference
+
+def CreateSausageBufferFunction(task): 
   # initiate postgresql connection
   conn = psycopg2.connect(database=parser.get('postgresql', 'database'), 
                           user=parser.get('postgresql', 'user'),
                           password=parser.get('postgresql', 'password'))
   curs = conn.cursor()
   
-  # Worker Task is hex-specific by definition/parallel
+  # Worker Task is hex-specific by definition/parallel (or a range of parcels within a large hex)
   hexStartTime = time.time()
+  hex, part, parts = hex_task(task)
   
   # fcBufferLines  = "Lines_Buffer_{}".format(hex)
-  fcLines  = "Lines_{}".format(hex)
+  fcLines  = "Lines_{}_{}".format(hex,part)
   
   if hex < hexStart:
     # print('hex {} is prior to requested start point, hex {} and is assumed processed; Skipping.'.format(hex,str(hexStart)))
@@ -248,9 +281,9 @@ def CreateSausageBufferFunction(hex):
   arcpy.CheckOutExtension('Network')
 
   
-  # Prepare to loop over points within polygons
-  arcpy.MakeFeatureLayer_management(points, "selection", where_clause = '"HEX_ID" = {}'.format(hex))
-  pointCount = int(arcpy.GetCount_management("selection").getOutput(0))
+  # Prepare to loop over points within polygons (read from the parcel shards; see parcel_shards.py)
+  hex_point_rows = hex_rows(shards, hex)
+  pointCount = len(hex_point_rows)
   
   if pointCount == 0:
     # print('No parcels within hex {}; Skipping.'.format(hex))
@@ -265,20 +298,20 @@ def CreateSausageBufferFunction(hex):
     current_floor = 0    
   
   # list of OIDs to iterate over (in LI_Vic context, GNAF ids had to be encoded as utf-8)
-  raw_point_id_list = unique_values("selection", pointsID)
-  raw_point_id_list = [x.encode('utf-8') for x in raw_point_id_list]
+  # ids are sorted within hex (see parcel_shards.py), so sub-tasks are ranges of parcel ids
+  hex_point_rows = task_part(hex_point_rows, part, parts)
+  raw_point_id_list = [x.encode('utf-8') for x in shards.id[hex_point_rows]]
   
-  # fetch list of successfully processed buffers, if any 
-  # (for string match to work, had to select first item of returned tuple)
-  curs.execute("SELECT {} FROM {} WHERE hex = {}".format(pointsID.lower(),sausage_buffer_table,hex))
-  completed_points = list(curs)
-  completed_points = [x[0] for x in completed_points]
-
+  # fetch set of successfully processed buffers within hex, if any (see resume.py)
+  completed_points = completed_set(curs, sausage_buffer_table, pointsID.lower(), 'hex = {}'.format(hex))
   
-  point_id_list = [x for x in raw_point_id_list if x not in completed_points]
+  pending       = pending_items(zip(hex_point_rows, raw_point_id_list), completed_points, key = lambda x: x[1])
+  point_rows    = [x[0] for x in pending]
+  point_id_list = [x[1] for x in pending]
   valid_pointCount = len(point_id_list)
 
   if valid_pointCount == 0:
+    logStatus(hex, part, parts, 0, "COMPLETED", (time.time()-hexStartTime)/60)
     return(3)  
   
   # commence iteration
@@ -292,10 +325,7 @@ def CreateSausageBufferFunction(hex):
       if current_floor > 0:
         current_floor +=1
       
-      chunkSQL = ''' "{}" in ({})'''.format(pointsID,"'"+"','".join(point_id_list[current_floor:current_max+1])+"'")
-      place = "after defining chunkSQL"
-
-      chunk_group = arcpy.SelectLayerByAttribute_management("selection", where_clause = chunkSQL)
+      chunk_group = shard_layer(shards, point_rows[current_floor:current_max+1], "chunk_group", pointsID, spatialReference)
       place = "after defining chunk_group"
       
       # iterCount = int(arcpy.GetCount_management(chunk_group).getOutput(0))
@@ -337,18 +367,17 @@ def CreateSausageBufferFunction(hex):
                                              join_field  = "ObjectId")
       place = "after AddJoin" 
       
-      # write output line features within chunk to Postgresql spatial feature
-      # Need to parse WKT output slightly (Postgresql doesn't take this M-values nonsense)
-      with arcpy.da.SearchCursor("tempLayer",['Facilities.Name','Shape@WKT']) as cursor:
+      # queue output line features within chunk, to be bulk loaded (and buffered) by the result writer
+      # (lines are read as WKB, and M values dropped; see bulk_loader.py)
+      rows = []
+      with arcpy.da.SearchCursor("tempLayer",['Facilities.Name','Shape@WKB']) as cursor:
         for row in cursor:
           id =  row[0].encode('utf-8')
-          wkt = row[1].encode('utf-8').replace(' NAN','').replace(' M ','')
-          curs.execute(queryInsertSausage + "( '{0}',{1},ST_Buffer(ST_SnapToGrid(ST_GeometryFromText('{2}', {3}),0.001),{4}));".format(id,hex,wkt,srid,line_buffer))
-          place = "after curs.execute insert sausage buffer" 
-          conn.commit()
-          place = "after conn.commit for insert sausage buffer" 
-          row_count+=1  
+          rows.append((id, hex, ewkb(row[1], srid)))
       place = "after SearchCursor"           
+      write_rows(sausage_buffer_table, sausageColumns, rows, select = sausageSelect)
+      place = "after queueing sausage buffer lines" 
+      row_count += len(rows)
 
       current_floor = (group_by * count)
       count += 1   
@@ -356,8 +385,9 @@ def CreateSausageBufferFunction(hex):
     except:
        print('''HEY, IT'S AN ERROR: {}
                 ERROR CONTEXT: hex: {} current_floor: {} current_max: {} row_count: {}
-                PLACE: {}
-                WKT: {}'''.format(sys.exc_info(),hex,current_floor,current_max,row_count,place,wkt))
+                PLACE: {}'''.format(sys.exc_info(),hex,current_floor,current_max,row_count,place))
+       if parts > 1:
+         logStatus(hex, part, parts, row_count, "ERROR", (time.time()-hexStartTime)/60)
        writeLog(hex,row_count, "ERROR",(time.time()-hexStartTime)/60, log_table)   
        return(666)
     finally:
@@ -366,19 +396,27 @@ def CreateSausageBufferFunction(hex):
        arcpy.Delete_management(fcLines)
   
 
-  curs.execute("SELECT COUNT({}) FROM {};".format(pointsID.lower(),sausage_buffer_table))
-  numerator = list(curs)
-  numerator = int(numerator[0][0])
-  writeLog(hex,row_count, "COMPLETED",(time.time()-hexStartTime)/60, log_table)   
-  progressor(numerator,denominator,start,"{} / {} points processed. Last completed hex: {}".format(numerator,denominator,hex))
-  arcpy.Delete_management("selection")
+  logStatus(hex, part, parts, row_count, "COMPLETED", (time.time()-hexStartTime)/60)
+  report_progress(row_count, task)
+  arcpy.Delete_management("in_memory/chunk_group")
   arcpy.CheckInExtension('Network')
   conn.close()
   return(0)   
   
        
-nWorkers = 4
-hex_list = unique_values(points, 'HEX_ID')
+nWorkers = pool_size(parser.get('parallel', 'workers'))
+
+# result writer processes, and the number of rows or seconds after which these commit (see result_writer.py)
+connect = dict(database=parser.get('postgresql', 'database'), user=parser.get('postgresql', 'user'), password=parser.get('postgresql', 'password'))
+write_policy = dict(writers = parser.get('parallel', 'writers'),
+                    batch_rows = parser.get('parallel', 'write_batch_rows'),
+                    batch_secs = parser.get('parallel', 'write_batch_secs'))
+progress_interval = parser.get('parallel', 'progress_interval')
+
+# timeout (mins) and retries (with backoff, in seconds) for failed tasks (see task_runner.py)
+task_guard = dict(timeout = parser.get('parallel', 'task_timeout'),
+                  retries = parser.get('parallel', 'task_retries'),
+                  backoff = parser.get('parallel', 'retry_backoff'))
      
 # MAIN PROCESS
 if __name__ == '__main__': 
@@ -394,17 +432,29 @@ if __name__ == '__main__':
   conn.commit()
   
   # fetch list of successfully processed buffers, if any
-  curs.execute("SELECT hex FROM {} WHERE status = 'COMPLETED'".format(log_table))
-  completed_hexes = list(curs)
+  completed_hexes = completed_set(curs, log_table, 'hex', "status = 'COMPLETED'")
   
-  # compile list of remaining hexes to process
-  remaining_hex_list = [x for x in hex_list if x not in completed_hexes]
+  # compile list of remaining hexes to process (from the parcel shards, built if required)
+  shard_dir = build_shards(shard_cache, destGdb, points, pointsID)
+  shards = load_shards(shard_dir)
+  denominator = len(shards.id)
+  remaining_hex_list = pending_items(shards.hex, completed_hexes)
   
   # Setup a pool of workers/child processes and split log output
-  pool = multiprocessing.Pool(nWorkers)
+  # (progress is tallied from worker reports, starting from the points of hexes already completed)
+  curs.execute("SELECT COALESCE(sum(parcel_count),0) FROM {} WHERE status = 'COMPLETED'".format(log_table))
+  tracker = start_progress(denominator, int(list(curs)[0][0]), 'points processed', progress_interval)
+  queues, writers = start_writers(connect, **write_policy)
+  pool = multiprocessing.Pool(nWorkers, initializer = worker_init, initargs = (queues, tracker[1], shard_dir))
   
-  # Divide work by hexes
-  pool.map(CreateSausageBufferFunction, remaining_hex_list, chunksize=1)
+  # Divide work by hexes, largest first (see hex_scheduler.py)
+  hex_costs, in_minutes = plan_hexes(curs, remaining_hex_list, log_table, split = split_parcels)
+  hex_costs = exclude_quarantined(curs, script, hex_costs)
+  results = run_largest_first(pool, guarded(CreateSausageBufferFunction, **task_guard), hex_costs, nWorkers, in_minutes, label = 'hex tasks', progress = False)
+  stage_summary(curs, script, results)
+  pool.close()
+  stop_progress(*tracker, label = 'points processed')
+  failed_writes = stop_writers(queues, writers)
       
   # Create sausage buffer spatial index
   print("Creating sausage buffer spatial index... "),
@@ -423,6 +473,9 @@ if __name__ == '__main__':
   conn.commit()  
   print("Done.")
   
+  # tasks whose results failed to be written are reported (as an error), rather than logging the stage as complete
+  check_writes(failed_writes)
+
   # output to completion log    
   script_running_log(script, task, start)
   
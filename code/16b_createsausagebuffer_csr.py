@@ -0,0 +1,355 @@
+# Purpose: This script creates sausage buffers for specified input distance.
+#          It is an open source alternative to 16_createsausagebuffer_loop.py which does
+#          not require ArcGIS or a Network Analyst licence.
+# It:
+#  -- builds the pedestrian network graph once (see network_graph.py), and reads parcel
+#     locations on the network from the network_snaps table (15b_snap_points_to_network.py)
+#  -- iterates over hexes not previously processed, in parallel (largest first; see hex_scheduler.py);
+#     hexes with more than split_parcels parcels are processed as sub-tasks (ranges of parcel ids),
+#     which are logged in log_hex_subtasks until all parts of the hex are complete
+#  -- groups points within a hex at the same network location (see network_snap.location_groups)
+#  -- for chunks of locations within hexes not previously processed, collects each location's
+#     reachable edges (including partial edges at the frontier of the network distance)
+#     from a bounded network search
+#  -- buffers these lines by the specified line buffer distance within the worker process
+#     (see sausage_buffer.py), rather than sending each line to PostGIS to be buffered;
+#     each buffer is stored for every point at that location
+#  -- bulk loads the sausage buffer polygons to the project postgresql database using COPY
+#  -- alternatively (sausage_output = area in config.ini), only the sausage buffer area is
+#     stored, directly to the nh{distance}m summary table, as this is all we require as
+#     denominator to density measures.  Optionally (sausage_simplify > 0) a simplified
+#     polygon is retained for catchment joins, which is much smaller than the full polygon.
+# Input: requires network dataset, parcel points etc -- specified in config.ini
+#
+# Carl Higgs and Koen Simons, 2016-2017
+
+import os
+import time
+import multiprocessing
+import sys
+import psycopg2
+import numpy as np
+from job_queue import enqueue, run_queue
+from hex_scheduler import pool_size, plan_hexes, run_largest_first, hex_task, task_part, subtask_sql
+from result_writer import start_writers, stop_writers, sync_writers, check_writes, writer_init, writing, write_rows, write_sql
+from task_runner import guarded, exclude_quarantined, stage_summary
+
+from network_snap import location_groups
+from network_service import load_network, submit_stage
+from sausage_buffer import sausage_buffers, ewkb_geometries
+from script_running_log import script_running_log
+from ConfigParser import SafeConfigParser
+
+parser = SafeConfigParser()
+parser.read(os.path.join(sys.path[0],'config.ini'))
+
+# simple timer for log file
+start = time.time()
+script = os.path.basename(sys.argv[0])
+
+# INPUT PARAMETERS
+folderPath = parser.get('data', 'folderPath')
+urbanGdb   = os.path.join(folderPath,parser.get('data', 'workspace'))
+
+## specify locations
+points =  parser.get('parcels','parcel_dwellings')
+
+# specify the unique location identifier
+pointsID = parser.get('parcels', 'parcel_id')
+
+## Network settings
+network_edges = parser.get('roads', 'pedestrian_road_edges')
+graph_cache = os.path.join(folderPath,parser.get('network', 'graph_cache'))
+
+# Service area settings
+distance = int(parser.get('network', 'distance'))
+units = "m"
+
+srid = int(parser.get('workspace', 'srid'))
+line_buffer = int(parser.get('network', 'line_buffer'))
+
+# sausage buffer output: 'polygon' or 'area' (optionally with simplified polygon)
+sausage_output   = parser.get('network', 'sausage_output')
+sausage_simplify = float(parser.get('network', 'sausage_simplify'))
+store_polygons   = (sausage_output == 'polygon') or (sausage_simplify > 0)
+
+# points within this distance of each other along the network share a single sausage buffer
+location_quantum = float(parser.get('network', 'location_quantum'))
+
+# Output databases
+sausage_buffer_table = "sausagebuffer_{}".format(distance)
+nh_sausagebuffer_summary = "nh{}m".format(distance)
+
+# location chunk size (for looping within polygon)
+group_by = 200
+
+# hexes with more parcels than this are split into sub-tasks
+split_parcels = int(parser.get('parallel', 'split_parcels'))
+
+## Log file details (including header row)
+log_table = 'log_hex_sausage_buffer'
+
+# SQL Settings
+sqlDBName   = parser.get('postgresql', 'database')
+sqlUserName = parser.get('postgresql', 'user')
+sqlPWD      = parser.get('postgresql', 'password')
+
+# work is dispatched to a local pool of workers, or via a job queue which may be shared by
+# workers on other hosts (see job_queue.py)
+dispatch = parser.get('parallel', 'dispatch')
+connect  = dict(database=sqlDBName, user=sqlUserName, password=sqlPWD)
+if dispatch == 'queue':
+  connect['host'] = parser.get('postgresql', 'host')
+
+createTable_log     = '''
+        CREATE TABLE IF NOT EXISTS {}
+          (hex integer PRIMARY KEY,
+          parcel_count integer NOT NULL,
+          status varchar,
+          moment varchar,
+          mins double precision
+          );
+          '''.format(log_table)
+
+queryInsert      = '''
+  INSERT INTO {} VALUES
+  '''.format(log_table)
+
+queryUpdate      = '''
+  ON CONFLICT ({0})
+  DO UPDATE SET {1}=EXCLUDED.{1},{2}=EXCLUDED.{2},{3}=EXCLUDED.{3},{4}=EXCLUDED.{4}
+  '''.format('hex','parcel_count','status','moment','mins')
+
+createTable_sausageBuffer = '''
+  CREATE TABLE IF NOT EXISTS {}
+    ({} varchar PRIMARY KEY,
+     hex integer,
+     geom geometry);
+  '''.format(sausage_buffer_table,pointsID.lower())
+
+createTable_nh1600m_area = '''
+  CREATE TABLE IF NOT EXISTS {0}
+    ({1} varchar PRIMARY KEY,
+     hex integer,
+     area_sqm double precision,
+     area_sqkm double precision,
+     area_ha double precision);
+  '''.format(nh_sausagebuffer_summary,pointsID.lower())
+
+createTable_nh1600m = '''
+  CREATE TABLE IF NOT EXISTS {0} AS
+    SELECT {1}, area_sqm, area_sqm/1000000 AS area_sqkm, area_sqm/10000 AS area_ha FROM
+      (SELECT {1}, ST_AREA(geom) AS area_sqm FROM {2}) AS t;
+  '''.format(nh_sausagebuffer_summary,pointsID.lower(),sausage_buffer_table)
+
+# Define log file write method
+def writeLog(hex = 0,parcel_count = 0,status = 'NULL',mins = 0, create = log_table):
+  try:
+    if create == 'create':
+      curs.execute(createTable_log)
+      conn.commit()
+
+    else:
+      moment = time.strftime("%Y%m%d-%H%M%S")
+      # write to sql table (via the result writer, from worker processes)
+      statement = "{0} ({1},{2},'{3}','{4}',{5}) {6};".format(queryInsert,hex, parcel_count, status, moment, mins, queryUpdate)
+      if writing():
+        write_sql(statement)
+      else:
+        curs.execute(statement)
+        conn.commit()
+
+  except:
+    print('''Issue with log file using parameters:
+             hex: {}  parcel_count: {}  status: {}   mins:  {}  create:  {}
+             '''. format(hex, parcel_count, status, mins, create))
+
+# Child/Worker Init function
+# each worker opens its own connection to the SQL database, used to check progress, and writes
+# results and logs via the result writer processes
+def worker_init(queues):
+  global conn, curs
+  conn = psycopg2.connect(**connect)
+  curs = conn.cursor()
+  writer_init(queues)
+
+# Log the status of a hex, or of a sub-task (logging the hex once all of its parts have this status)
+def logStatus(hex, part, parts, row_count, status, mins):
+  if parts > 1:
+    write_sql(subtask_sql(log_table, hex, '', part, parts, row_count, status, mins, log_table,
+                          ['hex', 'sum(parcel_count)', 'status', "'{}'".format(time.strftime("%Y%m%d-%H%M%S")), 'sum(mins)'], queryUpdate))
+  else:
+    writeLog(hex,row_count, status,mins, log_table)
+
+# Worker/Child PROCESS
+def CreateSausageBufferFunction(task):
+  # Worker Task is hex-specific by definition/parallel (or a range of parcels within a large hex)
+  hexStartTime = time.time()
+  hex, part, parts = hex_task(task)
+
+  # points are ordered by id within hex (see read_snaps), so parts are ranges of parcel ids
+  selection = task_part(np.flatnonzero(A_hex == hex), part, parts)
+  pointCount = len(selection)
+  if pointCount == 0:
+    return(2)
+
+  # fetch list of successfully processed buffers, if any
+  if sausage_output == 'area':
+    curs.execute("SELECT {} FROM {} WHERE hex = {}".format(pointsID.lower(),nh_sausagebuffer_summary,hex))
+  else:
+    curs.execute("SELECT {} FROM {} WHERE hex = {}".format(pointsID.lower(),sausage_buffer_table,hex))
+  completed_points = set([x[0] for x in list(curs)])
+  point_list = [i for i in selection if A_id[i] not in completed_points]
+  valid_pointCount = len(point_list)
+  if valid_pointCount == 0:
+    logStatus(hex, part, parts, 0, "COMPLETED", (time.time()-hexStartTime)/60)
+    return(3)
+
+  # points at the same network location share a single sausage buffer
+  point_list = np.array(point_list)
+  groups = location_groups(graph, A_edge[point_list], A_offset[point_list], location_quantum)
+  groupCount = len(groups)
+
+  # commence iteration
+  row_count = 0
+  current_floor = 0
+  try:
+    while (current_floor < groupCount):
+      chunk = groups[current_floor:current_floor + group_by]
+      origins = point_list[[members[0] for members in chunk]]
+      buffers = sausage_buffers(graph, A_edge[origins], A_offset[origins], distance, line_buffer)
+      buffers = [(point_list[members], geom) for members, geom in zip(chunk, buffers) if geom is not None]
+
+      # queue sausage buffer areas and/or polygons within chunk, to be bulk loaded by the result writer
+      if sausage_output == 'area':
+        rows = [(A_id[i], hex, '{:.3f}'.format(geom.area), '{:.9f}'.format(geom.area/1000000), '{:.7f}'.format(geom.area/10000)) for points, geom in buffers for i in points]
+        write_rows(nh_sausagebuffer_summary, (pointsID.lower(), 'hex', 'area_sqm', 'area_sqkm', 'area_ha'), rows)
+      if store_polygons:
+        if sausage_simplify > 0:
+          buffers = [(points, geom.simplify(sausage_simplify)) for points, geom in buffers]
+        rows = []
+        # each location's polygon is encoded once, however many points share it
+        for (points, geom), geom_hex in zip(buffers, ewkb_geometries([geom for points, geom in buffers], srid)):
+          rows += [(A_id[i], hex, geom_hex) for i in points]
+        write_rows(sausage_buffer_table, (pointsID.lower(), 'hex', 'geom'), rows)
+      row_count += len(rows)
+      current_floor += group_by
+  except:
+    print('''HEY, IT'S AN ERROR: {}
+             ERROR CONTEXT: hex: {} part: {}/{} current_floor: {} row_count: {}'''.format(sys.exc_info(),hex,part+1,parts,current_floor,row_count))
+    if parts > 1:
+      logStatus(hex, part, parts, row_count, "ERROR", (time.time()-hexStartTime)/60)
+    writeLog(hex,row_count, "ERROR",(time.time()-hexStartTime)/60, log_table)
+    return(666)
+
+  logStatus(hex, part, parts, row_count, "COMPLETED", (time.time()-hexStartTime)/60)
+  return(0)
+
+nWorkers = pool_size(parser.get('parallel', 'workers'))
+
+# result writer processes, and the number of rows or seconds after which these commit (see result_writer.py)
+write_policy = dict(writers = parser.get('parallel', 'writers'),
+                    batch_rows = parser.get('parallel', 'write_batch_rows'),
+                    batch_secs = parser.get('parallel', 'write_batch_secs'))
+
+# timeout (mins) and retries (with backoff, in seconds) for failed tasks (see task_runner.py)
+task_guard = dict(timeout = parser.get('parallel', 'task_timeout'),
+                  retries = parser.get('parallel', 'task_retries'),
+                  backoff = parser.get('parallel', 'retry_backoff'))
+
+# Worker state: the network graph and parcel locations on it (see network_service.load_network),
+# set as globals which are inherited by the worker processes when these are forked
+def stage_state(network):
+  global graph, A_id, A_hex, A_edge, A_offset
+  graph = network['graph']
+  A_id, A_hex, A_edge, A_offset = network['parcel']
+
+# Run the stage, using a pool of workers writing results via the given writer processes
+# (run by the main process below, or by the network service; see network_service.py)
+def run_stage(pool, queues, writers):
+  global conn, curs
+  # Task name is now defined
+  task = 'creates {}{} sausage buffers for locations in {} based on road network {} (CSR network graph)'.format(distance,units,points,network_edges)
+  print("Commencing task: {} at {}".format(task,time.strftime("%Y%m%d-%H%M%S")))
+
+  # initiate postgresql connection
+  conn = psycopg2.connect(**connect)
+  curs = conn.cursor()
+
+  # initiate log file
+  writeLog(create='create')
+
+  # create output spatial feature and/or area summary table in Postgresql
+  if store_polygons:
+    curs.execute(createTable_sausageBuffer)
+  if sausage_output == 'area':
+    curs.execute(createTable_nh1600m_area)
+  conn.commit()
+
+  # fetch list of successfully processed buffers, if any
+  curs.execute("SELECT hex FROM {} WHERE status = 'COMPLETED'".format(log_table))
+  completed_hexes = set([x[0] for x in list(curs)])
+
+  # compile list of remaining hexes to process
+  remaining_hex_list = [x for x in np.unique(A_hex) if x not in completed_hexes]
+
+  # Divide work by hexes (splitting large hexes into sub-tasks), largest first
+  hex_costs, in_minutes = plan_hexes(curs, remaining_hex_list, log_table, split = split_parcels)
+  hex_costs = exclude_quarantined(curs, script, hex_costs)
+  if dispatch == 'queue':
+    enqueue(curs, log_table, hex_costs)
+    run_queue(pool, guarded(CreateSausageBufferFunction, **task_guard), log_table, connect, nWorkers, quarantine_stage = script)
+  else:
+    results = run_largest_first(pool, guarded(CreateSausageBufferFunction, **task_guard), hex_costs, nWorkers, in_minutes, label = 'hex tasks')
+    stage_summary(curs, script, results)
+  failed_writes = sync_writers(queues, writers)
+
+  if store_polygons:
+    # Create sausage buffer spatial index
+    print("Creating sausage buffer spatial index... "),
+    curs.execute("CREATE INDEX IF NOT EXISTS {0}_gix ON {0} USING GIST (geom);".format(sausage_buffer_table))
+    conn.commit()
+    print("Done.")
+
+    print("Analyze the sausage buffer table to improve performance.")
+    curs.execute("ANALYZE {};".format(sausage_buffer_table))
+    conn.commit()
+    print("Done.")
+
+  if sausage_output == 'area':
+    print("Analyze the summary table of parcel id and area to improve performance.")
+    curs.execute("ANALYZE {};".format(nh_sausagebuffer_summary))
+    conn.commit()
+    print("Done.")
+  else:
+    # Create summary table of parcel id and area
+    print("Creating summary table of parcel id and area... "),
+    curs.execute(createTable_nh1600m)
+    conn.commit()
+    print("Done.")
+
+  # tasks whose results failed to be written are reported (as an error), rather than logging the stage as complete
+  check_writes(failed_writes)
+
+  # output to completion log
+  script_running_log(script, task, start)
+
+  # clean up
+  conn.close()
+
+# MAIN PROCESS
+if __name__ == '__main__':
+  # run by the network service, if running (see network_service.py), or otherwise here
+  if submit_stage(script) is None:
+    # Build network graph and read point locations on network
+    # (these are inherited by the worker processes when these are forked)
+    stage_state(load_network(connect, graph_cache, urbanGdb, network_edges, destinations = False))
+
+    # Setup writer processes, and a pool of workers/child processes writing results via these
+    queues, writers = start_writers(connect, **write_policy)
+    pool = multiprocessing.Pool(nWorkers, initializer = worker_init, initargs = (queues,))
+    try:
+      run_stage(pool, queues, writers)
+    finally:
+      pool.close()
+      stop_writers(queues, writers)
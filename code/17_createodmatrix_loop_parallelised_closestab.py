@@ -11,6 +11,12 @@ import sys
 import psycopg2 
 import numpy as np
 
+from hex_scheduler import pool_size, plan_hexes, run_largest_first
+from task_runner import guarded, exclude_quarantined, stage_summary
+from worker_startup import start_pool, startup_summary
+from result_writer import start_writers, stop_writers, check_writes, writer_init, writing, write_rows, write_sql
+from parcel_shards import build_shards, load_shards, hex_rows, shard_layer
+from hex_destinations import build_candidates, load_candidates, hex_candidates, candidate_clause, certified_lines, line_origins, rows_extent, ring_oids, retry_radius
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
 
@@ -36,11 +42,18 @@ arcpy.env.overwriteOutput = True
 A_points = os.path.join(urbanGdb,parser.get('parcels', 'parcel_dwellings'))
 A_pointsID = parser.get('parcels', 'parcel_id')
 
+# parcel ids and coordinates by hex (see parcel_shards.py)
+shard_cache = os.path.join(folderPath,parser.get('network', 'parcel_shards'))
+
+# candidate destinations of each type by hex (see hex_destinations.py)
+candidate_cache = os.path.join(folderPath,parser.get('network', 'destination_candidates'))
+candidate_rule = dict(cell   = float(parser.get('network', 'candidate_cell')),
+                      radius = float(parser.get('network', 'candidate_radius')),
+                      count  = int(parser.get('network', 'candidate_count')))
+
 ## specify "B_points" (e.g. destinations)
 B_pointsID = parser.get('destinations', 'destination_id')
 
-featureClasses = arcpy.ListFeatureClasses()
-
 # List of 31 potentially relevant destinations: see destinations.csv in LI scripts folder for details
 destination_list = parser.get('destinations', 'destination_list').split(',')
 
@@ -60,19 +73,36 @@ sqlPWD      = parser.get('postgresql', 'password')
 
 sqlTableName  = "dist_cl_od_parcel_dest"
 log_table    = "log_dist_cl_od_parcel_dest"
-queryPartA = "INSERT INTO {} VALUES ".format(sqlTableName)
+# points located off the main network component (see 15b_snap_points_to_network.py)
+disconnected_table = "network_disconnected_points"
 
-sqlChunkify = 500
+# rows per batch queued to the result writer
+sqlChunkify = 5000
 
-        
-# initiate postgresql connection
-conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
-curs = conn.cursor()
 
-# get pid name
-pid = multiprocessing.current_process().name
-# create initial OD cost matrix layer on worker processors
-if pid !='MainProcess':
+# Worker/Child setup (pool initializer; see worker_startup.py)
+#   -- destination feature classes and counts, and points off the main network, are listed once
+#      by the main process and passed to workers as settings, rather than queried on import
+#   -- each worker opens its own connection to the SQL database, used to check progress, and writes
+#      results and logs via the result writer processes
+def worker_setup(settings):
+  global conn, curs, featureClasses, count_list, exclude_disconnected, disconnected_dest, shards, A_spatialReference
+  global candidates, B_oidFields
+  global outNALayer, originsLayerName, destinationsLayerName, linesLayerName, ODLinesSubLayer, fields
+  shards               = load_shards(settings['shard_dir'])
+  A_spatialReference   = arcpy.Describe(A_points).spatialReference
+  featureClasses       = settings['featureClasses']
+  count_list           = settings['count_list']
+  exclude_disconnected = settings['exclude_disconnected']
+  disconnected_dest    = settings['disconnected_dest']
+  candidates           = dict((B_points, load_candidates(index_dir)) for B_points, index_dir in settings['candidates'].items())
+  B_oidFields          = dict((B_points, arcpy.Describe(B_points).OIDFieldName) for B_points in candidates)
+  
+  # initiate postgresql connection, and result writer queues
+  conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
+  curs = conn.cursor()
+  writer_init(settings['queues'])
+  
   # Make OD cost matrix layer
   result_object = arcpy.MakeODCostMatrixLayer_na(in_network_dataset = in_network_dataset, 
                                                  out_network_analysis_layer = "ODmatrix", 
@@ -93,11 +123,36 @@ if pid !='MainProcess':
   # you may have to do this later in the script - but try now....
   ODLinesSubLayer = arcpy.mapping.ListLayers(outNALayer, linesLayerName)[0]
   fields = ['Name', 'Total_Length']
-  
+
+# Settings for workers, listed once by the main process
+def stage_settings(curs):
   # store list of destinations with counts (so as to overlook destinations for which zero data exists!)
   curs.execute("SELECT dest_name,dest_count FROM dest_type")
   count_list = list(curs)
+
+  # where listed, destinations located off the main network are excluded, as no solution may be
+  # found for these (parcels off the main network are excluded by hex, below)
+  curs.execute("SELECT to_regclass('{}')".format(disconnected_table))
+  exclude_disconnected = curs.fetchone()[0] is not None
+  disconnected_dest = {}
+  if exclude_disconnected:
+    curs.execute("SELECT point_id FROM {} WHERE point_type = 'destination'".format(disconnected_table))
+    for x in list(curs):
+      disconnected_dest.setdefault(int(x[0].split(',')[0]), []).append(x[0])
   
+  # index candidate destinations of each type present in the study region by hex, once
+  shard_dir = build_shards(shard_cache, urbanGdb, parser.get('parcels', 'parcel_dwellings'), A_pointsID)
+  featureClasses = arcpy.ListFeatureClasses()
+  candidates = {}
+  for B_points in featureClasses:
+    if B_points in destination_list and count_list[destination_list.index(B_points)][1] > 0:
+      candidates[B_points] = build_candidates(candidate_cache, shard_dir, destGdb, B_points, **candidate_rule)
+  return dict(shard_dir = shard_dir,
+              featureClasses = featureClasses,
+              count_list = count_list,
+              exclude_disconnected = exclude_disconnected,
+              disconnected_dest = disconnected_dest,
+              candidates = candidates)
 
 # Define query to create table
 createTable     = '''
@@ -109,10 +164,9 @@ createTable     = '''
    PRIMARY KEY({1},dest)
    );
    '''.format(sqlTableName, A_pointsID)
-   
-queryPartA      = '''
-  INSERT INTO {} VALUES
-  '''.format(sqlTableName)
+
+# columns of OD matrix table, as written by the result writer
+resultColumns = (A_pointsID.lower(), 'dest', 'oid', 'distance')
   
 createTable_log     = '''
         CREATE TABLE IF NOT EXISTS {}
@@ -148,9 +202,13 @@ def writeLog(hex = 0, AhexN = 'NULL', Bcode = 'NULL', status = 'NULL', mins= 0,
       moment = time.strftime("%Y%m%d-%H%M%S")
       # print to screen regardless
       print('Hex:{:5d} A:{:8s} Dest:{:8s} {:15s} {:15s}'.format(hex, str(AhexN), str(Bcode), status, moment))     
-      # write to sql table
-      curs.execute("{0} ({1},{2},{3},'{4}',{5}) {6}".format(queryInsert,hex, AhexN, Bcode,status, mins, queryUpdate))
-      conn.commit()  
+      # write to sql table (via the result writer, from worker processes)
+      statement = "{0} ({1},{2},{3},'{4}',{5}) {6}".format(queryInsert,hex, AhexN, Bcode,status, mins, queryUpdate)
+      if writing():
+        write_sql(statement)
+      else:
+        curs.execute(statement)
+        conn.commit()
   except:
     print("ERROR: {}".format(sys.exc_info()))
     raise
@@ -184,16 +242,39 @@ def renameSkinny(is_geo, in_obj, out_obj, keep_fields_list=[''], rename_fields_l
       arcpy.MakeTableView_management(in_obj, out_obj, where_clause, field_info=field_info_str)
   return out_obj
 
+def solveOD(A_layer, B_layer):
+  ''' Add origins and destinations to the OD cost matrix layer and solve, returning a list of
+      OD lines (name, length), or None if no solution was found.'''
+  arcpy.AddLocations_na(in_network_analysis_layer = outNALayer, 
+      sub_layer                      = originsLayerName, 
+      in_table                       = A_layer, 
+      field_mappings                 = "Name {} #".format(A_pointsID), 
+      search_tolerance               = "{} Meters".format(searchTolerance), 
+      search_criteria                = "{} SHAPE;{} NONE".format(locateShape,noLocateJunctions), 
+      append                         = "CLEAR", 
+      snap_to_position_along_network = "NO_SNAP", 
+      exclude_restricted_elements    = "INCLUDE",
+      search_query                   = "{} #;{} #".format(locateShape,noLocateJunctions))
+  
+  arcpy.AddLocations_na(in_network_analysis_layer = outNALayer, 
+      sub_layer                      = destinationsLayerName, 
+      in_table                       = B_layer, 
+      field_mappings                 = "Name {} #".format(B_pointsID), 
+      search_tolerance               = "{} Meters".format(searchTolerance), 
+      search_criteria                = "{} SHAPE;{} NONE".format(locateShape,noLocateJunctions), 
+      append                         = "CLEAR", 
+      snap_to_position_along_network = "NO_SNAP", 
+      exclude_restricted_elements    = "INCLUDE",
+      search_query                   = "{} #;{} #".format(locateShape,noLocateJunctions))
+  
+  # Process: Solve
+  result = arcpy.Solve_na(outNALayer, terminate_on_solve_error = "CONTINUE")
+  if result[1] == u'false':
+    return None
+  return [tuple(line) for line in arcpy.da.SearchCursor(ODLinesSubLayer, fields)]
+
 # Worker/Child PROCESS
 def ODMatrixWorkerFunction(hex): 
-  # Connect to SQL database 
-  try:
-    conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
-    curs = conn.cursor()
-  except:
-    print("SQL connection error")
-    print(sys.exc_info()[1])
-    return 100
   # make sure Network Analyst licence is 'checked out'
   arcpy.CheckOutExtension('Network')
  
@@ -204,15 +285,19 @@ def ODMatrixWorkerFunction(hex):
     return(1)
     
   try:
-    arcpy.MakeFeatureLayer_management (A_points, "A_pointsLayer")
-      # note: make sure A_selection is deleted at end of this... 
-      #  ALSO: I commented out the following as no longer made sense: selection_type  = 'ADD_TO_SELECTION'
-    A_selection = arcpy.SelectLayerByAttribute_management("A_pointsLayer", where_clause = '"HEX_ID" = {}'.format(hex))
-    A_pointCount = int(arcpy.GetCount_management(A_selection).getOutput(0))
+    # the hex's parcels are read from the parcel shards (see parcel_shards.py)
+    A_rows = hex_rows(shards, hex)
+    if exclude_disconnected:
+      curs.execute("SELECT point_id FROM {} WHERE point_type = 'parcel' AND hex = {}".format(disconnected_table,hex))
+      disconnected = [x[0] for x in list(curs)]
+      if len(disconnected) > 0:
+        A_rows = A_rows[~np.isin(shards.id[A_rows], disconnected)]
+    A_pointCount = len(A_rows)
 	  # Skip empty hexes
     if A_pointCount == 0:
 	    writeLog(hex,0,'NULL',"no A points",(time.time()-hexStartTime)/60)
 	    return(2)
+    A_selection = shard_layer(shards, A_rows, "A_selection", A_pointsID, A_spatialReference)
 	
     # fetch list of successfully processed destinations for this hex, if any
     # curs.execute("SELECT dest FROM {} WHERE hex = {}".format(log_table,hex))
@@ -229,52 +314,52 @@ def ODMatrixWorkerFunction(hex):
         destNum = destination_list.index(B_points)
         # only procede if > 0 destinations of this type are present in study region
         if count_list[destNum][1] > 0:
-	      # OD Matrix Setup
-          arcpy.AddLocations_na(in_network_analysis_layer = outNALayer, 
-              sub_layer                      = originsLayerName, 
-              in_table                       = A_selection, 
-              field_mappings                 = "Name {} #".format(A_pointsID), 
-              search_tolerance               = "{} Meters".format(searchTolerance), 
-              search_criteria                = "{} SHAPE;{} NONE".format(locateShape,noLocateJunctions), 
-              append                         = "CLEAR", 
-              snap_to_position_along_network = "NO_SNAP", 
-              exclude_restricted_elements    = "INCLUDE",
-              search_query                   = "{} #;{} #".format(locateShape,noLocateJunctions))
+          # destinations located off the main network are excluded
+          where_clause = []
+          if len(disconnected_dest.get(destNum, [])) > 0:
+            where_clause.append('''"{}" NOT IN ('{}')'''.format(B_pointsID, "','".join(disconnected_dest[destNum])))
+          B_layer = B_points
+          if len(where_clause) > 0:
+            B_layer = arcpy.MakeFeatureLayer_management(B_points, "B_pointsLayer", where_clause = where_clause[0])
           
-          arcpy.AddLocations_na(in_network_analysis_layer = outNALayer, 
-              sub_layer                      = destinationsLayerName, 
-              in_table                       = B_points, 
-              field_mappings                 = "Name {} #".format(B_pointsID), 
-              search_tolerance               = "{} Meters".format(searchTolerance), 
-              search_criteria                = "{} SHAPE;{} NONE".format(locateShape,noLocateJunctions), 
-              append                         = "CLEAR", 
-              snap_to_position_along_network = "NO_SNAP", 
-              exclude_restricted_elements    = "INCLUDE",
-              search_query                   = "{} #;{} #".format(locateShape,noLocateJunctions))
+          # only the hex's candidate destinations are added (see hex_destinations.py)
+          B_oids, B_radius = hex_candidates(candidates[B_points], hex)
+          B_candidates = B_layer
+          if not np.isinf(B_radius):
+            B_candidates = arcpy.MakeFeatureLayer_management(B_points, "B_candidatesLayer",
+                             where_clause = ' AND '.join([candidate_clause(B_oidFields[B_points], B_oids)] + where_clause))
+          lines = solveOD(A_selection, B_candidates)
+          outputLines = certified_lines(lines or [], B_radius, searchTolerance)
           
-          # Process: Solve
-          result = arcpy.Solve_na(outNALayer, terminate_on_solve_error = "CONTINUE")
-          if result[1] == u'false':
+          # parcels whose closest candidate may not be the closest destination are solved again against
+          # the destinations within a wider ring, bounded by the closest found (see hex_destinations.py)
+          A_retry = A_rows[~np.isin(shards.id[A_rows], list(line_origins(outputLines)))]
+          while len(A_retry) > 0 and not np.isinf(B_radius):
+            B_oids, B_radius = ring_oids(candidates[B_points], rows_extent(shards, A_retry),
+                                         retry_radius(lines or [], shards.id[A_retry], B_radius, searchTolerance))
+            B_candidates = B_layer
+            if not np.isinf(B_radius):
+              B_candidates = arcpy.MakeFeatureLayer_management(B_points, "B_candidatesLayer",
+                               where_clause = ' AND '.join([candidate_clause(B_oidFields[B_points], B_oids)] + where_clause))
+            lines = solveOD(shard_layer(shards, A_retry, "A_retry", A_pointsID, A_spatialReference), B_candidates)
+            retryLines = certified_lines(lines or [], B_radius, searchTolerance)
+            outputLines += retryLines
+            A_retry = A_retry[~np.isin(shards.id[A_retry], list(line_origins(retryLines)))]
+          if lines is None and len(outputLines) == 0:
+            # log, and continue with the remaining destinations for this hex
             writeLog(hex,A_pointCount,destNum,"no solution",(time.time()-hexStartTime)/60)
-            return(4)
+            continue
           
-          # Extract lines layer, export to SQL database
-          outputLines = arcpy.da.SearchCursor(ODLinesSubLayer, fields)
-          count = 0
-          chunkedLines = list()
+          # Extract lines layer, queue to the result writer (logging the destination as solved once written)
+          rows = list()
           for outputLine in outputLines :
-            count += 1
             ID = outputLine[0].split('-')
             ID1 = ID[1].split(',')
-            chunkedLines.append("('{}',{},{},{})".format(ID[0].strip(' '),ID1[0],ID1[1],int(round(outputLine[1]))))
-            if(count % sqlChunkify == 0):
-              curs.execute(queryPartA + ','.join(rowOfChunk for rowOfChunk in chunkedLines))
-              conn.commit()
-              chunkedLines = list()
-          
-          if(count % sqlChunkify != 0):
-            curs.execute(queryPartA + ','.join(rowOfChunk for rowOfChunk in chunkedLines))
-            conn.commit()
+            rows.append((ID[0].strip(' '),int(ID1[0]),int(ID1[1]),int(round(outputLine[1]))))
+            if len(rows) == sqlChunkify:
+              write_rows(sqlTableName, resultColumns, rows)
+              rows = list()
+          write_rows(sqlTableName, resultColumns, rows)
           writeLog(hex,A_pointCount,destNum,"Solved",(time.time()-hexStartTime)/60)
   
     # return worker function as completed once all destinations processed
@@ -285,13 +370,23 @@ def ODMatrixWorkerFunction(hex):
     return(multiprocessing.current_process().pid)
   finally:
     arcpy.CheckInExtension('Network')
-    conn.close()
 
 # Child/Worker Init functions
 # Iterator must exist on Workers
 
-nWorkers = 4
-hex_list = unique_values(A_points, 'HEX_ID')
+nWorkers = pool_size(parser.get('parallel', 'workers'))
+
+# result writer processes, and the number of rows or seconds after which these commit (see result_writer.py)
+connect = dict(database=sqlDBName, user=sqlUserName, password=sqlPWD)
+write_policy = dict(writers = parser.get('parallel', 'writers'),
+                    batch_rows = parser.get('parallel', 'write_batch_rows'),
+                    batch_secs = parser.get('parallel', 'write_batch_secs'))
+
+# timeout (mins) and retries (with backoff, in seconds) for failed tasks (see task_runner.py)
+task_guard = dict(timeout = parser.get('parallel', 'task_timeout'),
+                  retries = parser.get('parallel', 'task_retries'),
+                  backoff = parser.get('parallel', 'retry_backoff'))
+cost_radius = float(parser.get('parallel', 'cost_radius'))
   
 # MAIN PROCESS
 if __name__ == '__main__':
@@ -311,17 +406,36 @@ if __name__ == '__main__':
   # initiate log file
   writeLog(create='create')
   
-  # Setup a pool of workers/child processes and split log output
-  pool = multiprocessing.Pool(nWorkers)
+  # Setup writer processes, and a pool of workers/child processes writing results via these
+  # (workers are initialised with settings listed once here; see worker_startup.py)
+  settings = stage_settings(curs)
+  queues, writers = start_writers(connect, **write_policy)
+  settings['queues'] = queues
+  pool, startups = start_pool(nWorkers, worker_setup, settings)
   
   # Task name is now defined
   task = 'Create OD cost matrix for A points to B points.'  # Do stuff
   print("Commencing task ({}): {} at {}".format(sqlDBName,task,time.strftime("%Y%m%d-%H%M%S")))
 
-  # Divide work by hexes
+  # Divide work by hexes, largest first (see hex_scheduler.py)
   # Note: if a restricted list of hexes are wished to be processed, just supply a subset of hex_list including only the relevant hex id numbers.
-  hexCursor = hex_list
-  pool.map(ODMatrixWorkerFunction, hexCursor, chunksize=1)
+  # hex costs are weighted by the density of destinations around each hex's parcels
+  shards = load_shards(settings['shard_dir'])
+  curs.execute("SELECT x, y FROM destination_xy")
+  B_xy = np.array(list(curs), dtype = float)
+  hex_costs, in_minutes = plan_hexes(curs, shards.hex, log_table,
+                                     points = (np.repeat(shards.hex, np.diff(shards.offset)), shards.x, shards.y),
+                                     destinations = (B_xy[:,0], B_xy[:,1]),
+                                     radius = cost_radius)
+  hex_costs = exclude_quarantined(curs, script, hex_costs)
+  results = run_largest_first(pool, guarded(ODMatrixWorkerFunction, **task_guard), hex_costs, nWorkers, in_minutes)
+  stage_summary(curs, script, results)
+  startup_summary(startups)
+  pool.close()
+  failed_writes = stop_writers(queues, writers)
+  
+  # tasks whose results failed to be written are reported (as an error), rather than logging the stage as complete
+  check_writes(failed_writes)
   
   # output to completion log    
   script_running_log(script, task, start)
@@ -0,0 +1,378 @@
+# Purpose: This script finds for each A point the closest B point along a network.
+#              - it is an open source alternative to 17_createodmatrix_loop_parallelised_closestab.py
+#                which does not require ArcGIS or a Network Analyst licence
+#              - the pedestrian road network is read once, and held as a compressed sparse
+#                row graph (see network_graph.py)
+#              - two modes are available (set closest_mode in the [network] section of config.ini):
+#                  origin:   a single Dijkstra search per parcel location finds the closest destination
+#                            of every remaining destination type (parcels sharing a network location,
+#                            to within location_quantum, share one search); work is divided by hex,
+#                            with hexes of more than split_parcels parcels split into sub-tasks
+#                            (ranges of parcel ids; see hex_scheduler.py)
+#                  facility: a single multi-source Dijkstra search per destination type, seeded
+#                            from all destinations of that type, labels every network node with
+#                            its closest destination and distance; parcel results are then
+#                            looked up from the node at which they are located.
+#                            If a contraction hierarchy has been built (15c_build_contraction_hierarchy.py)
+#                            each sweep is a PHAST query over the hierarchy (see network_ch.py).
+#                            Work is divided by destination type (one network sweep each).
+#              - it uses parallel processing
+#              - it outputs to the same sql table as script 17 (dist_cl_od_parcel_dest),
+#                so 26_create_table__indicator_dest.py may be run as usual
+#
+#          Note: parcels and destinations are located at their closest position along the network
+#                (network_snaps table; see 15b_snap_points_to_network.py); as per Network Analyst,
+#                the distance from point to network is not included in the reported distance.
+# Authors: Carl Higgs, Koen Simons
+
+import os
+import time
+import multiprocessing
+import sys
+import psycopg2
+import numpy as np
+
+from network_graph import index_targets, closest_by_type, nearest_source, source_seeds, locate_nearest
+from network_snap import location_groups
+from network_service import load_network, submit_stage
+from network_ch import load_ch, phast
+from job_queue import enqueue, run_queue
+from hex_scheduler import pool_size, plan_hexes, completed_hexes, run_largest_first, hex_task, task_part, completed_parts, subtask_sql
+from result_writer import start_writers, stop_writers, sync_writers, check_writes, writer_init, writing, write_rows, write_sql
+from task_runner import guarded, run_tasks, exclude_quarantined, stage_summary
+from script_running_log import script_running_log
+from ConfigParser import SafeConfigParser
+
+
+parser = SafeConfigParser()
+parser.read(os.path.join(sys.path[0],'config.ini'))
+
+# simple timer for log file
+start = time.time()
+script = os.path.basename(sys.argv[0])
+
+# INPUT PARAMETERS
+folderPath = parser.get('data', 'folderPath')
+urbanGdb    = os.path.join(folderPath,parser.get('data', 'workspace'))
+
+# Specify geodatabase with feature classes of "origins"
+A_points = parser.get('parcels', 'parcel_dwellings')
+A_pointsID = parser.get('parcels', 'parcel_id')
+
+# List of 31 potentially relevant destinations: see destinations.csv in LI scripts folder for details
+destination_list = parser.get('destinations', 'destination_list').split(',')
+
+## Network settings
+network_edges = parser.get('roads', 'pedestrian_road_edges')
+graph_cache = os.path.join(folderPath,parser.get('network', 'graph_cache'))
+closest_mode = parser.get('network', 'closest_mode')
+location_quantum = float(parser.get('network', 'location_quantum'))
+ch_file = os.path.join(folderPath,parser.get('network', 'contraction_hierarchy'))
+
+hexStart = 0
+
+
+# SQL Settings
+sqlDBName   = parser.get('postgresql', 'database')
+sqlUserName = parser.get('postgresql', 'user')
+sqlPWD      = parser.get('postgresql', 'password')
+
+# work is dispatched to a local pool of workers, or via a job queue which may be shared by
+# workers on other hosts (see job_queue.py)
+dispatch = parser.get('parallel', 'dispatch')
+connect  = dict(database=sqlDBName, user=sqlUserName, password=sqlPWD)
+if dispatch == 'queue':
+  connect['host'] = parser.get('postgresql', 'host')
+
+sqlTableName  = "dist_cl_od_parcel_dest"
+log_table    = "log_dist_cl_od_parcel_dest"
+
+# rows per batch queued to the result writer
+sqlChunkify = 5000
+
+
+# Define query to create table
+createTable     = '''
+  CREATE TABLE IF NOT EXISTS {0}
+  ({1} varchar NOT NULL ,
+   dest smallint NOT NULL ,
+   oid bigint NOT NULL ,
+   distance integer NOT NULL,
+   PRIMARY KEY({1},dest)
+   );
+   '''.format(sqlTableName, A_pointsID)
+
+# columns of OD matrix table, as written by the result writer
+resultColumns = (A_pointsID.lower(), 'dest', 'oid', 'distance')
+
+createTable_log     = '''
+        CREATE TABLE IF NOT EXISTS {}
+          (hex integer NOT NULL,
+          parcel_count integer NOT NULL,
+          dest varchar,
+          status varchar,
+          mins double precision,
+          PRIMARY KEY(hex,dest)
+          );
+          '''.format(log_table)
+
+queryInsert      = '''
+  INSERT INTO {} VALUES
+  '''.format(log_table)
+
+
+queryUpdate      = '''
+  ON CONFLICT ({0},{4})
+  DO UPDATE SET {1}=EXCLUDED.{1},{2}=EXCLUDED.{2},{3}=EXCLUDED.{3}
+  '''.format('hex','parcel_count','status','mins','dest')
+
+
+## Functions defined for this script
+# Define log file write method
+def writeLog(hex = 0, AhexN = 'NULL', Bcode = 'NULL', status = 'NULL', mins= 0, create = log_table):
+  try:
+    if create == 'create':
+      curs.execute(createTable_log)
+      conn.commit()
+
+    else:
+      moment = time.strftime("%Y%m%d-%H%M%S")
+      # print to screen regardless
+      print('Hex:{:5d} A:{:8s} Dest:{:8s} {:15s} {:15s}'.format(hex, str(AhexN), str(Bcode), status, moment))
+      # write to sql table (via the result writer, from worker processes)
+      statement = "{0} ({1},{2},{3},'{4}',{5}) {6}".format(queryInsert,hex, AhexN, Bcode,status, mins, queryUpdate)
+      if writing():
+        write_sql(statement)
+      else:
+        curs.execute(statement)
+        conn.commit()
+  except:
+    print("ERROR: {}".format(sys.exc_info()))
+    raise
+
+# Child/Worker Init function
+# each worker opens its own connection to the SQL database, used to check progress, and writes
+# results and logs via the result writer processes
+def worker_init(queues):
+  global conn, curs
+  conn = psycopg2.connect(**connect)
+  curs = conn.cursor()
+  writer_init(queues)
+
+# Log a destination as solved for a hex, or for a sub-task (logging the hex once all of its parts are solved)
+def logSolved(hex, part, parts, AhexN, destNum, mins):
+  if parts > 1:
+    write_sql(subtask_sql(log_table, hex, destNum, part, parts, AhexN, "Solved", mins, log_table,
+                          ['hex', 'sum(parcel_count)', 'dest', 'status', 'sum(mins)'], queryUpdate))
+  else:
+    writeLog(hex,AhexN,destNum,"Solved",mins)
+
+# Worker/Child PROCESS
+def ODMatrixWorkerFunction(task):
+  # Worker Task is hex-specific by definition/parallel (or a range of parcels within a large hex)
+  #   Skip if hex was finished in previous run
+  hexStartTime = time.time()
+  hex, part, parts = hex_task(task)
+  if hex < hexStart:
+    return(1)
+
+  try:
+    # parcels are ordered by id within hex (see read_snaps), so parts are ranges of parcel ids
+    A_selection = task_part(np.flatnonzero(A_hex == hex), part, parts)
+    A_pointCount = len(A_selection)
+    # Skip empty hexes
+    if A_pointCount == 0:
+      writeLog(hex,0,'NULL',"no A points",(time.time()-hexStartTime)/60)
+      return(2)
+
+    # fetch list of successfully processed destinations for this hex, if any
+    curs.execute("SELECT dest FROM {} WHERE hex = {}".format(log_table,hex))
+    completed_dest = [int(x[0]) for x in list(curs)]
+    if parts > 1:
+      completed_dest += [int(x) for x in completed_parts(curs, log_table, hex, part, parts)]
+
+    # only procede for destinations with > 0 destinations of this type present in study region
+    remaining_dest = [destNum for destNum in range(len(destination_list))
+                        if destNum not in completed_dest and destNum in located_dest]
+    if len(remaining_dest) == 0:
+      return 0
+
+    # a single search per network location finds the closest destination of each remaining type,
+    # for all parcels at that location
+    rows = list()
+    for members in location_groups(graph, A_edge[A_selection], A_offset[A_selection], location_quantum):
+      origin = A_selection[members[0]]
+      closest = closest_by_type(graph, (A_edge[origin], A_offset[origin]), dest_targets, remaining_dest)
+      for i in A_selection[members]:
+        for destNum in remaining_dest:
+          if destNum in closest:
+            oid, distance = closest[destNum]
+            rows.append((A_id[i],destNum,oid,int(round(distance))))
+            if len(rows) == sqlChunkify:
+              write_rows(sqlTableName, resultColumns, rows)
+              rows = list()
+    write_rows(sqlTableName, resultColumns, rows)
+    for destNum in remaining_dest:
+      logSolved(hex,part,parts,A_pointCount,destNum,(time.time()-hexStartTime)/60)
+
+    # return worker function as completed once all destinations processed
+    return 0
+
+  except:
+    conn.rollback()
+    writeLog(hex, multiprocessing.current_process().pid, "'ERROR'", str(sys.exc_info()[1]).replace("'",""), (time.time()-hexStartTime)/60)
+    return(multiprocessing.current_process().pid)
+
+# Worker/Child PROCESS (closest facility mode)
+def ClosestFacilityWorkerFunction(destNum):
+  destStartTime = time.time()
+  try:
+    # fetch list of hexes already processed for this destination, if any
+    curs.execute("SELECT hex FROM {} WHERE dest = '{}'".format(log_table,destNum))
+    done_hexes = set([int(x[0]) for x in list(curs)])
+    A_selection = np.flatnonzero(~np.isin(A_hex, list(done_hexes)))
+    if len(A_selection) == 0:
+      return 0
+
+    # one sweep of the network from all destinations of this type
+    sources = dest_sources[destNum]
+    if ch is not None:
+      node_distance, node_oid = phast(ch, source_seeds(sources))
+    else:
+      node_distance, node_oid = nearest_source(graph, source_seeds(sources))
+    distance, oid = locate_nearest(graph, node_distance, node_oid, A_edge[A_selection], A_offset[A_selection], sources)
+
+    rows = list()
+    for i, d, o in zip(A_selection, distance, oid):
+      if o < 0:
+        # no destination of this type reachable
+        continue
+      rows.append((A_id[i],destNum,o,int(round(d))))
+      if len(rows) == sqlChunkify:
+        write_rows(sqlTableName, resultColumns, rows)
+        rows = list()
+    write_rows(sqlTableName, resultColumns, rows)
+
+    # log completion by hex, so that results are comparable with those processed in origin mode
+    hexes, hex_counts = np.unique(A_hex[A_selection], return_counts = True)
+    for hex, hex_count in zip(hexes, hex_counts):
+      writeLog(int(hex),hex_count,destNum,"Solved",(time.time()-destStartTime)/60)
+    return 0
+
+  except:
+    conn.rollback()
+    print("ERROR: destination {}: {}".format(destNum, sys.exc_info()))
+    return(multiprocessing.current_process().pid)
+
+nWorkers = pool_size(parser.get('parallel', 'workers'))
+
+# result writer processes, and the number of rows or seconds after which these commit (see result_writer.py)
+write_policy = dict(writers = parser.get('parallel', 'writers'),
+                    batch_rows = parser.get('parallel', 'write_batch_rows'),
+                    batch_secs = parser.get('parallel', 'write_batch_secs'))
+
+# timeout (mins) and retries (with backoff, in seconds) for failed tasks (see task_runner.py)
+task_guard = dict(timeout = parser.get('parallel', 'task_timeout'),
+                  retries = parser.get('parallel', 'task_retries'),
+                  backoff = parser.get('parallel', 'retry_backoff'))
+cost_radius = float(parser.get('parallel', 'cost_radius'))
+split_parcels = int(parser.get('parallel', 'split_parcels'))
+
+# Worker state: the network graph, parcel and destination locations on it (see network_service.load_network),
+# and destination indices, set as globals which are inherited by the worker processes when these are forked
+def stage_state(network):
+  global graph, A_id, A_hex, A_edge, A_offset, B_edge, dest_targets, located_dest, dest_sources, ch
+  graph = network['graph']
+  A_id, A_hex, A_edge, A_offset = network['parcel']
+  B_id, B_hex, B_edge, B_offset = network['destination']
+  B_label = [tuple(int(x) for x in id.split(',')) for id in B_id]
+  dest_targets = index_targets(graph, B_edge, B_offset, B_label)
+  located_dest = set([label[0] for label in B_label])
+  # in facility mode, destinations of each type are indexed separately, labelled by oid
+  B_type = np.array([label[0] for label in B_label], dtype = np.int64)
+  B_oid  = np.array([label[1] for label in B_label], dtype = np.int64)
+  dest_sources = {}
+  for destNum in located_dest:
+    of_type = B_type == destNum
+    dest_sources[destNum] = index_targets(graph, B_edge[of_type], B_offset[of_type], B_oid[of_type].tolist())
+
+  ch = None
+  if closest_mode == 'facility' and os.path.isfile(ch_file):
+    print("Loading contraction hierarchy {}... ".format(ch_file)),
+    ch = load_ch(ch_file, graph)
+    print("Done.")
+
+# Run the stage, using a pool of workers writing results via the given writer processes
+# (run by the main process below, or by the network service; see network_service.py)
+def run_stage(pool, queues, writers):
+  global conn, curs
+  try:
+    conn = psycopg2.connect(**connect)
+    curs = conn.cursor()
+
+    # create OD matrix table
+    curs.execute(createTable)
+    conn.commit()
+
+  except:
+    print("SQL connection error")
+    print(sys.exc_info()[0])
+    raise
+
+  # initiate log file
+  writeLog(create='create')
+
+  # Task name is now defined
+  task = 'Create OD cost matrix for A points to B points (CSR network graph).'  # Do stuff
+  print("Commencing task ({}): {} at {}".format(sqlDBName,task,time.strftime("%Y%m%d-%H%M%S")))
+
+  if closest_mode == 'facility':
+    # Divide work by destination type (one network sweep per destination type); these tasks are
+    # quarantined separately from the hex tasks of origin mode, as both are numbered
+    facility_stage = '{}:facility'.format(script)
+    dest_tasks = exclude_quarantined(curs, facility_stage, dict((destNum, 1) for destNum in located_dest))
+    outcomes = dict((destNum, outcome) for destNum, outcome, mins in run_tasks(pool, guarded(ClosestFacilityWorkerFunction, **task_guard), sorted(dest_tasks)))
+    stage_summary(curs, facility_stage, outcomes)
+  else:
+    # Divide work by hexes, largest first (cost weighted by local destination density)
+    # Note: if a restricted list of hexes are wished to be processed, just supply a subset of hex_list including only the relevant hex id numbers.
+    # (hexes already processed for every destination type, as per the stage log, are not queued again)
+    hex_done = completed_hexes(curs, log_table, located_dest)
+    hex_list = [x for x in np.unique(A_hex) if x not in hex_done]
+    hex_costs, in_minutes = plan_hexes(curs, hex_list, log_table,
+                                       points = (A_hex, graph.node_x[graph.edge_u[A_edge]], graph.node_y[graph.edge_u[A_edge]]),
+                                       destinations = (graph.node_x[graph.edge_u[B_edge]], graph.node_y[graph.edge_u[B_edge]]),
+                                       radius = cost_radius,
+                                       split = split_parcels)
+    hex_costs = exclude_quarantined(curs, script, hex_costs)
+    if dispatch == 'queue':
+      enqueue(curs, log_table, hex_costs)
+      run_queue(pool, guarded(ODMatrixWorkerFunction, **task_guard), log_table, connect, nWorkers, quarantine_stage = script)
+    else:
+      results = run_largest_first(pool, guarded(ODMatrixWorkerFunction, **task_guard), hex_costs, nWorkers, in_minutes, label = 'hex tasks')
+      stage_summary(curs, script, results)
+  failed_writes = sync_writers(queues, writers)
+
+  # tasks whose results failed to be written are reported (as an error), rather than logging the stage as complete
+  check_writes(failed_writes)
+
+  # output to completion log
+  script_running_log(script, task, start)
+  conn.close()
+
+# MAIN PROCESS
+if __name__ == '__main__':
+  # run by the network service, if running (see network_service.py), or otherwise here
+  if submit_stage(script) is None:
+    # Build network graph and read A and B point locations on network
+    # (these are inherited by the worker processes when these are forked)
+    stage_state(load_network(connect, graph_cache, urbanGdb, network_edges))
+
+    # Setup writer processes, and a pool of workers/child processes writing results via these
+    queues, writers = start_writers(connect, **write_policy)
+    pool = multiprocessing.Pool(nWorkers, initializer = worker_init, initargs = (queues,))
+    try:
+      run_stage(pool, queues, writers)
+    finally:
+      pool.close()
+      stop_writers(queues, writers)
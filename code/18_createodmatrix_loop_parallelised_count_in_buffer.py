@@ -8,7 +8,12 @@ import multiprocessing
 import sys
 import psycopg2 
 import numpy as np
-from progressor import progressor
+from progress_tracker import start_progress, stop_progress, progress_init, report_progress
+from hex_scheduler import pool_size, plan_hexes, run_largest_first
+from task_runner import guarded, exclude_quarantined, stage_summary
+from worker_startup import start_pool, startup_summary
+from result_writer import start_writers, stop_writers, check_writes, writer_init, writing, write_rows, write_sql
+from parcel_shards import build_shards, load_shards, hex_rows, shard_layer
 
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
@@ -35,11 +40,12 @@ arcpy.env.overwriteOutput = True
 A_points = os.path.join(urbanGdb,parser.get('parcels', 'parcel_dwellings'))
 A_pointsID = parser.get('parcels', 'parcel_id')
 
+# parcel ids and coordinates by hex (see parcel_shards.py)
+shard_cache = os.path.join(folderPath,parser.get('network', 'parcel_shards'))
+
 ## specify "destinations", which in this context are parcels which we shall refer to as "B_points"
 B_pointsID = parser.get('destinations', 'destination_id')
 
-featureClasses = arcpy.ListFeatureClasses()
-
 # List of 31 potentially relevant destinations: see destinations.csv in LI scripts folder for details
 destination_list = parser.get('destinations', 'count_destinations').split(',')
 cutoffs          = parser.get('destinations', 'count_cutoffs').split(',')
@@ -62,22 +68,29 @@ sqlPWD      = parser.get('postgresql', 'password')
 
 sqlTableName  = "parcel_dest_counts"
 log_table     = "log_parcel_dest_counts"
-queryPartA    = "INSERT INTO {} VALUES ".format(sqlTableName)
-
-sqlChunkify = 500
 
-       
-# initiate postgresql connection
-conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
-curs = conn.cursor()
+# rows per batch queued to the result writer
+sqlChunkify = 5000
 
-# get pid name
-pid = multiprocessing.current_process().name
-# create initial OD cost matrix layer on worker processors
 
-curs.execute("SELECT dest_name,dest_count FROM dest_type")
-count_list = list(curs)
+# Worker/Child setup (pool initializer; see worker_startup.py)
+#   -- destination feature classes and counts are listed once by the main process and passed
+#      to workers as settings, rather than queried on import
+#   -- each worker opens its own connection to the SQL database, used to check progress, and writes
+#      results and logs via the result writer processes
+def worker_setup(settings):
+  global conn, curs, featureClasses, count_list, shards, A_spatialReference
+  shards         = load_shards(settings['shard_dir'])
+  A_spatialReference = arcpy.Describe(A_points).spatialReference
+  featureClasses = settings['featureClasses']
+  count_list     = settings['count_list']
+  progress_init(settings['progress'])
   
+  # initiate postgresql connection, and result writer queues
+  conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
+  curs = conn.cursor()
+  writer_init(settings['queues'])
+
 
 # Define query to create table
 createTable     = '''
@@ -89,10 +102,10 @@ createTable     = '''
    PRIMARY KEY({1},dest)
    );
    '''.format(sqlTableName, A_pointsID)
+
+# columns of count table, as written by the result writer
+resultColumns = (A_pointsID.lower(), 'dest', 'cutoff', 'count')
    
-queryPartA      = '''
-  INSERT INTO {} VALUES
-  '''.format(sqlTableName)
   
 createTable_log     = '''
         CREATE TABLE IF NOT EXISTS {}
@@ -128,9 +141,13 @@ def writeLog(hex = 0, AhexN = 'NULL', Bcode = 'NULL', status = 'NULL', mins= 0,
       moment = time.strftime("%Y%m%d-%H%M%S")
       # print to screen regardless
       # print('Hex:{:5d} A:{:8s} Dest:{:8s} {:15s} {:15s}'.format(hex, str(AhexN), str(Bcode), status, moment))     
-      # write to sql table
-      curs.execute("{0} ({1},{2},{3},'{4}',{5}) {6}".format(queryInsert,hex, AhexN, Bcode,status, mins, queryUpdate))
-      conn.commit()  
+      # write to sql table (via the result writer, from worker processes)
+      statement = "{0} ({1},{2},{3},'{4}',{5}) {6}".format(queryInsert,hex, AhexN, Bcode,status, mins, queryUpdate)
+      if writing():
+        write_sql(statement)
+      else:
+        curs.execute(statement)
+        conn.commit()
   except:
     print("ERROR: {}".format(sys.exc_info()))
     raise
@@ -166,14 +183,6 @@ def renameSkinny(is_geo, in_obj, out_obj, keep_fields_list=[''], rename_fields_l
 
 # Worker/Child PROCESS
 def ODMatrixWorkerFunction(hex): 
-  # Connect to SQL database 
-  try:
-    conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
-    curs = conn.cursor()
-  except:
-    print("SQL connection error")
-    print(sys.exc_info()[1])
-    return 100
   # make sure Network Analyst licence is 'checked out'
   arcpy.CheckOutExtension('Network')
  
@@ -184,15 +193,14 @@ def ODMatrixWorkerFunction(hex):
     return(1)
     
   try:
-    arcpy.MakeFeatureLayer_management (A_points, "A_pointsLayer")
-      # note: make sure A_selection is deleted at end of this... 
-      #  ALSO: I commented out the following as no longer made sense: selection_type  = 'ADD_TO_SELECTION'
-    A_selection = arcpy.SelectLayerByAttribute_management("A_pointsLayer".format(hex), where_clause = '"HEX_ID" = {}'.format(hex))
-    A_pointCount = int(arcpy.GetCount_management(A_selection).getOutput(0))
+    # the hex's parcels are read from the parcel shards (see parcel_shards.py)
+    A_rows = hex_rows(shards, hex)
+    A_pointCount = len(A_rows)
       # Skip empty hexes
     if A_pointCount == 0:
         writeLog(hex,0,'NULL',"no A points",(time.time()-hexStartTime)/60)
         return(2)
+    A_selection = shard_layer(shards, A_rows, "A_selection", A_pointsID, A_spatialReference)
     
     # fetch list of successfully processed destinations for this hex, if any
     # curs.execute("SELECT dest FROM {} WHERE hex = {}".format(log_table,hex))
@@ -257,33 +265,27 @@ def ODMatrixWorkerFunction(hex):
           result = arcpy.Solve_na(outNALayer, terminate_on_solve_error = "CONTINUE")
           if result[1] == u'false':
             writeLog(hex,A_pointCount,destNum,"no solution",(time.time()-hexStartTime)/60)
-            return(4)
+            report_progress(1, (hex, destNum))
+            continue
           place = "before numpy"
           df = arcpy.da.TableToNumPyArray(ODLinesSubLayer, 'Name')    
           stripped_df = [f[0].encode('utf-8').split(' - ')[0] for f in df]
           id_counts = np.unique(stripped_df, return_counts=True)
           length  = len(id_counts[0])-1
-          count = 0
-          chunkedLines = list()
+          rows = list()
           place = "before loop"
           for x in range(0,length) :
-            count += 1
             ID = id_counts[0][x]
             tally = id_counts[1][x]
-            string = "('{}',{},{},{})".format(ID,destNum,int(cutoffs[destNum]),tally)
-            chunkedLines.append("('{}',{},{},{})".format(ID,destNum,int(cutoffs[destNum]),tally))
-            if(count % sqlChunkify == 0):
-              place = "before postgresql out"
-              curs.execute(queryPartA + ','.join(rowOfChunk for rowOfChunk in chunkedLines))
-              conn.commit()
-              chunkedLines = list() 
-          if(count % sqlChunkify != 0):
-            curs.execute(queryPartA + ','.join(rowOfChunk for rowOfChunk in chunkedLines))
-            conn.commit()
+            rows.append((ID,destNum,int(cutoffs[destNum]),int(tally)))
+            if len(rows) == sqlChunkify:
+              place = "before result writer"
+              write_rows(sqlTableName, resultColumns, rows)
+              rows = list()
+          # queued to the result writer (logging the destination as solved once written)
+          write_rows(sqlTableName, resultColumns, rows)
           writeLog(hex,A_pointCount,destNum,"Solved",(time.time()-hexStartTime)/60)
-          curs.execute("SELECT count(*) FROM {}".format(log_table))
-          progress = int(list(curs)[0][0])
-          progressor(progress,hex_dest_combinations,start,"{}/{} hex-destination combinations processed".format(progress,hex_dest_combinations))
+          report_progress(1, (hex, destNum))
     # return worker function as completed once all destinations processed
     return 0
   
@@ -295,15 +297,24 @@ def ODMatrixWorkerFunction(hex):
     return(multiprocessing.current_process().pid)
   finally:
     arcpy.CheckInExtension('Network')
-    conn.close()
 
 # Child/Worker Init functions
 # Iterator must exist on Workers
 
-nWorkers = 4
-hex_list = unique_values(A_points, 'HEX_ID')
-# tally expected hex-destination result set
-hex_dest_combinations = len(hex_list)*len(destination_list)
+nWorkers = pool_size(parser.get('parallel', 'workers'))
+
+# result writer processes, and the number of rows or seconds after which these commit (see result_writer.py)
+connect = dict(database=sqlDBName, user=sqlUserName, password=sqlPWD)
+write_policy = dict(writers = parser.get('parallel', 'writers'),
+                    batch_rows = parser.get('parallel', 'write_batch_rows'),
+                    batch_secs = parser.get('parallel', 'write_batch_secs'))
+
+# timeout (mins) and retries (with backoff, in seconds) for failed tasks (see task_runner.py)
+task_guard = dict(timeout = parser.get('parallel', 'task_timeout'),
+                  retries = parser.get('parallel', 'task_retries'),
+                  backoff = parser.get('parallel', 'retry_backoff'))
+progress_interval = parser.get('parallel', 'progress_interval')
+cost_radius = float(parser.get('parallel', 'cost_radius'))
 
 # MAIN PROCESS
 if __name__ == '__main__':
@@ -323,23 +334,47 @@ if __name__ == '__main__':
   # initiate log file
   writeLog(create='create')
   
-  # Setup a pool of workers/child processes and split log output
-  pool = multiprocessing.Pool(nWorkers)
-  
   # Task name is now defined
   task = 'Count B points within network buffer distance of A points'  # Do stuff
   print("Commencing task ({}): {} at {}".format(sqlDBName,task,time.strftime("%Y%m%d-%H%M%S")))
   
-  # get count of completed hex-destination combinations
+  # tally expected hex-destination result set
+  shard_dir = build_shards(shard_cache, urbanGdb, parser.get('parcels', 'parcel_dwellings'), A_pointsID)
+  shards = load_shards(shard_dir)
+  hex_dest_combinations = len(shards.hex)*len(destination_list)
+  
+  # get count of completed hex-destination combinations (once; progress is then tallied from worker reports)
   curs.execute("SELECT count(*) FROM {}".format(log_table))
   log_progress = int(list(curs)[0][0])
   
-  # iterate over hexes while log count is shorter than expected tally of hex-destination combinations  
-  progressor(log_progress,hex_dest_combinations,start,"{}/{} hex-destination combinations processed".format(log_progress,hex_dest_combinations))
-  while log_progress < hex_dest_combinations:  
-    pool.map(ODMatrixWorkerFunction, hex_list, chunksize=1)
-    curs.execute("SELECT count(*) FROM {}".format(log_table))
-    log_progress = int(list(curs)[0][0])
+  # hex costs are weighted by the density of destinations around each hex's parcels
+  curs.execute("SELECT x, y FROM destination_xy")
+  B_xy = np.array(list(curs), dtype = float)
+  hex_costs, in_minutes = plan_hexes(curs, shards.hex, log_table,
+                                     points = (np.repeat(shards.hex, np.diff(shards.offset)), shards.x, shards.y),
+                                     destinations = (B_xy[:,0], B_xy[:,1]),
+                                     radius = cost_radius)
+
+  # process each hex once; failed hexes are retried (with backoff) up to task_retries times,
+  # then quarantined, rather than re-running all hexes until the log is complete
+  hex_costs = exclude_quarantined(curs, script, hex_costs)
+  
+  # Setup writer processes, and a pool of workers/child processes writing results via these
+  # (workers are initialised with settings listed once here; see worker_startup.py)
+  tracker = start_progress(hex_dest_combinations, log_progress, 'hex-destination combinations processed', progress_interval)
+  queues, writers = start_writers(connect, **write_policy)
+  curs.execute("SELECT dest_name,dest_count FROM dest_type")
+  settings = dict(shard_dir = shard_dir, featureClasses = arcpy.ListFeatureClasses(), count_list = list(curs), progress = tracker[1], queues = queues)
+  pool, startups = start_pool(nWorkers, worker_setup, settings)
+  results = run_largest_first(pool, guarded(ODMatrixWorkerFunction, **task_guard), hex_costs, nWorkers, in_minutes, progress = False)
+  stop_progress(*tracker, label = 'hex-destination combinations processed')
+  stage_summary(curs, script, results)
+  startup_summary(startups)
+  pool.close()
+  failed_writes = stop_writers(queues, writers)
+  
+  # tasks whose results failed to be written are reported (as an error), rather than logging the stage as complete
+  check_writes(failed_writes)
   
   # output to completion log    
   script_running_log(script, task, start)
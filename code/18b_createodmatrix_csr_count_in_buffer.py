@@ -0,0 +1,329 @@
+# Purpose: This script counts the number of destinations within a network distance of parcels
+#              - it is an open source alternative to 18_createodmatrix_loop_parallelised_count_in_buffer.py
+#                which does not require ArcGIS or a Network Analyst licence
+#              - rather than solving an OD matrix for each destination type and cutoff, a single
+#                bounded network search per parcel location (to the largest cutoff; parcels sharing
+#                a network location, to within location_quantum, share one search) tallies reachable
+#                destinations of every type against that type's own cutoff, as well as against
+#                any optional extra cutoffs (count_extra_cutoffs in config.ini)
+#              - hexes of more than split_parcels parcels are split into sub-tasks (ranges of
+#                parcel ids; see hex_scheduler.py)
+#              - it outputs to the same sql table as script 18 (parcel_dest_counts), and if extra
+#                cutoffs are specified, to a multi-cutoff table (parcel_dest_counts_multi)
+# Authors: Carl Higgs, Koen Simons
+
+import os
+import time
+import multiprocessing
+import sys
+import psycopg2
+import numpy as np
+
+from network_graph import index_targets, targets_within
+from network_snap import location_groups
+from network_service import load_network, submit_stage
+from job_queue import enqueue, run_queue
+from hex_scheduler import pool_size, plan_hexes, completed_hexes, run_largest_first, hex_task, task_part, completed_parts, subtask_sql
+from result_writer import start_writers, stop_writers, sync_writers, check_writes, writer_init, writing, write_rows, write_sql
+from task_runner import guarded, exclude_quarantined, stage_summary
+from script_running_log import script_running_log
+from ConfigParser import SafeConfigParser
+
+
+parser = SafeConfigParser()
+parser.read(os.path.join(sys.path[0],'config.ini'))
+
+# simple timer for log file
+start = time.time()
+script = os.path.basename(sys.argv[0])
+
+# INPUT PARAMETERS
+folderPath = parser.get('data', 'folderPath')
+urbanGdb    = os.path.join(folderPath,parser.get('data', 'workspace'))
+
+# Specify geodatabase with feature classes of "origins"
+A_points = parser.get('parcels', 'parcel_dwellings')
+A_pointsID = parser.get('parcels', 'parcel_id')
+
+# List of 31 potentially relevant destinations: see destinations.csv in LI scripts folder for details
+# (the destination code in destination_xy is the index in destination_list)
+all_destination_list = parser.get('destinations', 'destination_list').split(',')
+destination_list = parser.get('destinations', 'count_destinations').split(',')
+cutoffs          = [int(x) for x in parser.get('destinations', 'count_cutoffs').split(',')]
+extra_cutoffs    = [int(x) for x in parser.get('destinations', 'count_extra_cutoffs').split(',') if x.strip() != '']
+max_cutoff       = max(cutoffs + extra_cutoffs)
+
+## Network settings
+network_edges = parser.get('roads', 'pedestrian_road_edges')
+graph_cache = os.path.join(folderPath,parser.get('network', 'graph_cache'))
+location_quantum = float(parser.get('network', 'location_quantum'))
+
+hexStart = 0
+
+# SQL Settings
+sqlDBName   = parser.get('postgresql', 'database')
+sqlUserName = parser.get('postgresql', 'user')
+sqlPWD      = parser.get('postgresql', 'password')
+
+# work is dispatched to a local pool of workers, or via a job queue which may be shared by
+# workers on other hosts (see job_queue.py)
+dispatch = parser.get('parallel', 'dispatch')
+connect  = dict(database=sqlDBName, user=sqlUserName, password=sqlPWD)
+if dispatch == 'queue':
+  connect['host'] = parser.get('postgresql', 'host')
+
+sqlTableName   = "parcel_dest_counts"
+multiTableName = "parcel_dest_counts_multi"
+log_table      = "log_parcel_dest_counts"
+
+# rows per batch queued to the result writer
+sqlChunkify = 5000
+
+
+# Define query to create table
+createTable     = '''
+  CREATE TABLE IF NOT EXISTS {0}
+  ({1} varchar NOT NULL ,
+   dest smallint NOT NULL ,
+   cutoff integer NOT NULL,
+   count integer NOT NULL,
+   PRIMARY KEY({1},dest)
+   );
+   '''.format(sqlTableName, A_pointsID)
+
+createTable_multi     = '''
+  CREATE TABLE IF NOT EXISTS {0}
+  ({1} varchar NOT NULL ,
+   dest smallint NOT NULL ,
+   cutoff integer NOT NULL,
+   count integer NOT NULL,
+   PRIMARY KEY({1},dest,cutoff)
+   );
+   '''.format(multiTableName, A_pointsID)
+
+# columns of count tables, as written by the result writer
+resultColumns = (A_pointsID.lower(), 'dest', 'cutoff', 'count')
+
+createTable_log     = '''
+        CREATE TABLE IF NOT EXISTS {}
+          (hex integer NOT NULL,
+          parcel_count integer NOT NULL,
+          dest varchar,
+          status varchar,
+          mins double precision,
+          PRIMARY KEY(hex,dest)
+          );
+          '''.format(log_table)
+
+queryInsert      = '''
+  INSERT INTO {} VALUES
+  '''.format(log_table)
+
+
+queryUpdate      = '''
+  ON CONFLICT ({0},{4})
+  DO UPDATE SET {1}=EXCLUDED.{1},{2}=EXCLUDED.{2},{3}=EXCLUDED.{3}
+  '''.format('hex','parcel_count','status','mins','dest')
+
+
+## Functions defined for this script
+# Define log file write method
+def writeLog(hex = 0, AhexN = 'NULL', Bcode = 'NULL', status = 'NULL', mins= 0, create = log_table):
+  try:
+    if create == 'create':
+      curs.execute(createTable_log)
+      conn.commit()
+
+    else:
+      moment = time.strftime("%Y%m%d-%H%M%S")
+      # write to sql table (via the result writer, from worker processes)
+      statement = "{0} ({1},{2},{3},'{4}',{5}) {6}".format(queryInsert,hex, AhexN, Bcode,status, mins, queryUpdate)
+      if writing():
+        write_sql(statement)
+      else:
+        curs.execute(statement)
+        conn.commit()
+  except:
+    print("ERROR: {}".format(sys.exc_info()))
+    raise
+
+# Child/Worker Init function
+# each worker opens its own connection to the SQL database, used to check progress, and writes
+# results and logs via the result writer processes
+def worker_init(queues):
+  global conn, curs
+  conn = psycopg2.connect(**connect)
+  curs = conn.cursor()
+  writer_init(queues)
+
+# Log a destination as solved for a hex, or for a sub-task (logging the hex once all of its parts are solved)
+def logSolved(hex, part, parts, AhexN, destNum, mins):
+  if parts > 1:
+    write_sql(subtask_sql(log_table, hex, destNum, part, parts, AhexN, "Solved", mins, log_table,
+                          ['hex', 'sum(parcel_count)', 'dest', 'status', 'sum(mins)'], queryUpdate))
+  else:
+    writeLog(hex,AhexN,destNum,"Solved",mins)
+
+# Worker/Child PROCESS
+def CountInBufferWorkerFunction(task):
+  # Worker Task is hex-specific by definition/parallel (or a range of parcels within a large hex)
+  # Skip if hex was finished in previous run
+  hexStartTime = time.time()
+  hex, part, parts = hex_task(task)
+  if hex < hexStart:
+    return(1)
+
+  try:
+    # parcels are ordered by id within hex (see read_snaps), so parts are ranges of parcel ids
+    A_selection = task_part(np.flatnonzero(A_hex == hex), part, parts)
+    A_pointCount = len(A_selection)
+    # Skip empty hexes
+    if A_pointCount == 0:
+      writeLog(hex,0,'NULL',"no A points",(time.time()-hexStartTime)/60)
+      return(2)
+
+    # fetch list of successfully processed destinations for this hex, if any
+    curs.execute("SELECT dest FROM {} WHERE hex = {}".format(log_table,hex))
+    completed_dest = [int(x[0]) for x in list(curs) if x[0] != 'NULL']
+    if parts > 1:
+      completed_dest += [int(x) for x in completed_parts(curs, log_table, hex, part, parts)]
+    remaining_dest = set([destNum for destNum in located_dest if destNum not in completed_dest])
+    if len(remaining_dest) == 0:
+      return 0
+
+    rows = list()
+    rows_multi = list()
+    for members in location_groups(graph, A_edge[A_selection], A_offset[A_selection], location_quantum):
+      # one bounded search tallies all destination types at all cutoffs, for all parcels at this location
+      origin = A_selection[members[0]]
+      tally       = {}
+      tally_extra = {}
+      for (destNum, oid), d in targets_within(graph, (A_edge[origin], A_offset[origin]), dest_targets, max_cutoff).items():
+        if destNum not in remaining_dest:
+          continue
+        if d <= cutoffs[destNum]:
+          tally[destNum] = tally.get(destNum, 0) + 1
+        for cutoff in extra_cutoffs:
+          if d <= cutoff:
+            tally_extra[(destNum, cutoff)] = tally_extra.get((destNum, cutoff), 0) + 1
+      for i in A_selection[members]:
+        for destNum in tally:
+          rows.append((A_id[i],destNum,cutoffs[destNum],tally[destNum]))
+          if len(rows) == sqlChunkify:
+            write_rows(sqlTableName, resultColumns, rows)
+            rows = list()
+        for destNum, cutoff in tally_extra:
+          rows_multi.append((A_id[i],destNum,cutoff,tally_extra[(destNum, cutoff)]))
+          if len(rows_multi) == sqlChunkify:
+            write_rows(multiTableName, resultColumns, rows_multi)
+            rows_multi = list()
+
+    write_rows(sqlTableName, resultColumns, rows)
+    write_rows(multiTableName, resultColumns, rows_multi)
+    for destNum in remaining_dest:
+      logSolved(hex,part,parts,A_pointCount,destNum,(time.time()-hexStartTime)/60)
+    print('Hex:{:5d} Part:{:3d}/{:<3d} A:{:8d} {:15s}'.format(hex, part + 1, parts, A_pointCount, time.strftime("%Y%m%d-%H%M%S")))
+    return 0
+
+  except:
+    conn.rollback()
+    print("ERROR: hex {} (part {}/{}): {}".format(hex, part + 1, parts, sys.exc_info()))
+    return(multiprocessing.current_process().pid)
+
+nWorkers = pool_size(parser.get('parallel', 'workers'))
+
+# result writer processes, and the number of rows or seconds after which these commit (see result_writer.py)
+write_policy = dict(writers = parser.get('parallel', 'writers'),
+                    batch_rows = parser.get('parallel', 'write_batch_rows'),
+                    batch_secs = parser.get('parallel', 'write_batch_secs'))
+
+# timeout (mins) and retries (with backoff, in seconds) for failed tasks (see task_runner.py)
+task_guard = dict(timeout = parser.get('parallel', 'task_timeout'),
+                  retries = parser.get('parallel', 'task_retries'),
+                  backoff = parser.get('parallel', 'retry_backoff'))
+cost_radius = float(parser.get('parallel', 'cost_radius'))
+split_parcels = int(parser.get('parallel', 'split_parcels'))
+
+# Worker state: the network graph, parcel and destination locations on it (see network_service.load_network),
+# and the index of destinations to be counted, set as globals which are inherited by the worker
+# processes when these are forked
+def stage_state(network):
+  global graph, A_id, A_hex, A_edge, A_offset, B_edge, B_count, dest_targets, located_dest
+  graph = network['graph']
+  A_id, A_hex, A_edge, A_offset = network['parcel']
+  B_id, B_hex, B_edge, B_offset = network['destination']
+  # destinations are re-coded by their index in the count destination list
+  B_label = [tuple(int(x) for x in id.split(',')) for id in B_id]
+  B_count = np.array([all_destination_list[label[0]] in destination_list for label in B_label], dtype = bool)
+  dest_targets = index_targets(graph, B_edge[B_count], B_offset[B_count],
+                               [(destination_list.index(all_destination_list[label[0]]), label[1]) for label, count in zip(B_label, B_count) if count])
+  located_dest = set([destination_list.index(all_destination_list[label[0]]) for label, count in zip(B_label, B_count) if count])
+  print("{} destinations to be counted.".format(sum(B_count)))
+
+# Run the stage, using a pool of workers writing results via the given writer processes
+# (run by the main process below, or by the network service; see network_service.py)
+def run_stage(pool, queues, writers):
+  global conn, curs
+  try:
+    conn = psycopg2.connect(**connect)
+    curs = conn.cursor()
+
+    # create output tables
+    curs.execute(createTable)
+    if len(extra_cutoffs) > 0:
+      curs.execute(createTable_multi)
+    conn.commit()
+
+  except:
+    print("SQL connection error")
+    print(sys.exc_info()[0])
+    raise
+
+  # initiate log file
+  writeLog(create='create')
+
+  # Task name is now defined
+  task = 'Count B points within network buffer distance of A points (CSR network graph)'
+  print("Commencing task ({}): {} at {}".format(sqlDBName,task,time.strftime("%Y%m%d-%H%M%S")))
+
+  # Divide work by hexes, largest first (cost weighted by local destination density)
+  # (hexes already processed for every destination type, as per the stage log, are not queued again)
+  hex_done = completed_hexes(curs, log_table, located_dest)
+  hex_list = [x for x in np.unique(A_hex) if x not in hex_done]
+  hex_costs, in_minutes = plan_hexes(curs, hex_list, log_table,
+                                     points = (A_hex, graph.node_x[graph.edge_u[A_edge]], graph.node_y[graph.edge_u[A_edge]]),
+                                     destinations = (graph.node_x[graph.edge_u[B_edge[B_count]]], graph.node_y[graph.edge_u[B_edge[B_count]]]),
+                                     radius = cost_radius,
+                                     split = split_parcels)
+  hex_costs = exclude_quarantined(curs, script, hex_costs)
+  if dispatch == 'queue':
+    enqueue(curs, log_table, hex_costs)
+    run_queue(pool, guarded(CountInBufferWorkerFunction, **task_guard), log_table, connect, nWorkers, quarantine_stage = script)
+  else:
+    results = run_largest_first(pool, guarded(CountInBufferWorkerFunction, **task_guard), hex_costs, nWorkers, in_minutes, label = 'hex tasks')
+    stage_summary(curs, script, results)
+  failed_writes = sync_writers(queues, writers)
+
+  # tasks whose results failed to be written are reported (as an error), rather than logging the stage as complete
+  check_writes(failed_writes)
+
+  # output to completion log
+  script_running_log(script, task, start)
+  conn.close()
+
+# MAIN PROCESS
+if __name__ == '__main__':
+  # run by the network service, if running (see network_service.py), or otherwise here
+  if submit_stage(script) is None:
+    # Build network graph and read A and B point locations on network
+    # (these are inherited by the worker processes when these are forked)
+    stage_state(load_network(connect, graph_cache, urbanGdb, network_edges))
+
+    # Setup writer processes, and a pool of workers/child processes writing results via these
+    queues, writers = start_writers(connect, **write_policy)
+    pool = multiprocessing.Pool(nWorkers, initializer = worker_init, initargs = (queues,))
+    try:
+      run_stage(pool, queues, writers)
+    finally:
+      pool.close()
+      stop_writers(queues, writers)
@@ -16,6 +16,7 @@ import time
 import numpy as np
 import sys
 import psycopg2
+from bulk_loader import load_table
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
 parser = SafeConfigParser()
@@ -60,8 +61,6 @@ output = POSentry+'_POSentryIDonly'
 
 # SQL Settings - storing passwords in plain text is obviously not ideal
 sqlTableName = "pos_attribute"
-queryPartA = "INSERT INTO {} VALUES ".format(sqlTableName)
-sqlChunkify = 50
 
 # initiate postgresql connection
 conn = psycopg2.connect(database=parser.get('postgresql', 'database'), 
@@ -115,25 +114,17 @@ conn.commit()
 curs.execute(createTable)
 conn.commit()
 
-with arcpy.da.UpdateCursor(POSentry, [polyID,pointID,linkID,category,area]) as cursor:
-  count = 0
-  chunkedLines = list()  
-  for row in cursor:
-    count += 1
-    # update feature  
-    row[2] = '{},{}'.format(row[0],str(row[1]))
-    cursor.updateRow(row)
-    
-    # accumulate attribute data for SQL table
-    chunkedLines.append("('{}','{}',{})".format(row[0],row[3],row[4]) ) 
-    if (count % sqlChunkify == 0) :
-      curs.execute(queryPartA + ','.join(rowOfChunk for rowOfChunk in chunkedLines)+' ON CONFLICT DO NOTHING')
-      conn.commit()
-      chunkedLines = list() 
-      
-  if(count % sqlChunkify != 0):
-    curs.execute(queryPartA + ','.join(rowOfChunk for rowOfChunk in chunkedLines)+' ON CONFLICT DO NOTHING')
-    conn.commit()    
+def pos_rows():
+  ''' Update the link ID of each POS entry point, generating its attribute data for the SQL table.'''
+  with arcpy.da.UpdateCursor(POSentry, [polyID,pointID,linkID,category,area]) as cursor:
+    for row in cursor:
+      # update feature  
+      row[2] = '{},{}'.format(row[0],str(row[1]))
+      cursor.updateRow(row)
+      yield (row[0],row[3],row[4])
+
+# stream attribute data to the SQL table (once per polygon; see bulk_loader.py)
+load_table(conn, sqlTableName, ['veac_id','os_group','area_ha'], pos_rows(), ignore_conflicts = True)
 
 renameSkinny(is_geo = True,in_obj = POSentry,out_obj = 'featureTrimmed',keep_fields_list=linkID,rename_fields_list=linkID)             
              
@@ -10,7 +10,13 @@ import multiprocessing
 import sys
 import psycopg2 
 import numpy as np
-from progressor import progressor
+from progress_tracker import start_progress, stop_progress, progress_init, report_progress
+from hex_scheduler import pool_size, plan_hexes, run_largest_first
+from task_runner import guarded, exclude_quarantined, stage_summary
+from worker_startup import start_pool, startup_summary
+from result_writer import start_writers, stop_writers, check_writes, writer_init, writing, write_rows, write_sql
+from parcel_shards import build_shards, load_shards, hex_rows, shard_layer
+from hex_destinations import build_candidates, load_candidates, hex_candidates, candidate_clause, certified_lines, line_origins, rows_extent, ring_oids, retry_radius
 
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
@@ -36,15 +42,22 @@ arcpy.env.overwriteOutput = True
 A_points = os.path.join(urbanGDB,parser.get('parcels', 'parcel_dwellings'))
 A_pointsID = parser.get('parcels', 'parcel_id')
 
+# parcel ids and coordinates by hex (see parcel_shards.py)
+shard_cache = os.path.join(folderPath,parser.get('network', 'parcel_shards'))
+
+# candidate POS entry points by hex (see hex_destinations.py)
+candidate_cache = os.path.join(folderPath,parser.get('network', 'destination_candidates'))
+candidate_rule = dict(cell   = float(parser.get('network', 'candidate_cell')),
+                      radius = float(parser.get('network', 'candidate_radius')),
+                      count  = int(parser.get('network', 'candidate_count')))
+
 
 ## specify "destinations"
 B_points =  parser.get('pos', 'pos_entry')
 B_pointsID = parser.get('pos', 'pos_entry_id')
+B_pointsQuery = ''
 
 
-# make POS feature layer
-arcpy.MakeFeatureLayer_management (B_points, "B_pointsLayer")  
-
 ## Network settings
 in_network_dataset = parser.get('roads', 'pedestrian_road_network')
 
@@ -62,7 +75,6 @@ cutoff =  parser.get('network', 'limit')
 
 ## Hex details (polygon feature to iterate over)
 polygons = parser.get('workspace', 'hex_grid')
-polyBuffer =  parser.get('workspace', 'hex_grid_buffer')
 
 hexStart = 0
 
@@ -77,19 +89,25 @@ sqlPWD      = parser.get('postgresql', 'password')
 
 sqlTableName  = "dist_cl_od_parcel_pos_all"
 log_table    = "log_dist_cl_od_parcel_dest"
-queryPartA = "INSERT INTO {} VALUES ".format(sqlTableName)
 
-sqlChunkify = 500
-
-        
-# initiate postgresql connection
-conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
-curs = conn.cursor()
-
-# get pid name
-pid = multiprocessing.current_process().name
-# create initial OD cost matrix layer on worker processors
-if pid !='MainProcess':
+# rows per batch queued to the result writer
+sqlChunkify = 5000
+
+
+# Worker/Child setup (pool initializer; see worker_startup.py)
+#   -- workers create their OD cost matrix and feature layers once, rather than on import, and
+#      write results and logs via the result writer processes; the parcel count and hex list are
+#      only required by the main process
+def worker_setup(settings):
+  global outNALayer, originsLayerName, destinationsLayerName, linesLayerName, ODLinesSubLayer, fields
+  global shards, A_spatialReference, candidates, B_oidField
+  progress_init(settings['progress'])
+  shards = load_shards(settings['shard_dir'])
+  candidates = load_candidates(settings['candidate_dir'])
+  B_oidField = arcpy.Describe(B_points).OIDFieldName
+  A_spatialReference = arcpy.Describe(A_points).spatialReference
+  writer_init(settings['queues'])
+  
   # Make OD cost matrix layer
   result_object = arcpy.MakeODCostMatrixLayer_na(in_network_dataset = in_network_dataset, 
                                                  out_network_analysis_layer = "ODmatrix", 
@@ -111,12 +129,8 @@ if pid !='MainProcess':
   ODLinesSubLayer = arcpy.mapping.ListLayers(outNALayer, linesLayerName)[0]
   fields = ['Name', 'Total_Length']
   
-  # store list of destinations with counts (so as to overlook destinations for which zero data exists!)
-  curs.execute("SELECT dest_name,dest_count FROM dest_type")
-  count_list = list(curs)
-  
-  arcpy.MakeFeatureLayer_management(B_points, "B_pointsLayer")    
-  arcpy.MakeFeatureLayer_management(polyBuffer, "buffer_layer")                
+  # make POS feature layer
+  arcpy.MakeFeatureLayer_management(B_points, "B_pointsLayer", B_pointsQuery)    
   
   
 # Define query to create table
@@ -127,10 +141,9 @@ createTable     = '''
    distance integer NOT NULL
    );
    '''.format(sqlTableName, A_pointsID.lower())
-   
-queryPartA      = '''
-  INSERT INTO {} VALUES
-  '''.format(sqlTableName)
+
+# columns of OD matrix table, as written by the result writer
+resultColumns = (A_pointsID.lower(), 'veac_id', 'distance')
 
 # this is the same log table as used for other destinations.
 #  It is only created if it does not already exist.
@@ -155,7 +168,6 @@ queryUpdate      = '''
   DO UPDATE SET {1}=EXCLUDED.{1},{2}=EXCLUDED.{2},{3}=EXCLUDED.{3}
   '''.format('hex','parcel_count','status','mins','dest')  
 
-parcel_count = int(arcpy.GetCount_management(A_points).getOutput(0))  
       
 ## Functions defined for this script
 # Define log file write method
@@ -168,9 +180,13 @@ def writeLog(hex = 0, AhexN = 'NULL', Bcode = 'NULL', status = 'NULL', mins= 0,
     else:
       moment = time.strftime("%Y%m%d-%H%M%S")
   
-      # write to sql table
-      curs.execute("{0} ({1},{2},'{3}','{4}',{5}) {6}".format(queryInsert,hex, AhexN, Bcode,status, mins, queryUpdate))
-      conn.commit()  
+      # write to sql table (via the result writer, from worker processes)
+      statement = "{0} ({1},{2},'{3}','{4}',{5}) {6}".format(queryInsert,hex, AhexN, Bcode,status, mins, queryUpdate)
+      if writing():
+        write_sql(statement)
+      else:
+        curs.execute(statement)
+        conn.commit()
   except:
     print("ERROR: {}".format(sys.exc_info()))
     raise
@@ -180,16 +196,38 @@ def unique_values(table, field):
   data = arcpy.da.TableToNumPyArray(table, [field])
   return np.unique(data[field])    
     
+def solveOD(A_layer, B_layer):
+  ''' Add origins and destinations to the OD cost matrix layer and solve, returning a list of
+      OD lines (name, length), or None if no solution was found.'''
+  arcpy.AddLocations_na(in_network_analysis_layer = outNALayer, 
+      sub_layer                      = originsLayerName, 
+      in_table                       = A_layer, 
+      field_mappings                 = "Name {} #".format(A_pointsID), 
+      search_tolerance               = "{} Meters".format(searchTolerance), 
+      search_criteria                = "{} SHAPE;{} NONE".format(locateShape,noLocateJunctions), 
+      append                         = "CLEAR", 
+      snap_to_position_along_network = "NO_SNAP", 
+      exclude_restricted_elements    = "INCLUDE",
+      search_query                   = "{} #;{} #".format(locateShape,noLocateJunctions))
+
+  arcpy.AddLocations_na(in_network_analysis_layer = outNALayer, 
+    sub_layer                      = destinationsLayerName, 
+    in_table                       = B_layer, 
+    field_mappings                 = "Name {} #".format(B_pointsID), 
+    search_tolerance               = "{} Meters".format(searchTolerance), 
+    search_criteria                = "{} SHAPE;{} NONE".format(locateShape,noLocateJunctions), 
+    append                         = "CLEAR", 
+    snap_to_position_along_network = "NO_SNAP", 
+    exclude_restricted_elements    = "INCLUDE",
+    search_query                   = "{} #;{} #".format(locateShape,noLocateJunctions))    
+  # Process: Solve
+  result = arcpy.Solve_na(outNALayer, terminate_on_solve_error = "CONTINUE")
+  if result[1] == u'false':
+    return None
+  return [tuple(line) for line in arcpy.da.SearchCursor(ODLinesSubLayer, fields)]
+
 # Worker/Child PROCESS
 def ODMatrixWorkerFunction(hex): 
-  # Connect to SQL database 
-  try:
-    conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
-    curs = conn.cursor()
-  except:
-    print("SQL connection error")
-    print(sys.exc_info()[1])
-    return 100
   # make sure Network Analyst licence is 'checked out'
   arcpy.CheckOutExtension('Network')
  
@@ -200,10 +238,9 @@ def ODMatrixWorkerFunction(hex):
     return(1)
     
   try:
-    arcpy.MakeFeatureLayer_management (A_points, "A_pointsLayer")
-  
-    A_selection = arcpy.SelectLayerByAttribute_management("A_pointsLayer", where_clause = '"HEX_ID" = {}'.format(hex))   
-    A_pointCount = int(arcpy.GetCount_management(A_selection).getOutput(0))
+    # the hex's parcels are read from the parcel shards (see parcel_shards.py)
+    A_rows = hex_rows(shards, hex)
+    A_pointCount = len(A_rows)
     
 	  # Skip empty hexes
     if A_pointCount == 0:
@@ -211,87 +248,85 @@ def ODMatrixWorkerFunction(hex):
 	  return(2)
 	
 
-    buffer = arcpy.SelectLayerByAttribute_management("buffer_layer", where_clause = '"ORIG_FID" = {}'.format(hex))
-    B_selection = arcpy.SelectLayerByLocation_management('B_pointsLayer', 'intersect', buffer)
-    B_pointCount = int(arcpy.GetCount_management(B_selection).getOutput(0))
+    A_selection = shard_layer(shards, A_rows, "A_selection", A_pointsID, A_spatialReference)
+    # only the hex's candidate POS entry points are added (see hex_destinations.py)
+    B_oids, B_radius = hex_candidates(candidates, hex)
+    B_pointCount = len(B_oids)
     
 	  # Skip empty hexes
     if B_pointCount == 0:
 	  writeLog(hex,A_pointCount,dest_code,"no B points",(time.time()-hexStartTime)/60)
 	  return(3)
       
-	# If we're still in the loop at this point, it means we have the right hex and buffer combo and both contain at least one valid element
-	# Process OD Matrix Setup
-    arcpy.AddLocations_na(in_network_analysis_layer = outNALayer, 
-        sub_layer                      = originsLayerName, 
-        in_table                       = A_selection, 
-        field_mappings                 = "Name {} #".format(A_pointsID), 
-        search_tolerance               = "{} Meters".format(searchTolerance), 
-        search_criteria                = "{} SHAPE;{} NONE".format(locateShape,noLocateJunctions), 
-        append                         = "CLEAR", 
-        snap_to_position_along_network = "NO_SNAP", 
-        exclude_restricted_elements    = "INCLUDE",
-        search_query                   = "{} #;{} #".format(locateShape,noLocateJunctions))
-
-    arcpy.AddLocations_na(in_network_analysis_layer = outNALayer, 
-      sub_layer                      = destinationsLayerName, 
-      in_table                       = B_selection, 
-      field_mappings                 = "Name {} #".format(B_pointsID), 
-      search_tolerance               = "{} Meters".format(searchTolerance), 
-      search_criteria                = "{} SHAPE;{} NONE".format(locateShape,noLocateJunctions), 
-      append                         = "CLEAR", 
-      snap_to_position_along_network = "NO_SNAP", 
-      exclude_restricted_elements    = "INCLUDE",
-      search_query                   = "{} #;{} #".format(locateShape,noLocateJunctions))    
-    # Process: Solve
-    result = arcpy.Solve_na(outNALayer, terminate_on_solve_error = "CONTINUE")
-    if result[1] == u'false':
+    if np.isinf(B_radius):
+      B_selection = arcpy.SelectLayerByAttribute_management('B_pointsLayer', 'CLEAR_SELECTION')
+    else:
+      B_selection = arcpy.SelectLayerByAttribute_management('B_pointsLayer', 'NEW_SELECTION', candidate_clause(B_oidField, B_oids))
+    lines = solveOD(A_selection, B_selection)
+    outputLines = certified_lines(lines or [], B_radius, searchTolerance)
+    
+    # parcels whose closest candidate may not be the closest POS are solved again against the POS
+    # within a wider ring, bounded by the closest found (see hex_destinations.py), until certified
+    A_retry = A_rows[~np.isin(shards.id[A_rows], list(line_origins(outputLines)))]
+    while len(A_retry) > 0 and not np.isinf(B_radius):
+      B_oids, B_radius = ring_oids(candidates, rows_extent(shards, A_retry),
+                                   retry_radius(lines or [], shards.id[A_retry], B_radius, searchTolerance))
+      if np.isinf(B_radius):
+        B_selection = arcpy.SelectLayerByAttribute_management('B_pointsLayer', 'CLEAR_SELECTION')
+      else:
+        B_selection = arcpy.SelectLayerByAttribute_management('B_pointsLayer', 'NEW_SELECTION', candidate_clause(B_oidField, B_oids))
+      lines = solveOD(shard_layer(shards, A_retry, "A_retry", A_pointsID, A_spatialReference), B_selection)
+      retryLines = certified_lines(lines or [], B_radius, searchTolerance)
+      outputLines += retryLines
+      A_retry = A_retry[~np.isin(shards.id[A_retry], list(line_origins(retryLines)))]
+    if lines is None and len(outputLines) == 0:
       writeLog(hex,A_pointCount,dest_code,"no solution",(time.time()-hexStartTime)/60)
       return(4)
 
-    # Extract lines layer, export to SQL database
-    outputLines = arcpy.da.SearchCursor(ODLinesSubLayer, fields)
-    curs = conn.cursor()
-    count = 0
-    chunkedLines = list()
+    # Extract lines layer, queue to the result writer (logging the hex as solved once written)
+    rows = list()
     
     for outputLine in outputLines :
-      count += 1
       place = "before id"
       ID_A = outputLine[0].split('-')[0].encode('utf-8').strip(' ')
       ID_B = outputLine[0].split('-')[1].split(',')[0].strip(' ').encode('utf-8')
       place = "after ID"
-      chunkedLines.append("('{}','{}',{})".format(ID_A,ID_B,int(round(outputLine[1]))))
-      if(count % sqlChunkify == 0):
-        curs.execute(queryPartA + ','.join(rowOfChunk for rowOfChunk in chunkedLines)+' ON CONFLICT DO NOTHING')
-        conn.commit()
-        chunkedLines = list()
+      rows.append((ID_A,ID_B,int(round(outputLine[1]))))
+      if len(rows) == sqlChunkify:
+        write_rows(sqlTableName, resultColumns, rows)
+        rows = list()
         
-    if(count % sqlChunkify != 0):
-      curs.execute(queryPartA + ','.join(rowOfChunk for rowOfChunk in chunkedLines)+' ON CONFLICT DO NOTHING')
-      conn.commit()
+    write_rows(sqlTableName, resultColumns, rows)
     writeLog(hex,A_pointCount,B_pointCount,"Solved",(time.time()-hexStartTime)/60)
     
-    curs.execute("SELECT COUNT(*) FROM {}".format(sqlTableName))
-    numerator = list(curs)
-    numerator = int(numerator[0][0])
-    progressor(numerator,parcel_count,start,"{}/{}; last hex processed: {}, at {}".format(numerator,parcel_count,hex,time.strftime("%Y%m%d-%H%M%S"))) 
+    report_progress(A_pointCount, hex)
     return 0
     
   except:
     print('''Error: {}
-             String: {}
+             Rows: {}
              Line example: {}
-      '''.format( sys.exc_info(),chunkedLines,outputLine))   
+      '''.format( sys.exc_info(),rows,outputLine))   
     writeLog(hex, multiprocessing.current_process().pid, "ERROR", (time.time()-hexStartTime)/60)
     return(multiprocessing.current_process().pid)
   finally:
     arcpy.CheckInExtension('Network')
-    conn.close()
 
 
-nWorkers = 4  
-hex_list = unique_values(A_points, 'HEX_ID')
+nWorkers = pool_size(parser.get('parallel', 'workers'))
+
+# result writer processes, and the number of rows or seconds after which these commit (see result_writer.py)
+connect = dict(database=sqlDBName, user=sqlUserName, password=sqlPWD)
+write_policy = dict(writers = parser.get('parallel', 'writers'),
+                    batch_rows = parser.get('parallel', 'write_batch_rows'),
+                    batch_secs = parser.get('parallel', 'write_batch_secs'))
+
+# timeout (mins) and retries (with backoff, in seconds) for failed tasks (see task_runner.py)
+task_guard = dict(timeout = parser.get('parallel', 'task_timeout'),
+                  retries = parser.get('parallel', 'task_retries'),
+                  backoff = parser.get('parallel', 'retry_backoff'),
+                  success = (None, 0, 1, 2, 3, 4))
+progress_interval = parser.get('parallel', 'progress_interval')
 
 # MAIN PROCESS
 if __name__ == '__main__':
@@ -311,17 +346,36 @@ if __name__ == '__main__':
   # initiate log file
   writeLog(create='create')  
   
-  # Setup a pool of workers/child processes and split log output
-  pool = multiprocessing.Pool(nWorkers)
+  # Setup writer processes, and a pool of workers/child processes writing results via these
+  # (progress is tallied from parcels of solved hexes, as reported by workers; see worker_startup.py for worker setup)
+  shard_dir = build_shards(shard_cache, urbanGDB, parser.get('parcels', 'parcel_dwellings'), A_pointsID)
+  shards = load_shards(shard_dir)
+  # index candidate POS entry points by hex, once
+  candidate_dir = build_candidates(candidate_cache, shard_dir, urbanGDB, B_points, B_pointsQuery, **candidate_rule)
+  parcel_count = len(shards.id)
+  hex_list = shards.hex
+  tracker = start_progress(parcel_count, 0, 'parcels processed', progress_interval)
+  queues, writers = start_writers(connect, **write_policy)
+  pool, startups = start_pool(nWorkers, worker_setup, dict(progress = tracker[1], shard_dir = shard_dir, candidate_dir = candidate_dir, queues = queues))
     
   # Task name is now defined
   task = 'Create OD cost matrix for parcel points to closest POS (any size)'  # Do stuff
   print("Commencing task ({}): {} at {}".format(sqlDBName,task,time.strftime("%Y%m%d-%H%M%S")))
 
-  # Divide work by hexes
+  # Divide work by hexes, largest first (see hex_scheduler.py)
+  # (the log table is shared with script 17, so its historical processing times are not used)
   # Note: if a restricted list of hexes are wished to be processed, just supply a subset of hex_list including only the relevant hex id numbers.
-  hexCursor = hex_list
-  pool.map(ODMatrixWorkerFunction, hexCursor, chunksize=1)
+  hex_costs, in_minutes = plan_hexes(curs, hex_list)
+  hex_costs = exclude_quarantined(curs, script, hex_costs)
+  results = run_largest_first(pool, guarded(ODMatrixWorkerFunction, **task_guard), hex_costs, nWorkers, in_minutes, progress = False)
+  stop_progress(*tracker, label = 'parcels processed')
+  stage_summary(curs, script, results)
+  startup_summary(startups)
+  pool.close()
+  failed_writes = stop_writers(queues, writers)
+  
+  # tasks whose results failed to be written are reported (as an error), rather than logging the stage as complete
+  check_writes(failed_writes)
   
   # output to completion log    
   script_running_log(script, task, start)
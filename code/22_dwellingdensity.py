@@ -18,7 +18,8 @@ import os
 import sys
 import time
 import psycopg2
-from progressor import progressor
+from parallel_sql import hex_chunks, run_chunks, check_chunks
+from resume import pending_rows
 
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
@@ -39,6 +40,8 @@ sqlPWD      = parser.get('postgresql', 'password')
 dd_table = 'dwelling_density'
 #  Size of tuple chunk sent to postgresql 
 sqlChunkify = 500
+# number of chunks run concurrently (see parallel_sql.py)
+sqlConnections = int(parser.get('parallel', 'sql_connections'))
 
 
 # specify the unique location identifier 
@@ -60,7 +63,8 @@ createTable_dd = '''
   '''.format(dd_table,pointsID.lower())
   
   
-query_A = '''
+# statement run for each chunk of parcels, given as an array of parcel ids ($1)
+query_dd = '''
 INSERT INTO {0} ({1},dwellings,area_ha,dd_nh1600m)
 (SELECT {2}.{1},  
           coalesce(sum({3}.dwellings),0) AS dwellings,
@@ -69,12 +73,9 @@ INSERT INTO {0} ({1},dwellings,area_ha,dd_nh1600m)
 FROM {2}  
 LEFT JOIN {3}
 ON ST_intersects({2}.geom, {3}.geom)
-WHERE {1} IN
+WHERE {2}.{1} = ANY($1)
+GROUP BY {2}.{1}) ON CONFLICT DO NOTHING
 '''.format(dd_table,pointsID.lower(),buffer_table,meshblock_table)
-  
-query_C = '''
-  GROUP BY {}) ON CONFLICT DO NOTHING;
-  '''.format(pointsID.lower())
 
 
 def unique_values(table, field):
@@ -107,40 +108,22 @@ try:
   print("{:4.2f} mins.".format((time.time() - start)/60))	
    
    
-  print("fetch list of processed parcels, if any..."), 
-  # (for string match to work, had to select first item of returned tuple)
-  curs.execute("SELECT {} FROM {}".format(pointsID.lower(),buffer_table))
-  raw_point_id_list = list(curs)
-  raw_point_id_list = [x[0] for x in raw_point_id_list]
-  
-  curs.execute("SELECT {} FROM {}".format(pointsID.lower(),dd_table))
-  completed_points = list(curs)
-  completed_points = [x[0] for x in completed_points]
-  
-  point_id_list = [x for x in raw_point_id_list if x not in completed_points]  
+  print("fetch list of parcels not yet processed..."), 
+  # (parcels with a sausage buffer, but not a dwelling density record; see resume.py)
+  point_id_list = pending_rows(conn, buffer_table, pointsID.lower(), dd_table, [pointsID.lower(), 'hex'])
+  chunks = hex_chunks(point_id_list, sqlChunkify)
   print("Done.")
   
-  denom = len(point_id_list)
-  count = 0
-  chunkedPoints = list()
-  
+  # chunks of parcels (by hex) are processed concurrently (see parallel_sql.py)
   print("Processing points...")
-  for point in point_id_list:
-    count += 1
-    chunkedPoints.append(point) 
-    if (count % sqlChunkify == 0) :
-        curs.execute('{} ({}) {}'.format(query_A,','.join("'"+x+"'" for x in chunkedPoints),query_C))
-        conn.commit()
-        chunkedPoints = list()
-        progressor(count,denom,start,"{}/{} points processed".format(count,denom))
-  if(count % sqlChunkify != 0):
-     curs.execute('{} ({}) {}'.format(query_A,','.join("'"+x+"'" for x in chunkedPoints),query_C))
-     conn.commit()
-  
-  progressor(count,denom,start,"{}/{} points processed".format(count,denom))
+  # chunks failing are reported (as an error), rather than logging the stage as complete
+  check_chunks(run_chunks(dict(database=sqlDBName, user=sqlUserName, password=sqlPWD), query_dd,
+                          chunks, sqlConnections))
   
 except:
        print('''HEY, IT'S AN ERROR: {}'''.format(sys.exc_info()))
+       # the stage is not logged as complete
+       raise
        
 # output to completion log    
 script_running_log(script, task, start)
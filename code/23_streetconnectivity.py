@@ -9,7 +9,9 @@ import sys
 import time
 import psycopg2
 import numpy as np
-from progressor import progressor
+from bulk_loader import cursor_rows, load_table
+from parallel_sql import hex_chunks, run_chunks, check_chunks
+from resume import pending_rows
 
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
@@ -72,6 +74,8 @@ street_connectivity_table = "street_connectivity"
 
 #  Size of tuple chunk sent to postgresql 
 sqlChunkify = 1000
+# number of chunks run concurrently (see parallel_sql.py)
+sqlConnections = int(parser.get('parallel', 'sql_connections'))
 
 # Define query to create table
 createTable_intersections     = '''
@@ -80,10 +84,6 @@ createTable_intersections     = '''
    geom geometry NOT NULL); 
   '''.format(intersections_table)
 
-queryPartA_intersections = '''
-  INSERT INTO {} VALUES 
-  '''.format(intersections_table)
-
 createTable_sc = '''
   CREATE TABLE IF NOT EXISTS {0}
   ({1} varchar PRIMARY KEY,
@@ -93,7 +93,8 @@ createTable_sc = '''
   ); 
   '''.format(street_connectivity_table,pointsID.lower())
 
-sc_query_A = '''
+# statement run for each chunk of parcels, given as an array of parcel ids ($1)
+sc_query = '''
 INSERT INTO {0} ({1},intersection_count,area_sqkm,sc_nh1600m)
 (SELECT {1}, COALESCE(COUNT({2}),0) AS intersection_count,area_sqkm, COALESCE(COUNT({2}),0)/area_sqkm AS sc_nh1600mm
 FROM {2} 
@@ -101,13 +102,10 @@ LEFT JOIN
 (SELECT {3}.{1},area_sqkm,geom FROM nh1600m LEFT JOIN {3} ON nh1600m.{1} = {3}.{1}) 
 AS sp_temp
 ON ST_Intersects(sp_temp.geom, {2}.geom)
-WHERE {1} IN 
+WHERE {1} = ANY($1)
+GROUP BY {1},area_sqkm) ON CONFLICT DO NOTHING
 '''.format(street_connectivity_table,pointsID.lower(),intersections_table,sausage_buffer_table)
 
-sc_query_C = '''
-  GROUP BY {},area_sqkm) ON CONFLICT DO NOTHING;
-  '''.format(pointsID.lower())
-
   
 
 
@@ -136,25 +134,10 @@ except:
   print(sys.exc_info()[1])
   raise
 
-# export intersections to PostGIS feature
-intersections_to_postgis = time.time()
-count = 0
-chunkedLines = list()
-progressor(count,intersection_count,intersections_to_postgis,"Exporting intersections: {}".format(count))
-with arcpy.da.SearchCursor("intersections", ["OBJECTID", "SHAPE@WKT"]) as cursor:
-  for row in cursor:
-      count += 1
-      wkt = row[1].encode('utf-8').replace(' NAN','').replace(' M ','')
-      chunkedLines.append("({0},ST_GeometryFromText('{1}', {2}))".format(row[0],wkt,srid)) 
-      if (count % sqlChunkify == 0) :
-        curs.execute(queryPartA_intersections + ','.join(rowOfChunk for rowOfChunk in chunkedLines)+' ON CONFLICT DO NOTHING')
-        conn.commit()
-        chunkedLines = list()
-        progressor(count,intersection_count,intersections_to_postgis,"Exporting intersections: {}".format(count))
-  if(count % sqlChunkify != 0):
-     curs.execute(queryPartA_intersections + ','.join(rowOfChunk for rowOfChunk in chunkedLines)+' ON CONFLICT DO NOTHING')
-     conn.commit()          
-progressor(count,intersection_count,intersections_to_postgis,"Exporting intersections: {}".format(count))
+# export intersections to PostGIS feature (streamed with COPY, as EWKB; see bulk_loader.py)
+load_table(conn, intersections_table, ['objectid', 'geom'],
+           cursor_rows("intersections", ["OBJECTID", "SHAPE@WKB"], srid),
+           total = intersection_count, ignore_conflicts = True)
 
 # Create sausage buffer spatial index
 print("Creating intersections spatial index... "),
@@ -178,37 +161,17 @@ conn.commit()
 print("{:4.2f} mins.".format((time.time() - start)/60))	
 
   
-print("fetch list of processed parcels, if any..."), 
-# (for string match to work, had to select first item of returned tuple)
-curs.execute("SELECT {} FROM {}".format(pointsID.lower(),sausage_buffer_table))
-raw_point_id_list = list(curs)
-raw_point_id_list = [x[0] for x in raw_point_id_list]
-
-curs.execute("SELECT {} FROM {}".format(pointsID.lower(),street_connectivity_table))
-completed_points = list(curs)
-completed_points = [x[0] for x in completed_points]
-
-point_id_list = [x for x in raw_point_id_list if x not in completed_points]  
+print("fetch list of parcels not yet processed..."), 
+# (parcels with a sausage buffer, but not a street connectivity record; see resume.py)
+point_id_list = pending_rows(conn, sausage_buffer_table, pointsID.lower(), street_connectivity_table, [pointsID.lower(), 'hex'])
+chunks = hex_chunks(point_id_list, sqlChunkify)
 print("Done.")
 
-denom = len(point_id_list)
-count = 0
-chunkedPoints = list()
-
+# chunks of parcels (by hex) are processed concurrently (see parallel_sql.py)
 print("Processing points...")
-for point in point_id_list:
-  count += 1
-  chunkedPoints.append(point) 
-  if (count % sqlChunkify == 0) :
-      curs.execute('{} ({}) {}'.format(sc_query_A,','.join("'"+x+"'" for x in chunkedPoints),sc_query_C))
-      conn.commit()
-      chunkedPoints = list()
-      progressor(count,denom,start,"{}/{} points processed".format(count,denom))
-if(count % sqlChunkify != 0):
-   curs.execute('{} ({}) {}'.format(sc_query_A,','.join("'"+x+"'" for x in chunkedPoints),sc_query_C))
-   conn.commit()
-
-progressor(count,denom,start,"{}/{} points processed".format(count,denom))
+# chunks failing are reported (as an error), rather than logging the stage as complete
+check_chunks(run_chunks(dict(database=sqlDBName, user=sqlUserName, password=sqlPWD), sc_query,
+                        chunks, sqlConnections))
 
 # output to completion log    
 script_running_log(script, task, start)
@@ -20,6 +20,7 @@ import os
 import time
 import psycopg2 
 from progressor import progressor
+from bulk_loader import cursor_rows, load_table
 import math
 
 from script_running_log import script_running_log
@@ -53,9 +54,6 @@ sqlPWD      = parser.get('postgresql', 'password')
 roadPoints_table = "roadsAsPoints"
 roadLengths_table = "road_length"
 
-#  Size of tuple chunk sent to postgresql 
-sqlChunkify = 500
-
 createTable_roadPoints = '''
   DROP TABLE IF EXISTS {0};
   CREATE TABLE {0}
@@ -64,10 +62,6 @@ createTable_roadPoints = '''
    value double precision NOT NULL,
    geom geometry NOT NULL); 
   '''.format(roadPoints_table)
-
-queryInsert      = '''
-  INSERT INTO {} VALUES
-  '''.format(roadPoints_table)
   
 # Maximum distance of a road segment
 MaxDistance = 10.0
@@ -115,27 +109,11 @@ try:
   conn.commit()
   print("{:4.2f} mins.".format((time.time() - start)/60))	
   
-  # export intersections to PostGIS feature
-  roadpoints_to_postgis = time.time()
-  count = 0
-  chunkedLines = list()
+  # export road points to PostGIS feature (streamed with COPY, as EWKB; see bulk_loader.py)
   road_point_count = int(arcpy.GetCount_management(mem_roadsAsPoints).getOutput(0))
-  progressor(count,road_point_count,roadpoints_to_postgis,"Exporting road points to PostGIS: {}".format(count))
-  with arcpy.da.SearchCursor(mem_roadsAsPoints, ["OID","CLASS_CODE","Value","SHAPE@WKT"]) as cursor:
-    for row in cursor:
-      count += 1
-      wkt = row[3].encode('utf-8').replace(' NAN','').replace(' M ','')
-      chunkedLines.append("({0},{1},{2},ST_GeometryFromText('{3}',{4}))".format(row[0],row[1],row[2],wkt,srid)) 
-      if (count % sqlChunkify == 0) :
-        curs.execute(queryInsert + ','.join(rowOfChunk for rowOfChunk in chunkedLines)+' ON CONFLICT DO NOTHING')
-        conn.commit()
-        chunkedLines = list()
-        progressor(count,road_point_count,roadpoints_to_postgis,"Exporting road points to PostGIS: {}".format(count))
-    if(count % sqlChunkify != 0):
-       curs.execute(queryInsert + ','.join(rowOfChunk for rowOfChunk in chunkedLines)+' ON CONFLICT DO NOTHING')
-       conn.commit()
-     
-  progressor(count,road_point_count,roadpoints_to_postgis,"Exporting road points to PostGIS: {}".format(count))  
+  load_table(conn, roadPoints_table, ['objectid', 'class_code', 'value', 'geom'],
+             cursor_rows(mem_roadsAsPoints, ["OID","CLASS_CODE","Value","SHAPE@WKB"], srid),
+             total = road_point_count)
   
   
   print("Creating spatial index... "),
@@ -14,7 +14,10 @@ import arcpy
 import os
 import time
 import psycopg2 
-from progressor import progressor
+from progress_tracker import start_progress, stop_progress, progress_init, report_progress
+from hex_scheduler import pool_size, plan_hexes, run_largest_first
+from task_runner import guarded, exclude_quarantined, stage_summary
+from resume import pending_clause, pending_rows, count_rows
 import math
 
 import sys
@@ -81,9 +84,10 @@ ON ST_Intersects({3}.geom, {2}.geom)
 WHERE {3}.hex = 
 '''.format(roadLengths_table,points_id.lower(),roadPoints_table,sausage_buffer_table)
 
+# parcels not already processed (see resume.py)
 spatialQueryB = '''
-  AND {0}.{1} NOT IN
-  '''.format(sausage_buffer_table,points_id.lower())
+  AND {}
+  '''.format(pending_clause(sausage_buffer_table,points_id.lower(),roadLengths_table))
 
 spatialQueryC = '''
   GROUP BY {}) ON CONFLICT DO NOTHING;
@@ -99,18 +103,6 @@ parcel_count = int(arcpy.GetCount_management(points).getOutput(0))
 conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
 curs = conn.cursor()
  
-# get list of already processed parcels 
-# (for string match to work, had to select first item of returned tuple)
-curs.execute("SELECT {} FROM {}".format(points_id.lower(),'parcelmb'))
-raw_point_id_list = list(curs)
-raw_point_id_list = [x[0] for x in raw_point_id_list]
-
-curs.execute("SELECT {} FROM {}".format(points_id.lower(),roadLengths_table))
-completed_points = list(curs)
-completed_points = [x[0] for x in completed_points]
-# print("{} parcels already processed".format(len(completed_points)))
-completed_points = "'{}'".format("','".join(completed_points))
-
 
 def unique_values(table, field):
   data = arcpy.da.TableToNumPyArray(table, [field])
@@ -120,17 +112,22 @@ def roadLengthInsert(hex):
   conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
   curs = conn.cursor()
 
-  curs.execute('{} {} {} ({}) {}'.format(spatialQueryA,hex,spatialQueryB,completed_points,spatialQueryC))
+  curs.execute('{} {} {} {}'.format(spatialQueryA,hex,spatialQueryB,spatialQueryC))
+  inserted = curs.rowcount
   conn.commit()  
+  conn.close()
   
-  curs.execute("SELECT COUNT(*) FROM {}".format(roadLengths_table))
-  numerator = list(curs)
-  numerator = int(numerator[0][0])
-  progressor(numerator,parcel_count,start,"{}/{}; last hex processed: {}, at {}".format(numerator,parcel_count,hex,time.strftime("%Y%m%d-%H%M%S")))
+  report_progress(inserted, hex)
 
   return 0
     
-nWorkers = 4
+nWorkers = pool_size(parser.get('parallel', 'workers'))
+
+# timeout (mins) and retries (with backoff, in seconds) for failed tasks (see task_runner.py)
+task_guard = dict(timeout = parser.get('parallel', 'task_timeout'),
+                  retries = parser.get('parallel', 'task_retries'),
+                  backoff = parser.get('parallel', 'retry_backoff'))
+progress_interval = parser.get('parallel', 'progress_interval')
 hex_list = unique_values(points, 'HEX_ID')
      
 # MAIN PROCESS
@@ -144,14 +141,24 @@ if __name__ == '__main__':
   curs.execute(createTable_roadLengths)
   conn.commit()
   print("{:4.2f} mins.".format((time.time() - start)/60))
+  
+  # hexes with parcels not already processed (see resume.py)
+  completed_point_count = count_rows(curs, roadLengths_table)
+  pending_hexes = set(pending_rows(conn, sausage_buffer_table, points_id.lower(), roadLengths_table, ['hex']))
+  hex_list = [x for x in hex_list if x in pending_hexes]
 	
   
   # Setup a pool of workers/child processes and split log output
-  pool = multiprocessing.Pool(nWorkers)
+  # (progress is tallied from parcels inserted, as reported by workers, following those previously processed)
+  tracker = start_progress(parcel_count, completed_point_count, 'parcels processed', progress_interval)
+  pool = multiprocessing.Pool(nWorkers, initializer = progress_init, initargs = (tracker[1],))
   
-  # Divide work by hexes
-  progressor(0,parcel_count,start," ")
-  pool.map(roadLengthInsert, hex_list, chunksize=1)
+  # Divide work by hexes, largest first (see hex_scheduler.py; stage 25 has no log of hex processing times)
+  hex_costs, in_minutes = plan_hexes(curs, hex_list)
+  hex_costs = exclude_quarantined(curs, script, hex_costs)
+  results = run_largest_first(pool, guarded(roadLengthInsert, **task_guard), hex_costs, nWorkers, in_minutes, progress = False)
+  stop_progress(*tracker, label = 'parcels processed')
+  stage_summary(curs, script, results)
       
   # output to completion log    
   script_running_log(script, task, start)
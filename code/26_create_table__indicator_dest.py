@@ -8,6 +8,7 @@ import sys
 import time
 import psycopg2 
 
+from table_lifecycle import unlogged, finish_table
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
 
@@ -72,7 +73,9 @@ create_hard_dest_table = '''
   AS SELECT parcelmb.{1} {2} FROM parcelmb {3} ;
   '''.format(dest_hard_table,A_pointsID.lower(),' '.join([", " + dest for dest in destinations]), joinString)
 
-curs.execute(create_hard_dest_table)
+# indicator tables are created unlogged, and keyed and analyzed once created (see table_lifecycle.py)
+curs.execute(unlogged(create_hard_dest_table))
+finish_table(curs, dest_hard_table, key = A_pointsID.lower())
 conn.commit()
   
   
@@ -93,7 +96,8 @@ create_soft_dest_table = '''
   AS SELECT parcelmb.{1} {2} FROM parcelmb {3} ;
   '''.format(dest_soft_table,A_pointsID.lower(),' '.join([", " + dest for dest in destinations]), joinString)
 
-curs.execute(create_soft_dest_table)
+curs.execute(unlogged(create_soft_dest_table))
+finish_table(curs, dest_soft_table, key = A_pointsID.lower())
 conn.commit()
 
 
@@ -113,7 +117,8 @@ createTable = '''
   AS SELECT parcelmb.{} {} FROM parcelmb {} ;
   '''.format(A_pointsID.lower(),' '.join([", " + dest for dest in destinations]), joinString)
 
-curs.execute(createTable)
+curs.execute(unlogged(createTable))
+finish_table(curs, 'dest_distance', key = A_pointsID.lower())
 conn.commit() 
   
 conn.close()
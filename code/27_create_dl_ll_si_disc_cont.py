@@ -9,6 +9,7 @@ import sys
 import time
 import psycopg2 
 
+from table_lifecycle import unlogged, finish_table
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
 
@@ -189,7 +190,13 @@ FROM ind_dest_soft;
 
 conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
 curs = conn.cursor()
-curs.execute(createTable)
+# indicator tables are created unlogged, and keyed and analyzed once created (see table_lifecycle.py)
+curs.execute(unlogged(createTable))
+for table in ['ind_dest_pt_hard','ind_dest_pt_soft',
+              'ind_daily_living_hard','ind_daily_living_soft',
+              'ind_local_living_hard','ind_local_living_soft',
+              'ind_si_mix_hard','ind_si_mix_soft']:
+  finish_table(curs, table, key = A_pointsID.lower())
 conn.commit()
 conn.close()
 
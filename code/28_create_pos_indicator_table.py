@@ -7,6 +7,7 @@ import sys
 import time
 import psycopg2 
 
+from table_lifecycle import unlogged, finish_table
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
 
@@ -63,7 +64,9 @@ LEFT JOIN pos_attribute ON {3}.{5} = pos_attribute.{5};
    
 conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
 curs = conn.cursor()
-curs.execute(createTable)
+# the indicator table is created unlogged, and keyed and analyzed once created (see table_lifecycle.py)
+curs.execute(unlogged(createTable))
+finish_table(curs, out_table, key = A_pointsID.lower())
 conn.commit()
 conn.close()
 
@@ -7,6 +7,7 @@ import sys
 import time
 import psycopg2 
 
+from table_lifecycle import unlogged, finish_table
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
 
@@ -53,8 +54,11 @@ LEFT JOIN
         
 conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
 curs = conn.cursor()
-curs.execute(create_ind_walkability_hard)
-curs.execute(create_ind_walkability_soft)
+# indicator tables are created unlogged, and keyed and analyzed once created (see table_lifecycle.py)
+curs.execute(unlogged(create_ind_walkability_hard))
+curs.execute(unlogged(create_ind_walkability_soft))
+finish_table(curs, 'ind_walkability_hard', key = A_pointsID.lower())
+finish_table(curs, 'ind_walkability_soft', key = A_pointsID.lower())
 conn.commit()
 conn.close()
 
@@ -7,6 +7,7 @@ import sys
 import time
 import psycopg2 
 
+from table_lifecycle import unlogged, finish_table
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
 
@@ -72,7 +73,9 @@ LEFT JOIN (SELECT sa1_7dig11, CASE WHEN COALESCE(mtwp_total,0) = 0 THEN 0 :: dou
    
 conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
 curs = conn.cursor()
-curs.execute(createTable)
+# the indicator table is created unlogged, and keyed and analyzed once created (see table_lifecycle.py)
+curs.execute(unlogged(createTable))
+finish_table(curs, 'ind_abs', key = A_pointsID.lower())
 conn.commit()
 conn.close()
 
@@ -8,6 +8,7 @@ import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
 
+from table_lifecycle import unlogged, finish_table
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
 
@@ -41,8 +42,10 @@ CREATE TABLE abs_2011_irsd
 conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
 conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
 curs = conn.cursor()
-curs.execute(createTable)
+# the table is loaded unlogged, and keyed and analyzed once loaded (see table_lifecycle.py)
+curs.execute(unlogged(createTable))
 curs.copy_expert(sql="COPY abs_2011_irsd FROM STDIN WITH CSV HEADER DELIMITER AS ',';", file=open(irsd))
+finish_table(curs, 'abs_2011_irsd', key = 'sa1_7dig11')
 conn.close()
 
 # output to completion log    
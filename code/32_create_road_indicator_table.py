@@ -11,6 +11,7 @@ import sys
 import time
 import psycopg2 
 
+from table_lifecycle import unlogged, finish_table
 from script_running_log import script_running_log
 from ConfigParser import SafeConfigParser
 
@@ -56,7 +57,9 @@ LEFT JOIN nh1600m ON road_length.{0} = nh1600m.{0};
    
 conn = psycopg2.connect(database=sqlDBName, user=sqlUserName, password=sqlPWD)
 curs = conn.cursor()
-curs.execute(createTable)
+# the indicator table is created unlogged, and keyed and analyzed once created (see table_lifecycle.py)
+curs.execute(unlogged(createTable))
+finish_table(curs, 'ind_roads', key = A_pointsID.lower())
 conn.commit()
 conn.close()
 
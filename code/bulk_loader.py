@@ -0,0 +1,162 @@
+# Purpose: Streaming bulk loader for geodatabase to PostGIS exports
+#          -- rows are read from a generator (e.g. an arcpy SearchCursor, see cursor_rows) and
+#             streamed to the database with COPY ... FROM STDIN, rather than formatted as INSERT
+#             statements of a few hundred rows, each committed
+#          -- geometries are read as well-known binary (SHAPE@WKB) and sent as hex encoded EWKB
+#             with the project SRID, rather than as WKT patched to remove NaN Z or M values; any
+#             Z or M values are dropped (ewkb)
+#          -- each table is loaded in a single transaction (committed once), and the rows loaded
+#             and rows per second are reported
+#          -- optionally, rows are copied to a temporary staging table and inserted from this,
+#             ignoring rows whose key is already present (as for INSERT ... ON CONFLICT DO NOTHING)
+#          Usage:
+#            rows = cursor_rows(feature, [id_field, 'SHAPE@WKB'], srid)
+#            load_table(conn, table, ['id', 'geom'], rows, total = feature_count)
+# Author:  Carl Higgs
+
+import sys
+import time
+import struct
+import binascii
+
+from progressor import progressor
+
+# rows between progress updates
+progress_rows = 10000
+
+# EWKB flags of the geometry type
+ewkb_z    = 0x80000000
+ewkb_m    = 0x40000000
+ewkb_srid = 0x20000000
+
+def copy_text(value):
+  ''' Return a value formatted for COPY (text format), as unicode.'''
+  if value is None:
+    return u'\\N'
+  if isinstance(value, bytes):
+    value = value.decode('utf-8')
+  elif not isinstance(value, type(u'')):
+    value = u'{}'.format(value)
+  return value.replace(u'\\', u'\\\\').replace(u'\t', u'\\t').replace(u'\n', u'\\n').replace(u'\r', u'\\r')
+
+def wkb_type(wkb, offset):
+  ''' Return the byte order prefix, base type and coordinate dimensions of the (ISO or extended) WKB
+      geometry at offset, and the offset of its body (following any SRID).'''
+  order = '<' if bytearray(wkb[offset:offset + 1])[0] == 1 else '>'
+  code = struct.unpack_from(order + 'I', wkb, offset + 1)[0]
+  z = bool(code & ewkb_z) or (code & 0xFFFF) // 1000 in (1, 3)
+  m = bool(code & ewkb_m) or (code & 0xFFFF) // 1000 in (2, 3)
+  body = offset + 5 + (4 if code & ewkb_srid else 0)
+  return order, (code & 0xFFFF) % 1000, 2 + z + m, body
+
+def flatten_wkb(wkb, offset, parts):
+  ''' Append the 2D (x, y) WKB of the geometry at offset to parts, returning the offset following it.'''
+  order, base, dims, offset = wkb_type(wkb, offset)
+  parts.append(struct.pack(order + 'BI', 1 if order == '<' else 0, base))
+  def coords(offset, n):
+    values = struct.unpack_from('{}{}d'.format(order, n*dims), wkb, offset)
+    parts.append(struct.pack('{}{}d'.format(order, 2*n), *[v for i in range(n) for v in values[i*dims:i*dims + 2]]))
+    return offset + 8*n*dims
+  if base == 1:
+    return coords(offset, 1)
+  n = struct.unpack_from(order + 'I', wkb, offset)[0]
+  parts.append(struct.pack(order + 'I', n))
+  offset += 4
+  if base == 2:
+    return coords(offset, n)
+  for i in range(n):
+    if base == 3:
+      points = struct.unpack_from(order + 'I', wkb, offset)[0]
+      parts.append(struct.pack(order + 'I', points))
+      offset = coords(offset + 4, points)
+    else:
+      offset = flatten_wkb(wkb, offset, parts)
+  return offset
+
+def ewkb(wkb, srid):
+  ''' Return hex encoded 2D EWKB, with SRID, of a WKB geometry (or None for a null geometry).'''
+  if wkb is None:
+    return None
+  wkb = bytes(wkb)
+  order, base, dims, body = wkb_type(wkb, 0)
+  if dims > 2:
+    parts = []
+    flatten_wkb(wkb, 0, parts)
+    wkb = b''.join(parts)
+    body = 5
+  header = struct.pack(order + 'BIi', 1 if order == '<' else 0, base | ewkb_srid, int(srid))
+  return binascii.hexlify(header + wkb[body:]).decode('ascii')
+
+def cursor_rows(feature, fields, srid = None, where_clause = None, convert = None, **kwargs):
+  ''' Generate rows of a feature class or table with an arcpy SearchCursor; SHAPE@WKB values are
+      returned as hex encoded EWKB with the given srid.  Optionally, convert is a function applied
+      to each row, returning a tuple of values (or None to skip the row).'''
+  import arcpy
+  geometry = [i for i, field in enumerate(fields) if field.upper() == 'SHAPE@WKB']
+  with arcpy.da.SearchCursor(feature, fields, where_clause = where_clause, **kwargs) as cursor:
+    for row in cursor:
+      if len(geometry) > 0:
+        row = list(row)
+        for i in geometry:
+          row[i] = ewkb(row[i], srid)
+      if convert is not None:
+        row = convert(row)
+        if row is None:
+          continue
+      yield tuple(row)
+
+class RowStream(object):
+  ''' A file-like object reading rows from a generator as COPY text format lines.'''
+  def __init__(self, rows, total = None, label = ''):
+    self.rows   = iter(rows)
+    self.total  = total
+    self.label  = label
+    self.count  = 0
+    self.start  = time.time()
+    self.buffer = b''
+
+  def read(self, size = 8192):
+    chunks = [self.buffer]
+    length = len(self.buffer)
+    while length < size:
+      try:
+        row = next(self.rows)
+      except StopIteration:
+        break
+      line = (u'\t'.join(copy_text(value) for value in row) + u'\n').encode('utf-8')
+      chunks.append(line)
+      length += len(line)
+      self.count += 1
+      if self.total and self.count % progress_rows == 0:
+        progressor(self.count, self.total, self.start, self.label)
+    data = b''.join(chunks)
+    self.buffer = data[size:]
+    if sys.version_info[0] < 3:
+      return str(data[:size])
+    return data[:size]
+
+def copy_rows(curs, table, columns, rows, total = None, ignore_conflicts = False):
+  ''' Stream rows (tuples of values for columns, or all of the table's columns if None) to a table
+      with COPY, returning the number of rows read; if ignore_conflicts, rows whose key is already
+      present in the table are not loaded.'''
+  stream = RowStream(rows, total, 'Loading {}'.format(table))
+  column_list = '' if columns is None else '({})'.format(','.join(columns))
+  target = table
+  if ignore_conflicts:
+    target = 'staging_{}'.format(table.split('.')[-1])
+    curs.execute("CREATE TEMP TABLE {} (LIKE {}) ON COMMIT DROP".format(target, table))
+  curs.copy_expert("COPY {} {} FROM STDIN".format(target, column_list), stream)
+  if ignore_conflicts:
+    curs.execute("INSERT INTO {0} {1} SELECT {2} FROM {3} ON CONFLICT DO NOTHING".format(
+                 table, column_list, '*' if columns is None else ','.join(columns), target))
+  return stream.count
+
+def load_table(conn, table, columns, rows, total = None, ignore_conflicts = False):
+  ''' Load rows to a table (as per copy_rows) and commit, reporting rows loaded per second.'''
+  load_start = time.time()
+  curs = conn.cursor()
+  count = copy_rows(curs, table, columns, rows, total, ignore_conflicts)
+  conn.commit()
+  secs = time.time() - load_start
+  print("\n{}: {:,} rows loaded in {:.1f} secs ({:,.0f} rows per sec)".format(table, count, secs, count/max(secs, 1e-9)))
+  return count
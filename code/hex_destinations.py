@@ -0,0 +1,181 @@
+# Purpose: Build-once index of candidate destinations for each hex, for the ArcGIS OD stages
+#          -- destinations are bucketed in a uniform grid; for each hex, rings of grid cells around
+#             the extent of its parcels are searched, expanding until at least a minimum number of
+#             destinations lie within a radius of the parcels' extent (and the radius is at least
+#             a minimum distance); these destinations are the hex's candidates
+#          -- as network distance is never shorter than straight line distance (less the distance
+#             of origin and destination from the network, up to the search tolerance each), a parcel
+#             whose closest candidate is within radius - 2 x tolerance along the network is certain
+#             to have found its closest destination (certified_lines); other parcels are solved
+#             again against the destinations within a wider ring, bounded by the distance of the
+#             closest candidate they found (retry_radius, ring_oids), until all are certified or
+#             the ring covers every destination
+#          -- the index is keyed on the state of the destination feature class, selection and parcel shards
+#             (as per parcel_shards.py), so it is only rebuilt when these change
+#          Workers load the index of each destination type as read-only memory maps, and add only a
+#          hex's candidates to the OD cost matrix, rather than every destination of the type (or
+#          those selected by location within the hex's buffer).
+# Author:  Carl Higgs
+
+import os
+import shutil
+import tempfile
+import collections
+import numpy as np
+
+from network_cache import source_key
+from parcel_shards import load_shards
+
+# increment if the index structure or rule changes, to invalidate existing indices
+candidate_version = 2
+
+# candidates of each hex (hex, offset, oid, radius), and the object ids and coordinates of all destinations
+CandidateIndex = collections.namedtuple('CandidateIndex', ['hex', 'offset', 'oid', 'radius', 'point_oid', 'point_x', 'point_y'])
+
+def hex_extents(shards):
+  ''' Return the extent (xmin, ymin, xmax, ymax arrays) of the parcels of each hex in the shards.'''
+  first = shards.offset[:-1]
+  x = np.asarray(shards.x)
+  y = np.asarray(shards.y)
+  return (np.minimum.reduceat(x, first), np.minimum.reduceat(y, first),
+          np.maximum.reduceat(x, first), np.maximum.reduceat(y, first))
+
+def extent_distance(x, y, xmin, ymin, xmax, ymax):
+  ''' Return the distance of points from an extent (zero within it).'''
+  dx = np.maximum(np.maximum(xmin - x, x - xmax), 0)
+  dy = np.maximum(np.maximum(ymin - y, y - ymax), 0)
+  return np.sqrt(dx**2 + dy**2)
+
+def ring_candidates(x, y, extents, cell = 500, radius = 3000, count = 8):
+  ''' Find the candidate destinations (points x, y) for each extent, by the expanding ring rule.
+      Returns the offset of each extent's candidates, the candidates (indices of points, by extent)
+      and the radius within which all points are candidates (inf where all points are candidates).'''
+  x = np.asarray(x, dtype = float)
+  y = np.asarray(y, dtype = float)
+  cell = float(cell)
+  xmin, ymin, xmax, ymax = extents
+  candidates = []
+  radii = np.full(len(xmin), np.inf)
+  if len(x) == 0:
+    return np.zeros(len(xmin) + 1, dtype = np.int64), np.arange(0), radii
+  # grid of destinations, sorted by cell (column major, so the cells of a column are contiguous)
+  x0 = min(x.min(), xmin.min())
+  y0 = min(y.min(), ymin.min())
+  nx = int((max(x.max(), xmax.max()) - x0)//cell) + 1
+  ny = int((max(y.max(), ymax.max()) - y0)//cell) + 1
+  key = ((x - x0)//cell).astype(np.int64)*ny + ((y - y0)//cell).astype(np.int64)
+  order = np.argsort(key, kind = 'mergesort')
+  key = key[order]
+  # rings from which the minimum radius is covered
+  k = int(np.ceil(float(radius)/cell))
+  for i in range(len(xmin)):
+    cx0 = int((xmin[i] - x0)//cell)
+    cx1 = int((xmax[i] - x0)//cell)
+    cy0 = int((ymin[i] - y0)//cell)
+    cy1 = int((ymax[i] - y0)//cell)
+    ring = k
+    while True:
+      # the cells within ring cells of the extent's cells cover all points within ring x cell of it
+      columns = range(max(cx0 - ring, 0), min(cx1 + ring, nx - 1) + 1)
+      lo = np.searchsorted(key, [c*ny + max(cy0 - ring, 0) for c in columns], side = 'left')
+      hi = np.searchsorted(key, [c*ny + min(cy1 + ring, ny - 1) for c in columns], side = 'right')
+      found = order[np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)])]
+      within = found[extent_distance(x[found], y[found], xmin[i], ymin[i], xmax[i], ymax[i]) <= ring*cell]
+      if len(within) >= count:
+        found = within
+        radii[i] = ring*cell
+        break
+      if cx0 - ring <= 0 and cy0 - ring <= 0 and cx1 + ring >= nx - 1 and cy1 + ring >= ny - 1:
+        # all destinations are candidates
+        break
+      ring += 1
+    candidates.append(np.sort(found))
+  offset = np.append(0, np.cumsum([len(c) for c in candidates])).astype(np.int64)
+  return offset, np.concatenate(candidates).astype(np.int64), radii
+
+def build_candidates(cache_root, shard_dir, gdb, feature, where_clause = '', cell = 500, radius = 3000, count = 8):
+  ''' Build the candidate index of a destination feature class (optionally, those matching a where
+      clause) for the hexes of the parcel shards, if not already current, returning its directory.'''
+  key = source_key(gdb, feature, 'candidates{}|{}|{}|{}|{}|{}'.format(candidate_version, where_clause,
+                   os.path.basename(shard_dir), cell, radius, count))
+  index_dir = os.path.join(cache_root, '{}_{}'.format(feature, key[:16]))
+  if os.path.isdir(index_dir):
+    return index_dir
+  if not os.path.exists(cache_root):
+    os.makedirs(cache_root)
+  import arcpy
+  data = arcpy.da.FeatureClassToNumPyArray(os.path.join(gdb, feature), ['OID@', 'SHAPE@X', 'SHAPE@Y'], where_clause)
+  shards = load_shards(shard_dir)
+  offset, found, radii = ring_candidates(data['SHAPE@X'], data['SHAPE@Y'], hex_extents(shards), cell, radius, count)
+  # arrays are written to a temporary directory which is then renamed, so that a partially
+  # written index is never read
+  build_dir = tempfile.mkdtemp(dir = cache_root)
+  np.save(os.path.join(build_dir, 'hex.npy'), np.asarray(shards.hex))
+  np.save(os.path.join(build_dir, 'offset.npy'), offset)
+  np.save(os.path.join(build_dir, 'oid.npy'), data['OID@'][found].astype(np.int64))
+  np.save(os.path.join(build_dir, 'radius.npy'), radii)
+  np.save(os.path.join(build_dir, 'point_oid.npy'), data['OID@'].astype(np.int64))
+  np.save(os.path.join(build_dir, 'point_x.npy'), data['SHAPE@X'].astype(float))
+  np.save(os.path.join(build_dir, 'point_y.npy'), data['SHAPE@Y'].astype(float))
+  try:
+    os.rename(build_dir, index_dir)
+  except OSError:
+    # built concurrently by another process
+    shutil.rmtree(build_dir)
+  return index_dir
+
+def load_candidates(index_dir):
+  ''' Open a candidate index as read-only memory mapped arrays.'''
+  return CandidateIndex(**dict((field, np.load(os.path.join(index_dir, '{}.npy'.format(field)), mmap_mode = 'r'))
+                               for field in CandidateIndex._fields))
+
+def hex_candidates(index, hex):
+  ''' Return the object ids of a hex's candidate destinations, and the radius within which these
+      are all of the destinations (inf if these are all destinations).'''
+  i = np.searchsorted(index.hex, hex)
+  if i == len(index.hex) or index.hex[i] != hex:
+    return np.arange(0), np.inf
+  return np.asarray(index.oid[index.offset[i]:index.offset[i + 1]]), float(index.radius[i])
+
+def rows_extent(shards, rows):
+  ''' Return the extent (xmin, ymin, xmax, ymax) of parcels (rows of the shards).'''
+  x = np.asarray(shards.x)[rows]
+  y = np.asarray(shards.y)[rows]
+  return x.min(), y.min(), x.max(), y.max()
+
+def ring_oids(index, extent, radius):
+  ''' Return the object ids of destinations within radius of an extent, and the radius (inf if
+      these are all destinations).'''
+  within = extent_distance(np.asarray(index.point_x), np.asarray(index.point_y), *extent) <= radius
+  if within.all():
+    return np.asarray(index.point_oid), np.inf
+  return np.asarray(index.point_oid)[within], float(radius)
+
+def retry_radius(lines, origins, radius, tolerance):
+  ''' Return the radius of the ring of destinations against which uncertified parcels (origins)
+      are solved again, given the OD lines found within radius: a destination beyond the
+      closest found for every origin, plus 2 x tolerance, cannot be closer along the network.
+      Where an origin found no destination, the radius is doubled.'''
+  origins = set(origins)
+  closest = {}
+  for line in lines:
+    origin = line[0].split('-')[0].strip(' ')
+    if origin in origins:
+      closest[origin] = min(line[1], closest.get(origin, np.inf))
+  if len(closest) < len(origins):
+    return 2*float(radius)
+  return max(max(closest.values()) + 2*float(tolerance), float(radius))
+
+def candidate_clause(oid_field, oids):
+  ''' Return a where clause selecting features by object id.'''
+  return '"{}" IN ({})'.format(oid_field, ','.join(str(x) for x in oids))
+
+def certified_lines(lines, radius, tolerance):
+  ''' Return the OD lines (name, length) solved against a hex's candidates which are certain to be
+      the closest of all destinations, given the candidates' radius and the search tolerance.'''
+  limit = radius - 2*float(tolerance)
+  return [line for line in lines if line[1] <= limit]
+
+def line_origins(lines):
+  ''' Return the set of origin names of OD lines (named 'origin - destination').'''
+  return set(line[0].split('-')[0].strip(' ') for line in lines)
@@ -0,0 +1,219 @@
+# Purpose: Cost model driven scheduling of hex tasks over a pool of worker processes
+#          -- estimates the cost of each hex from its parcel count (hex_parcels, as created by
+#             11_count_parcels_in_hexes.py), optionally weighted by the density of destinations
+#             around its parcels, and calibrated against historical processing times (mins)
+#             recorded for hexes in a stage's log table
+#          -- dispatches hexes largest first (task_runner.run_tasks), so that large (e.g. CBD) hexes
+#             are not left until last with the remaining workers idle
+#          -- sizes the pool from the CPU count (unless a number of workers is configured)
+#          -- reports predicted versus actual makespan (elapsed time to process all hexes)
+#          -- optionally splits hexes with more than a threshold number of parcels into sub-tasks
+#             (ranges of the hex's parcels, ordered by id) which may run on different workers;
+#             sub-task completion is recorded in log_hex_subtasks, and rolled up to the stage's
+#             own per hex log once all parts of a hex are complete
+# Author:  Carl Higgs
+
+import time
+import math
+import heapq
+import multiprocessing
+import numpy as np
+from progressor import progressor
+from task_runner import run_tasks
+
+# Log of sub-task completion (for hexes split in to parts)
+subtask_log_table = 'log_hex_subtasks'
+
+createTable_subtask_log = '''
+  CREATE TABLE IF NOT EXISTS {}
+    (stage varchar NOT NULL,
+     hex integer NOT NULL,
+     dest varchar NOT NULL,
+     part integer NOT NULL,
+     parts integer NOT NULL,
+     parcel_count integer,
+     status varchar,
+     mins double precision,
+     PRIMARY KEY(stage,hex,dest,part)
+     );
+  '''.format(subtask_log_table)
+
+def pool_size(workers = 0):
+  ''' Return the number of worker processes to use: as configured, or one per CPU if workers is 0.'''
+  workers = int(workers)
+  if workers > 0:
+    return workers
+  return multiprocessing.cpu_count()
+
+def table_exists(curs, table):
+  ''' Check whether a table exists in the database.'''
+  curs.execute("SELECT to_regclass('{}')".format(table))
+  return curs.fetchone()[0] is not None
+
+def hex_parcel_counts(curs, parcel_table = 'hex_parcels'):
+  ''' Return a dictionary of hex: parcel count.'''
+  if not table_exists(curs, parcel_table):
+    return {}
+  curs.execute("SELECT hex, parcel_count FROM {}".format(parcel_table))
+  return dict(list(curs))
+
+def hex_history(curs, log_table):
+  ''' Return a dictionary of hex: processing time (mins) from a stage's log table, for hexes
+      previously processed.  Where a hex is logged once per destination, mins is cumulative
+      for the hex, so the maximum is taken.'''
+  if log_table is None or not table_exists(curs, log_table):
+    return {}
+  curs.execute("SELECT hex, max(mins) FROM {} WHERE mins > 0 GROUP BY hex".format(log_table))
+  return dict([(int(hex), float(mins)) for hex, mins in list(curs)])
+
+def completed_hexes(curs, log_table, dests):
+  ''' Return the set of hexes logged in a stage's log table as processed for every one of a list
+      of destinations (e.g. destination numbers).'''
+  dests = sorted(set(str(x) for x in dests))
+  if len(dests) == 0 or not table_exists(curs, log_table):
+    return set()
+  curs.execute("SELECT hex FROM {} WHERE dest IN ({}) GROUP BY hex HAVING count(DISTINCT dest) >= {}".format(
+               log_table, ','.join("'{}'".format(x) for x in dests), len(dests)))
+  return set([int(x[0]) for x in list(curs)])
+
+def destination_density(hexes, x, y, dest_x, dest_y, radius):
+  ''' Return a dictionary of hex: number of destinations within radius of the centroid of the
+      hex's points (given as arrays of hex, x and y).'''
+  hexes = np.asarray(hexes)
+  dest_x = np.asarray(dest_x, dtype = float)
+  dest_y = np.asarray(dest_y, dtype = float)
+  hex_list, inverse = np.unique(hexes, return_inverse = True)
+  counts = np.bincount(inverse)
+  cx = np.bincount(inverse, weights = x)/counts
+  cy = np.bincount(inverse, weights = y)/counts
+  density = {}
+  for hex, hx, hy in zip(hex_list.tolist(), cx, cy):
+    density[hex] = int((((dest_x - hx)**2 + (dest_y - hy)**2) <= radius**2).sum())
+  return density
+
+def hex_costs(hex_list, parcel_counts, density = None, history = None):
+  ''' Estimate the cost of processing each hex as its parcel count, weighted by relative
+      destination density if given.  Where processing times are known for some hexes (history),
+      these are used directly, and the estimates for the remaining hexes are scaled to minutes.
+      Returns a dictionary of hex: cost, and whether costs are in minutes.'''
+  hex_list = [int(hex) for hex in hex_list]
+  cost = np.array([parcel_counts.get(hex, 1) for hex in hex_list], dtype = float)
+  if density:
+    d = np.array([density.get(hex, 0) for hex in hex_list], dtype = float)
+    cost = cost*(1 + d/max(d.mean(), 1))
+  in_minutes = False
+  if history:
+    known = np.array([hex in history for hex in hex_list])
+    if known.any() and cost[known].sum() > 0:
+      mins = np.array([history.get(hex, 0) for hex in hex_list])
+      cost = np.where(known, mins, cost*mins[known].sum()/cost[known].sum())
+      in_minutes = True
+  return dict(zip(hex_list, cost.tolist())), in_minutes
+
+def predicted_makespan(costs, workers):
+  ''' Return the makespan of dispatching tasks of the given costs to workers largest first.'''
+  loads = [0.0]*workers
+  for cost in sorted(costs, reverse = True):
+    heapq.heapreplace(loads, loads[0] + cost)
+  return max(loads)
+
+def run_largest_first(pool, func, costs, workers, in_minutes = False, label = 'hexes', progress = True):
+  ''' Process tasks (e.g. hexes) using a pool of workers in decreasing order of estimated cost,
+      reporting progress and the predicted versus actual makespan.  Tasks are dispatched by
+      task_runner.run_tasks, enforcing the timeout of a guarded task function.
+      Returns a dictionary of task: result.'''
+  tasks = sorted(costs, key = lambda task: costs[task], reverse = True)
+  results   = {}
+  durations = {}
+  schedule_start = time.time()
+  for task, result, mins in run_tasks(pool, func, tasks):
+    results[task]   = result
+    durations[task] = mins
+    if progress:
+      progressor(len(results), len(tasks), schedule_start, "{} / {} {} processed".format(len(results), len(tasks), label))
+  actual = (time.time() - schedule_start)/60
+
+  # the cost model is scaled to the total task time, so as to compare predicted and actual
+  # makespan regardless of whether historical processing times were available
+  total = sum(durations.values())
+  scale = total/max(sum(costs.values()), 1e-9)
+  print("\nScheduled {} {} over {} workers; makespan actual: {:.2f} mins, predicted: {:.2f} mins{}; lower bound (total task time/workers): {:.2f} mins".format(
+         len(tasks), label, workers, actual, predicted_makespan([costs[task]*scale for task in tasks], workers),
+         ' ({:.2f} mins from historical times)'.format(predicted_makespan(costs.values(), workers)) if in_minutes else '',
+         total/workers))
+  return results
+
+def split_hexes(costs, parcel_counts, threshold):
+  ''' Split hexes with more than threshold parcels in to (hex, part, parts) sub-tasks of no more
+      than threshold parcels, each with an equal share of the hex's cost.  Other hexes remain
+      single tasks.  Returns a dictionary of task: cost.'''
+  tasks = {}
+  for hex, cost in costs.items():
+    parts = 1
+    if threshold > 0:
+      parts = max(1, int(math.ceil(parcel_counts.get(hex, 0)/float(threshold))))
+    if parts == 1:
+      tasks[hex] = cost
+    else:
+      for part in range(parts):
+        tasks[(hex, part, parts)] = cost/parts
+  return tasks
+
+def hex_task(task):
+  ''' Return the hex, part and number of parts of a task (a hex, or (hex, part, parts) sub-task).'''
+  if isinstance(task, tuple):
+    return task
+  return task, 0, 1
+
+def task_part(items, part, parts):
+  ''' Return a sub-task's part of a hex's items (e.g. parcel ids, ordered such that parts are id ranges).'''
+  n = len(items)
+  return items[(n*part)//parts:(n*(part + 1))//parts]
+
+def completed_parts(curs, stage, hex, part, parts):
+  ''' Return the set of destinations (as logged) completed for a sub-task of a hex (as split into
+      the given number of parts; parts of another split cover other parcels).'''
+  curs.execute(createTable_subtask_log)
+  curs.execute("SELECT dest FROM {} WHERE stage = '{}' AND hex = {} AND part = {} AND parts = {}".format(subtask_log_table, stage, hex, part, parts))
+  return set([x[0] for x in list(curs)])
+
+def subtask_sql(stage, hex, dest, part, parts, parcel_count, status, mins, log_table, log_columns, log_update):
+  ''' Return SQL statements recording the status of a sub-task of a hex (for a destination, or ''
+      where not applicable), and writing the hex's entry in the stage's log table once all parts of
+      the hex have this status.  log_columns are the values of the log table's columns, as SQL
+      expressions over the sub-task log grouped by hex, dest and status (e.g. 'sum(parcel_count)'),
+      and log_update is the log table's ON CONFLICT clause.  Entries of the hex's sub-tasks from a
+      different split (e.g. if split_parcels or the parcel count has changed) are removed.'''
+  return ['''DELETE FROM {0} WHERE stage = '{1}' AND hex = {2} AND parts <> {3}'''.format(subtask_log_table, stage, hex, parts),
+          '''INSERT INTO {0} VALUES ('{1}',{2},'{3}',{4},{5},{6},'{7}',{8})
+             ON CONFLICT (stage,hex,dest,part)
+             DO UPDATE SET parts=EXCLUDED.parts,parcel_count=EXCLUDED.parcel_count,status=EXCLUDED.status,mins=EXCLUDED.mins'''.format(
+             subtask_log_table, stage, hex, dest, part, parts, parcel_count, status, mins),
+          '''INSERT INTO {0} SELECT {1} FROM {2}
+             WHERE stage = '{3}' AND hex = {4} AND dest = '{5}' AND status = '{6}' AND parts = {7}
+             GROUP BY hex, dest, status HAVING count(*) >= {7} {8}'''.format(
+             log_table, ','.join(log_columns), subtask_log_table, stage, hex, dest, status, parts, log_update)]
+
+def log_subtask(curs, *args):
+  ''' Record the status of a sub-task of a hex, and write the hex's log entry once all of its
+      parts have this status (taking the arguments of subtask_sql).'''
+  curs.execute(createTable_subtask_log)
+  for statement in subtask_sql(*args):
+    curs.execute(statement)
+  curs.connection.commit()
+
+def plan_hexes(curs, hex_list, log_table = None, points = None, destinations = None, radius = 3000, split = 0):
+  ''' Estimate hex costs for a stage, from hex parcel counts, historical processing times in the
+      stage's log table and optionally the density of destinations (arrays of x and y) within
+      radius of the hex's points (arrays of hex, x and y).  Hexes with more than 'split' parcels
+      are divided in to sub-tasks (see split_hexes).
+      Returns a dictionary of task: cost, and whether costs are in minutes.'''
+  density = None
+  if points is not None and destinations is not None:
+    density = destination_density(points[0], points[1], points[2], destinations[0], destinations[1], radius)
+  parcel_counts = hex_parcel_counts(curs)
+  costs, in_minutes = hex_costs(hex_list, parcel_counts, density, hex_history(curs, log_table))
+  if int(split) > 0:
+    curs.execute(createTable_subtask_log)
+    curs.connection.commit()
+  return split_hexes(costs, parcel_counts, int(split)), in_minutes
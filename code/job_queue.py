@@ -0,0 +1,270 @@
+# Purpose: PostgreSQL backed job queue for hex tasks, so that a stage may be processed by any
+#          number of worker processes on any number of hosts sharing the project database
+#          -- tasks (stage, hex, dest, part) are enqueued once with their estimated cost (see
+#             hex_scheduler.py); stages enqueue only tasks not complete in their log, and tasks
+#             already queued are left as is (unless failed), so every host may run the same script
+#          -- workers claim the most costly pending task using SELECT ... FOR UPDATE SKIP LOCKED,
+#             so concurrent workers never block on, or claim, the same task
+#          -- while a worker is running, a heartbeat thread updates the heartbeat of its claimed
+#             task; running tasks whose heartbeat is stale (e.g. the worker's host was lost) are
+#             reclaimed as pending by other workers
+#          -- the timeout of a guarded task function is enforced by the process running the pool:
+#             a worker whose task overruns it is terminated (see task_runner.run_tasks), its task
+#             returned to pending (or failed, once its attempts are spent), and a replacement
+#             worker started
+#          -- tasks are marked done (or failed, with the error) on completion; tasks failing on
+#             every attempt are quarantined (see task_runner.py), so are not enqueued again, and
+#             a summary of the stage's tasks is reported once the queue is processed
+#          Set dispatch = queue in the [parallel] section of config.ini to use the queue in place of
+#          a local process pool (stages 16b, 17b and 18b).
+# Author:  Carl Higgs
+
+import os
+import sys
+import time
+import socket
+import threading
+import functools
+import multiprocessing
+import psycopg2
+
+from hex_scheduler import hex_task
+from task_runner import task_failure, task_key, quarantine, quarantine_table, TaskOutcome
+from task_runner import guard_settings, terminate_overrun, abandon, deadline_poll
+
+queue_table = 'job_queue'
+
+createTable_queue = '''
+  CREATE TABLE IF NOT EXISTS {0}
+    (stage varchar NOT NULL,
+     hex integer NOT NULL,
+     dest varchar NOT NULL DEFAULT '',
+     part integer NOT NULL DEFAULT 0,
+     parts integer NOT NULL DEFAULT 1,
+     cost double precision NOT NULL DEFAULT 0,
+     status varchar NOT NULL DEFAULT 'pending',
+     worker varchar,
+     attempts integer NOT NULL DEFAULT 0,
+     claimed timestamp,
+     heartbeat timestamp,
+     finished timestamp,
+     mins double precision,
+     error varchar,
+     PRIMARY KEY(stage,hex,dest,part)
+     );
+  CREATE INDEX IF NOT EXISTS {0}_pending_idx ON {0} (stage, cost DESC) WHERE status = 'pending';
+  '''.format(queue_table)
+
+queryClaim = '''
+  UPDATE {0} q SET status = 'running', worker = %s, attempts = q.attempts + 1,
+                   claimed = now(), heartbeat = now(), error = NULL
+  FROM (SELECT stage, hex, dest, part FROM {0}
+        WHERE stage = %s AND status = 'pending'
+        ORDER BY cost DESC
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED) c
+  WHERE q.stage = c.stage AND q.hex = c.hex AND q.dest = c.dest AND q.part = c.part
+  RETURNING q.hex, q.dest, q.part, q.parts
+  '''.format(queue_table)
+
+def worker_name(pid = None):
+  ''' Return an identifier for this (or a given) worker process, unique across hosts.'''
+  return '{}:{}'.format(socket.gethostname(), os.getpid() if pid is None else pid)
+
+def job_task(hex, dest, part, parts):
+  ''' Return the task (as per hex_scheduler.hex_task; with destination, if any) of a queued job.'''
+  task = hex if parts == 1 else (hex, part, parts)
+  if dest == '':
+    return task
+  return (task, dest)
+
+def enqueue(curs, stage, costs, dests = None):
+  ''' Add tasks (a dictionary of task: cost, as per hex_scheduler.plan_hexes) to the queue for a
+      stage, optionally once for each of a list of destinations.  Tasks already queued are left
+      as is, other than failed tasks, which are returned to pending to be retried (tasks failing
+      every attempt are quarantined, so not enqueued).  Returns the number of tasks added or
+      returned to pending.'''
+  curs.execute(createTable_queue)
+  rows = []
+  for task, cost in costs.items():
+    hex, part, parts = hex_task(task)
+    for dest in (dests if dests is not None else ['']):
+      rows.append(curs.mogrify("(%s,%s,%s,%s,%s,%s)", (stage, int(hex), str(dest), int(part), int(parts), float(cost))).decode('utf-8'))
+  added = 0
+  for i in range(0, len(rows), 500):
+    curs.execute('''INSERT INTO {0} (stage, hex, dest, part, parts, cost) VALUES {1}
+                    ON CONFLICT (stage,hex,dest,part)
+                    DO UPDATE SET status = 'pending', worker = NULL, attempts = 0 WHERE {0}.status = 'failed' '''.format(queue_table, ','.join(rows[i:i+500])))
+    added += curs.rowcount
+  curs.connection.commit()
+  return added
+
+def claim(conn, stage, worker):
+  ''' Claim the most costly pending task of a stage for a worker, returning its
+      (hex, dest, part, parts), or None if no task is pending.'''
+  curs = conn.cursor()
+  curs.execute(queryClaim, (worker, stage))
+  job = curs.fetchone()
+  conn.commit()
+  return job
+
+def complete(conn, stage, job, worker, mins, status = 'done', error = None, attempts = 1):
+  ''' Mark a claimed task as done (or failed, with an error message), having made a number of
+      attempts (e.g. by a guarded task function).'''
+  hex, dest, part, parts = job
+  curs = conn.cursor()
+  curs.execute('''UPDATE {} SET status = %s, finished = now(), mins = %s, error = %s, attempts = attempts + %s - 1
+                  WHERE stage = %s AND hex = %s AND dest = %s AND part = %s AND worker = %s'''.format(queue_table),
+               (status, mins, error, attempts, stage, hex, dest, part, worker))
+  conn.commit()
+
+def release(conn, stage, worker, attempts, retries, error):
+  ''' Return the task claimed by a terminated worker to pending, having made a number of attempts
+      (or mark it failed, if its attempts, over all claims, exceed retries).  Returns the task
+      (as per job_task) and its status, or None if the worker held no task.'''
+  curs = conn.cursor()
+  curs.execute('''UPDATE {} SET attempts = attempts + %s - 1, error = %s, mins = extract(epoch from now() - claimed)/60,
+                         status = CASE WHEN attempts + %s - 1 > %s THEN 'failed' ELSE 'pending' END,
+                         finished = CASE WHEN attempts + %s - 1 > %s THEN now() END
+                  WHERE stage = %s AND worker = %s AND status = 'running'
+                  RETURNING hex, dest, part, parts, status, attempts'''.format(queue_table),
+               (attempts, error, attempts, retries, attempts, retries, stage, worker))
+  job = curs.fetchone()
+  conn.commit()
+  if job is None:
+    return None
+  return job_task(*job[:4]), job[4], job[5]
+
+def reclaim_stale(conn, stage, stale = 300):
+  ''' Return running tasks of a stage with no heartbeat for stale seconds to pending.
+      Returns the number of tasks reclaimed.'''
+  curs = conn.cursor()
+  curs.execute('''UPDATE {} SET status = 'pending', worker = NULL
+                  WHERE stage = %s AND status = 'running' AND heartbeat < now() - %s * interval '1 second' '''.format(queue_table),
+               (stage, stale))
+  reclaimed = curs.rowcount
+  conn.commit()
+  return reclaimed
+
+def queue_status(curs, stage):
+  ''' Return a dictionary of status: task count for a stage.'''
+  curs.execute(createTable_queue)
+  curs.execute("SELECT status, count(*) FROM {} WHERE stage = %s GROUP BY status".format(queue_table), (stage,))
+  return dict(list(curs))
+
+def heartbeat(connect, worker, stop, interval):
+  ''' Update the heartbeat of tasks claimed by a worker every interval seconds until stopped
+      (run as a thread, using its own connection).'''
+  conn = psycopg2.connect(**connect)
+  curs = conn.cursor()
+  while not stop.wait(interval):
+    curs.execute("UPDATE {} SET heartbeat = now() WHERE worker = %s AND status = 'running'".format(queue_table), (worker,))
+    conn.commit()
+  conn.close()
+
+def queue_summary(curs, stage, quarantine_stage):
+  ''' Report a summary of the queued tasks of a stage (as per task_runner.stage_summary), returning
+      the list of failed (and quarantined) tasks.'''
+  curs.execute(createTable_queue)
+  curs.execute('''SELECT hex, dest, part, parts, status, attempts, error FROM {}
+                  WHERE stage = %s'''.format(queue_table), (stage,))
+  jobs = list(curs)
+  failed  = [(job_task(*job[:4]), job[6]) for job in jobs if job[4] == 'failed']
+  retried = [job for job in jobs if job[4] == 'done' and job[5] > 1]
+  print("\n{}: {} tasks; {} completed ({} after retry); {} failed and quarantined{}".format(
+         quarantine_stage, len(jobs), len([job for job in jobs if job[4] == 'done']), len(retried), len(failed),
+         ' (see {})'.format(quarantine_table) if len(failed) > 0 else ''))
+  for task, error in sorted(failed, key = lambda x: task_key(x[0])):
+    print("  {}: {}".format(task_key(task), error))
+  return [task for task, error in failed]
+
+def queue_worker(args):
+  ''' Claim and run tasks of a stage until none remain pending or running, returning the number
+      of tasks run.  args are the task function, stage, connection parameters (a dictionary
+      of psycopg2.connect() arguments), heartbeat interval, stale timeout (seconds) and the
+      stage under which failed tasks are quarantined.
+      The task function is called with each task (see job_task); results are checked as per
+      task_runner.task_failure (e.g. a guarded task function, or a worker function result).'''
+  func, stage, connect, interval, stale, quarantine_stage = args
+  worker = worker_name()
+  conn = psycopg2.connect(**connect)
+  stop = threading.Event()
+  beat = threading.Thread(target = heartbeat, args = (connect, worker, stop, interval))
+  beat.daemon = True
+  beat.start()
+  tasks_run = 0
+  try:
+    while True:
+      reclaim_stale(conn, stage, stale)
+      job = claim(conn, stage, worker)
+      if job is None:
+        # wait for tasks running elsewhere, in case these are reclaimed
+        if queue_status(conn.cursor(), stage).get('running', 0) == 0:
+          break
+        time.sleep(min(interval, stale))
+        continue
+      task_start = time.time()
+      try:
+        result = func(job_task(*job))
+        error = task_failure(result)
+      except:
+        result, error = None, str(sys.exc_info()[1])
+      # attempts made by a guarded task function, beyond the first, are added to those of the job
+      attempts = result.attempts if isinstance(result, TaskOutcome) else 1
+      complete(conn, stage, job, worker, (time.time() - task_start)/60, 'done' if error is None else 'failed', error, attempts)
+      if error is not None:
+        # failed on every attempt; quarantined so that the task is not enqueued again
+        quarantine(conn.cursor(), quarantine_stage, job_task(*job), attempts, error)
+      tasks_run += 1
+  finally:
+    stop.set()
+    conn.close()
+  return tasks_run
+
+def run_queue(pool, func, stage, connect, workers, interval = 30, stale = 300, quarantine_stage = None):
+  ''' Process the queued tasks of a stage using a pool of workers (each claiming tasks from the
+      queue, along with any workers on other hosts), quarantining failed tasks (under
+      quarantine_stage, if given, e.g. the stage script, or otherwise stage), and report the
+      final queue status and a summary of the stage's tasks.'''
+  queue_start = time.time()
+  if quarantine_stage is None:
+    quarantine_stage = stage
+  timeout, retries = guard_settings(func)
+  manager = None
+  if timeout > 0:
+    manager = multiprocessing.Manager()
+    started = manager.dict()
+    func = functools.partial(func, started = started)
+  args = (func, stage, connect, interval, stale, quarantine_stage)
+  conn = psycopg2.connect(**connect)
+  try:
+    workers_run = [pool.apply_async(queue_worker, (args,)) for i in range(workers)]
+    terminated = 0
+    while len([x for x in workers_run if not x.ready()]) > terminated:
+      if manager is not None:
+        for key, pid, attempt in terminate_overrun(started, timeout):
+          error = 'timed out after {:g} mins (worker process {} terminated)'.format(timeout, pid)
+          released = release(conn, stage, worker_name(pid), attempt, retries, error)
+          if released is not None:
+            task, status, attempts = released
+            print("Task {} failed (attempt {} of {}): {}".format(task_key(task), attempt, retries + 1, error))
+            if status == 'failed':
+              quarantine(conn.cursor(), quarantine_stage, task, attempts, error)
+          # the terminated worker's claim loop is replaced
+          terminated += 1
+          workers_run.append(pool.apply_async(queue_worker, (args,)))
+      time.sleep(deadline_poll)
+    for x in workers_run:
+      if not x.ready():
+        abandon(x)
+    tasks_run = [x.get() for x in workers_run if x.ready()]
+    status = queue_status(conn.cursor(), stage)
+    queue_summary(conn.cursor(), stage, quarantine_stage)
+  finally:
+    conn.close()
+    if manager is not None:
+      manager.shutdown()
+  print("\nProcessed {} queued tasks of {} on {} over {} workers in {:.2f} mins; queue status: {}".format(
+         sum(tasks_run), stage, socket.gethostname(), workers, (time.time() - queue_start)/60,
+         ', '.join('{} {}'.format(n, s) for s, n in sorted(status.items()))))
+  return status
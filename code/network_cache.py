@@ -0,0 +1,117 @@
+# Purpose: Build-once, memory-mapped cache of the pedestrian network graph
+#          -- the CSR network graph (see network_graph.py), its edge geometry and source feature
+#             ids are written as NumPy .npy arrays to a cache directory
+#          -- the cache directory is keyed on a hash of the state of the source feature class (the
+#             sizes and modification times of its own table files in the file geodatabase, and the
+#             content of its row offset file), node precision and cache version, so the graph is
+#             only rebuilt when the network changes, not when other features of the geodatabase do
+#             (source_key; also used to key parcel shards and destination candidate indices)
+#          -- arrays are opened as read-only memory maps, so worker processes share one physical
+#             copy of the graph in the page cache rather than each holding its own
+# Author:  Carl Higgs
+
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+from network_graph import NetworkGraph, read_network_edges, build_graph
+
+# increment if the graph structure (build_graph) changes, to invalidate existing caches
+cache_version = 1
+
+def file_state(path, content = False):
+  ''' Return a description of a file's state (name, size and modification time, in full precision),
+      optionally with a digest of its content.'''
+  stat = os.stat(path)
+  state = '{}|{}|{}'.format(os.path.basename(path), stat.st_size, getattr(stat, 'st_mtime_ns', repr(stat.st_mtime)))
+  if content:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b''):
+        digest.update(block)
+    state += '|{}'.format(digest.hexdigest())
+  return state
+
+def feature_tables(gdb, feature):
+  ''' Return the files of a feature class's own table in a file geodatabase (named aNNNNNNNN.*, after
+      the feature class's object id in the GDB_SystemCatalog table), using GDAL/OGR; or None if
+      these cannot be found (e.g. GDAL is not installed, or the workspace is not a file geodatabase).'''
+  try:
+    from osgeo import gdal
+  except ImportError:
+    return None
+  source = gdal.OpenEx(gdb, gdal.OF_VECTOR, open_options = ['LIST_ALL_TABLES=YES'])
+  catalog = source.GetLayerByName('GDB_SystemCatalog') if source is not None else None
+  if catalog is None:
+    return None
+  name = os.path.basename(feature).lower()
+  for row in catalog:
+    if (row.GetField('Name') or '').lower() == name:
+      prefix = 'a{:08x}.'.format(row.GetFID())
+      return sorted(os.path.join(gdb, x) for x in os.listdir(gdb) if x.lower().startswith(prefix))
+  return None
+
+def feature_digest(gdb, feature):
+  ''' Return a description of a feature class's content using arcpy (row count, maximum object id,
+      extent and fields), where its table files cannot be found.'''
+  import arcpy
+  path = os.path.join(gdb, feature)
+  describe = arcpy.Describe(path)
+  extent = getattr(describe, 'extent', None)
+  max_oid = max([row[0] for row in arcpy.da.SearchCursor(path, ['OID@'])] or [0])
+  return '{}|{}|{}|{}'.format(arcpy.GetCount_management(path).getOutput(0), max_oid,
+                              '' if extent is None else '{!r},{!r},{!r},{!r}'.format(extent.XMin, extent.YMin, extent.XMax, extent.YMax),
+                              ','.join('{}:{}:{}'.format(x.name, x.type, x.length) for x in describe.fields))
+
+def source_key(gdb, feature, tag):
+  ''' Return a hash identifying the current state of a feature class in a file geodatabase, and
+      data derived from it, as described by a tag (e.g. the kind and version of the derived data,
+      and the parameters with which it is built).  The state of the feature class is that of its
+      table files (see feature_tables; its row offset file is hashed, so same size edits within
+      the resolution of file times are detected), or otherwise its content as per feature_digest.'''
+  key = hashlib.sha1()
+  key.update('{}|{}|{}'.format(tag, feature, os.path.abspath(gdb)).encode('utf-8'))
+  tables = feature_tables(gdb, feature)
+  if tables is not None:
+    for path in tables:
+      key.update(file_state(path, content = path.lower().endswith('.gdbtablx')).encode('utf-8'))
+  else:
+    key.update(feature_digest(gdb, feature).encode('utf-8'))
+  return key.hexdigest()
+
+def build_cache(cache_root, gdb, feature, precision = 0.001):
+  ''' Build the network graph cache for a feature class, if not already current, returning its directory.'''
+  cache_dir = os.path.join(cache_root, '{}_{}'.format(feature, source_key(gdb, feature, 'graph{}|{}'.format(cache_version, precision))[:16]))
+  if os.path.isdir(cache_dir):
+    return cache_dir
+  if not os.path.exists(cache_root):
+    os.makedirs(cache_root)
+  edge_coords, edge_fid = read_network_edges(gdb, feature)
+  graph = build_graph(edge_coords, precision)
+  # arrays are written to a temporary directory which is then renamed, so that a partially
+  # written cache is never read
+  build_dir = tempfile.mkdtemp(dir = cache_root)
+  for field in NetworkGraph._fields:
+    np.save(os.path.join(build_dir, '{}.npy'.format(field)), getattr(graph, field))
+  np.save(os.path.join(build_dir, 'edge_fid.npy'), edge_fid)
+  try:
+    os.rename(build_dir, cache_dir)
+  except OSError:
+    # built concurrently by another process
+    shutil.rmtree(build_dir)
+  return cache_dir
+
+def load_graph(cache_dir):
+  ''' Open a cached network graph as read-only memory mapped arrays, returning the graph and
+      source feature ids of its edges.'''
+  graph = NetworkGraph(**dict((field, np.load(os.path.join(cache_dir, '{}.npy'.format(field)), mmap_mode = 'r'))
+                              for field in NetworkGraph._fields))
+  edge_fid = np.load(os.path.join(cache_dir, 'edge_fid.npy'), mmap_mode = 'r')
+  return graph, edge_fid
+
+def cached_graph(cache_root, gdb, feature, precision = 0.001):
+  ''' Return the network graph and edge feature ids for a feature class, from the cache
+      (building the cache first where the network has changed).'''
+  return load_graph(build_cache(cache_root, gdb, feature, precision))
@@ -0,0 +1,248 @@
+# Purpose: Contraction hierarchy over the CSR network graph, for repeated distance queries
+#          on a static pedestrian network (see network_graph.py)
+#          -- nodes are contracted in order of importance (edge difference plus the number of
+#             contracted neighbours, with lazy updates), adding shortcuts where no witness path
+#             is found by a bounded local search
+#          -- the resulting upward graph (arcs to higher ranked nodes) is stored along with the
+#             arcs ordered by level for a PHAST style sweep, and persisted as a NumPy .npz file
+#          -- PHAST one-to-all (or multi-source, nearest labelled source) query: an upward search
+#             from the sources followed by a linear downward sweep, level by level, in NumPy
+#          -- bucket based many-to-many query: upward searches from each target fill node buckets,
+#             which are then scanned by upward searches from each source
+#
+#          Queries are in terms of network nodes; as per network_graph.nearest_source(), points
+#          located along edges are seeded from both edge ends with an initial distance, and direct
+#          paths between points on the same edge are checked by the caller
+#          (e.g. network_graph.locate_nearest()).
+# Author:  Carl Higgs
+
+import heapq
+import collections
+import numpy as np
+
+# contraction hierarchy, as NumPy arrays
+#   rank                        : contraction order of each node (higher is more important)
+#   up_indptr, up_indices, up_weights : CSR upward graph (arcs from each node to higher ranked nodes)
+#   sweep_src, sweep_dst, sweep_w     : downward sweep arcs (dst is higher ranked than src), ordered by
+#                                       level of src; arcs of level l are sweep_ptr[l] to sweep_ptr[l+1]
+#   sweep_ptr                   : sweep level offsets
+#   signature                   : node count, arc count and total arc length of the source graph
+ContractionHierarchy = collections.namedtuple('ContractionHierarchy', ['rank',
+                                                                       'up_indptr', 'up_indices', 'up_weights',
+                                                                       'sweep_src', 'sweep_dst', 'sweep_w', 'sweep_ptr',
+                                                                       'signature'])
+
+def graph_signature(graph):
+  ''' Return a summary of a network graph, used to check a hierarchy was built from the same graph.'''
+  return np.array([len(graph.indptr) - 1, len(graph.indices), graph.weights.sum()], dtype = float)
+
+def witness_search(adj, source, avoid, limit, settle_limit):
+  ''' Bounded Dijkstra search over the remaining (uncontracted) graph, avoiding one node.
+      Returns a dictionary of node: distance for nodes settled within the limits.'''
+  best = {source: 0}
+  settled = {}
+  heap = [(0, source)]
+  while heap and len(settled) < settle_limit:
+    d, u = heapq.heappop(heap)
+    if u in settled:
+      continue
+    if d > limit:
+      break
+    settled[u] = d
+    for v, w in adj[u].items():
+      dv = d + w
+      if v != avoid and dv < best.get(v, float('inf')):
+        best[v] = dv
+        heapq.heappush(heap, (dv, v))
+  return settled
+
+def node_shortcuts(adj, v, settle_limit):
+  ''' Return the (u, w, distance) shortcuts required to contract node v, for each pair of its
+      neighbours not connected by a witness path of no greater length.'''
+  neighbours = list(adj[v].items())
+  shortcuts = []
+  for i, (u, du) in enumerate(neighbours):
+    targets = dict((w, du + dw) for w, dw in neighbours[i+1:])
+    if len(targets) == 0:
+      continue
+    witness = witness_search(adj, u, v, max(targets.values()), settle_limit)
+    for w, d in targets.items():
+      if witness.get(w, float('inf')) > d:
+        shortcuts.append((u, w, d))
+  return shortcuts
+
+def build_ch(graph, settle_limit = 200):
+  ''' Build a contraction hierarchy for a (symmetric) CSR network graph.'''
+  node_count = len(graph.indptr) - 1
+  indptr   = graph.indptr
+  indices  = graph.indices
+  weights  = graph.weights
+  inf      = float('inf')
+
+  # the remaining graph is held as adjacency dictionaries (parallel arcs reduced to the shortest)
+  adj = [dict() for u in range(node_count)]
+  for u in range(node_count):
+    for v, w in zip(indices[indptr[u]:indptr[u+1]].tolist(), weights[indptr[u]:indptr[u+1]].tolist()):
+      if v != u and w < adj[u].get(v, inf):
+        adj[u][v] = w
+
+  contracted_neighbours = [0]*node_count
+  rank = np.full(node_count, -1, dtype = np.int64)
+  up   = [None]*node_count
+  heap = [(len(node_shortcuts(adj, v, settle_limit)) - len(adj[v]), v) for v in range(node_count)]
+  heapq.heapify(heap)
+  order = 0
+  while heap:
+    priority, v = heapq.heappop(heap)
+    if rank[v] >= 0:
+      continue
+    # lazy update: contract if still the least important node, else re-queue
+    shortcuts = node_shortcuts(adj, v, settle_limit)
+    priority = len(shortcuts) - len(adj[v]) + contracted_neighbours[v]
+    if heap and priority > heap[0][0]:
+      heapq.heappush(heap, (priority, v))
+      continue
+    for u, w, d in shortcuts:
+      if d < adj[u].get(w, inf):
+        adj[u][w] = d
+        adj[w][u] = d
+    up[v] = list(adj[v].items())
+    for u in adj[v]:
+      del adj[u][v]
+      contracted_neighbours[u] += 1
+    adj[v] = {}
+    rank[v] = order
+    order += 1
+
+  # upward graph
+  up_indptr = np.zeros(node_count + 1, dtype = np.int64)
+  up_indptr[1:] = np.cumsum([len(arcs) for arcs in up])
+  up_indices = np.array([u for arcs in up for u, w in arcs], dtype = np.int64)
+  up_weights = np.array([w for arcs in up for u, w in arcs], dtype = float)
+
+  # a node's level exceeds that of all its upward neighbours, so that the downward sweep may
+  # process all nodes of a level at once
+  level = np.zeros(node_count, dtype = np.int64)
+  for v in np.argsort(-rank).tolist():
+    if len(up[v]) > 0:
+      level[v] = 1 + max(level[u] for u, w in up[v])
+  src = np.repeat(np.arange(node_count, dtype = np.int64), np.diff(up_indptr))
+  sweep = np.lexsort((src, level[src]))
+  sweep_ptr = np.zeros(level.max() + 2, dtype = np.int64)
+  sweep_ptr[1:] = np.cumsum(np.bincount(level[src], minlength = level.max() + 1))
+  return ContractionHierarchy(rank = rank,
+                              up_indptr = up_indptr,
+                              up_indices = up_indices,
+                              up_weights = up_weights,
+                              sweep_src = src[sweep],
+                              sweep_dst = up_indices[sweep],
+                              sweep_w = up_weights[sweep],
+                              sweep_ptr = sweep_ptr,
+                              signature = graph_signature(graph))
+
+def save_ch(filename, ch):
+  ''' Save a contraction hierarchy to a NumPy .npz file.'''
+  np.savez(filename, **ch._asdict())
+
+def load_ch(filename, graph = None):
+  ''' Load a contraction hierarchy from a NumPy .npz file; if a graph is given, check the
+      hierarchy was built from it.'''
+  data = np.load(filename)
+  ch = ContractionHierarchy(**dict((field, data[field]) for field in ContractionHierarchy._fields))
+  if graph is not None and not np.allclose(ch.signature, graph_signature(graph)):
+    raise ValueError('Contraction hierarchy {} does not match the network graph; please rebuild it'.format(filename))
+  return ch
+
+def upward_search(ch, seeds):
+  ''' Dijkstra search over the upward graph from seed (node, distance) pairs.
+      Returns a dictionary of node: distance for the whole upward search space.'''
+  indptr  = ch.up_indptr
+  indices = ch.up_indices
+  weights = ch.up_weights
+  best    = {}
+  settled = {}
+  heap = []
+  for node, d in seeds:
+    if node >= 0 and d < best.get(node, float('inf')):
+      best[node] = d
+      heap.append((d, node))
+  heapq.heapify(heap)
+  while heap:
+    d, u = heapq.heappop(heap)
+    if u in settled:
+      continue
+    settled[u] = d
+    a = indptr[u]
+    b = indptr[u+1]
+    for v, w in zip(indices[a:b].tolist(), weights[a:b].tolist()):
+      dv = d + w
+      if dv < best.get(v, float('inf')):
+        best[v] = dv
+        heapq.heappush(heap, (dv, v))
+  return settled
+
+def phast(ch, seeds):
+  ''' PHAST one-to-all query, seeded from every (node, distance, label) source at once.
+      As per network_graph.nearest_source(), returns arrays of the distance to (inf where
+      unreachable) and label of (-1 where unreachable) the nearest source for every node.'''
+  node_count = len(ch.rank)
+  dist  = np.full(node_count, np.inf)
+  label = np.full(node_count, -1, dtype = np.int64)
+  # upward search from all sources, tracking labels
+  indptr  = ch.up_indptr
+  indices = ch.up_indices
+  weights = ch.up_weights
+  settled = np.zeros(node_count, dtype = bool)
+  heap = []
+  for node, d, source in seeds:
+    if node >= 0 and d < dist[node]:
+      dist[node]  = d
+      label[node] = source
+      heap.append((d, node))
+  heapq.heapify(heap)
+  while heap:
+    d, u = heapq.heappop(heap)
+    if settled[u]:
+      continue
+    settled[u] = True
+    a = indptr[u]
+    b = indptr[u+1]
+    for v, w in zip(indices[a:b].tolist(), weights[a:b].tolist()):
+      dv = d + w
+      if dv < dist[v]:
+        dist[v]  = dv
+        label[v] = label[u]
+        heapq.heappush(heap, (dv, v))
+  # downward sweep, from the highest level; each level only depends on those above it
+  for l in range(1, len(ch.sweep_ptr) - 1):
+    a = ch.sweep_ptr[l]
+    b = ch.sweep_ptr[l+1]
+    src  = ch.sweep_src[a:b]
+    dst  = ch.sweep_dst[a:b]
+    cand = dist[dst] + ch.sweep_w[a:b]
+    # closest candidate for each node of this level
+    order = np.lexsort((cand, src))
+    first = np.concatenate([[True], src[order][1:] != src[order][:-1]])
+    order = order[first]
+    better = cand[order] < dist[src[order]]
+    order = order[better]
+    dist[src[order]]  = cand[order]
+    label[src[order]] = label[dst[order]]
+  return dist, label
+
+def many_to_many(ch, sources, targets):
+  ''' Bucket based many-to-many query, for lists of sources and targets each given as a list of
+      (node, distance) seeds (e.g. network_graph.location_seeds()).
+      Returns an array of distances (inf where unreachable) of shape (sources, targets).'''
+  buckets = {}
+  for j, seeds in enumerate(targets):
+    for node, d in upward_search(ch, seeds).items():
+      buckets.setdefault(node, []).append((j, d))
+  result = np.full((len(sources), len(targets)), np.inf)
+  for i, seeds in enumerate(sources):
+    row = result[i]
+    for node, d in upward_search(ch, seeds).items():
+      for j, dt in buckets.get(node, []):
+        if d + dt < row[j]:
+          row[j] = d + dt
+  return result
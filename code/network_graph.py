@@ -0,0 +1,414 @@
+# Purpose: Pure-Python network analysis engine used in place of ArcGIS Network Analyst
+#          -- builds a compressed sparse row (CSR) graph from the pedestrian road edges
+#             (NumPy arrays of node offsets, arc targets and arc lengths)
+#          -- points are located on the network as an edge and offset along that edge
+#             (see network_snap.py)
+#          -- finds closest destinations along the network using a heap based Dijkstra search,
+#             either from each origin, or from all destinations of a type at once (closest facility)
+#          -- finds all nodes within a distance of an origin using a bounded Dijkstra search
+#             (e.g. to count destinations within network distance cutoffs)
+#          -- returns the (full and partial) edges reachable within a distance, along with
+#             their geometry (e.g. for construction of sausage buffers)
+#          -- labels connected components of the network (so that points located on islands
+#             disconnected from the main network may be excluded before solving)
+#
+#          The network edges are read from the file geodatabase using the GDAL/OGR
+#          OpenFileGDB driver, so no ArcGIS licence is required (runs on a plain Linux box).
+#          Edge end points are merged into nodes where they coincide to within 'precision'
+#          (1 mm by default, as per the ST_SnapToGrid tolerance used elsewhere).
+# Author:  Carl Higgs
+
+import heapq
+import collections
+import numpy as np
+
+# the graph is stored as a tuple of NumPy arrays so that it may be pickled / shared with workers
+#   node_x, node_y : node coordinates
+#   indptr         : CSR offsets; arcs leaving node n are indptr[n] to indptr[n+1]
+#   indices        : arc target node
+#   weights        : arc length (metres)
+#   arc_edge       : edge index of arc (each edge is traversable in both directions)
+#   edge_u, edge_v : edge start and end node
+#   edge_length    : edge length (metres)
+#   vertex_ptr     : edge geometry offsets; vertices of edge e are vertex_ptr[e] to vertex_ptr[e+1]
+#   vertex_x, vertex_y : edge geometry vertex coordinates (ordered from edge_u to edge_v)
+NetworkGraph = collections.namedtuple('NetworkGraph', ['node_x', 'node_y',
+                                                       'indptr', 'indices', 'weights', 'arc_edge',
+                                                       'edge_u', 'edge_v', 'edge_length',
+                                                       'vertex_ptr', 'vertex_x', 'vertex_y'])
+
+def read_network_edges(gdb, feature):
+  ''' Read line features from a file geodatabase using OGR, returning a list of
+      (n,2) coordinate arrays (one per line part) and an array of source feature ids.'''
+  from osgeo import ogr
+  source = ogr.Open(gdb)
+  if source is None:
+    raise IOError('Unable to open {} using OGR'.format(gdb))
+  layer = source.GetLayerByName(feature)
+  if layer is None:
+    raise IOError('Feature {} not found in {}'.format(feature, gdb))
+  edge_coords = []
+  edge_fid = []
+  for f in layer:
+    geom = f.GetGeometryRef()
+    if geom is None:
+      continue
+    # multipart features are split in to their component lines
+    if geom.GetGeometryCount() > 0:
+      parts = [geom.GetGeometryRef(i) for i in range(geom.GetGeometryCount())]
+    else:
+      parts = [geom]
+    for part in parts:
+      coords = np.array(part.GetPoints(), dtype = float)
+      if len(coords) < 2:
+        continue
+      edge_coords.append(coords[:,:2])
+      edge_fid.append(f.GetFID())
+  return edge_coords, np.array(edge_fid, dtype = np.int64)
+
+def read_point_features(gdb, feature, fields):
+  ''' Read point features from a file geodatabase using OGR, returning a list of
+      attribute value lists (one per field) and x and y coordinate arrays.'''
+  from osgeo import ogr
+  source = ogr.Open(gdb)
+  if source is None:
+    raise IOError('Unable to open {} using OGR'.format(gdb))
+  layer = source.GetLayerByName(feature)
+  if layer is None:
+    raise IOError('Feature {} not found in {}'.format(feature, gdb))
+  values = [[] for field in fields]
+  x = []
+  y = []
+  for f in layer:
+    geom = f.GetGeometryRef()
+    if geom is None:
+      continue
+    for i, field in enumerate(fields):
+      values[i].append(f.GetField(field))
+    x.append(geom.GetX())
+    y.append(geom.GetY())
+  return values, np.array(x, dtype = float), np.array(y, dtype = float)
+
+def build_graph(edge_coords, precision = 0.001):
+  ''' Build a CSR network graph from a list of (n,2) line coordinate arrays.
+      Line end points within 'precision' of each other are treated as the same node.'''
+  start_xy = np.array([c[0]  for c in edge_coords], dtype = float)
+  end_xy   = np.array([c[-1] for c in edge_coords], dtype = float)
+  edge_length = np.array([np.sqrt((np.diff(c, axis = 0)**2).sum(axis = 1)).sum() for c in edge_coords])
+
+  # merge coincident end points in to nodes
+  keys = np.round(np.vstack([start_xy, end_xy])/precision).astype(np.int64)
+  node_keys, inverse = np.unique(keys, axis = 0, return_inverse = True)
+  inverse = inverse.ravel()
+  edge_count = len(edge_coords)
+  edge_u = inverse[:edge_count]
+  edge_v = inverse[edge_count:]
+  node_count = len(node_keys)
+  node_xy = np.zeros((node_count,2))
+  node_xy[edge_u] = start_xy
+  node_xy[edge_v] = end_xy
+
+  # each edge is traversable in both directions
+  edge_index = np.arange(edge_count, dtype = np.int64)
+  arc_from   = np.concatenate([edge_u, edge_v])
+  arc_to     = np.concatenate([edge_v, edge_u])
+  arc_edge   = np.concatenate([edge_index, edge_index])
+  order      = np.argsort(arc_from, kind = 'mergesort')
+  indptr     = np.zeros(node_count + 1, dtype = np.int64)
+  indptr[1:] = np.cumsum(np.bincount(arc_from, minlength = node_count))
+
+  # edge geometry is retained as flat vertex arrays
+  vertex_ptr     = np.zeros(edge_count + 1, dtype = np.int64)
+  vertex_ptr[1:] = np.cumsum([len(c) for c in edge_coords])
+  vertex_xy      = np.vstack(edge_coords)
+  return NetworkGraph(node_x = node_xy[:,0],
+                      node_y = node_xy[:,1],
+                      indptr = indptr,
+                      indices = arc_to[order],
+                      weights = edge_length[arc_edge[order]],
+                      arc_edge = arc_edge[order],
+                      edge_u = edge_u,
+                      edge_v = edge_v,
+                      edge_length = edge_length,
+                      vertex_ptr = vertex_ptr,
+                      vertex_x = vertex_xy[:,0],
+                      vertex_y = vertex_xy[:,1])
+
+# a lookup of targets (e.g. destinations) located on the network
+#   by_node : node: list of (label, distance from node to target) for targets on edges incident to node
+#   by_edge : edge: list of (label, offset) for targets located on edge
+TargetIndex = collections.namedtuple('TargetIndex', ['by_node', 'by_edge'])
+
+def location_seeds(graph, edge, offset):
+  ''' Return search seed (node, distance) pairs for a location on the network, given as an
+      edge and offset (distance along the edge geometry from its start node).
+      No seeds are returned for unlocated points (edge < 0).'''
+  if edge < 0:
+    return []
+  edge = int(edge)
+  return [(int(graph.edge_u[edge]), float(offset)),
+          (int(graph.edge_v[edge]), float(graph.edge_length[edge] - offset))]
+
+def index_targets(graph, edges, offsets, labels):
+  ''' Create a lookup of targets located on the network at the given edges and offsets
+      (e.g. labels of (destination type, object id) tuples).  Unlocated targets are ignored.'''
+  by_node = {}
+  by_edge = {}
+  for edge, offset, label in zip(edges, offsets, labels):
+    if edge < 0:
+      continue
+    for node, d in location_seeds(graph, edge, offset):
+      by_node.setdefault(node, []).append((label, d))
+    by_edge.setdefault(int(edge), []).append((label, float(offset)))
+  return TargetIndex(by_node, by_edge)
+
+def closest_by_type(graph, origin, targets, wanted, limit = None):
+  ''' Heap based Dijkstra search from an origin (edge, offset) location, continuing until the
+      closest target of each wanted type has been found (or the network, or an optional
+      distance limit, is exhausted).
+      'targets' is a TargetIndex of (type, id) labels, as per index_targets().
+      Returns a dictionary of type: (id, distance) for each type found.'''
+  indptr   = graph.indptr
+  indices  = graph.indices
+  weights  = graph.weights
+  wanted   = set(wanted)
+  found    = {}
+  best     = {}
+  settled  = set()
+  # targets are added to the heap as they are reached, coded as negative node numbers;
+  # a target is the closest of its type once it is popped from the heap
+  reached  = []
+  heap = []
+  edge, offset = origin
+  for node, d in location_seeds(graph, edge, offset):
+    if d < best.get(node, float('inf')):
+      best[node] = d
+      heap.append((d, node))
+  for label, target_offset in targets.by_edge.get(int(edge), []):
+    if label[0] in wanted:
+      reached.append(label)
+      heap.append((abs(target_offset - offset), -len(reached)))
+  heapq.heapify(heap)
+  while heap and wanted:
+    d, u = heapq.heappop(heap)
+    if limit is not None and d > limit:
+      break
+    if u < 0:
+      kind, id = reached[-u-1]
+      if kind in wanted:
+        found[kind] = (id, d)
+        wanted.discard(kind)
+      continue
+    if u in settled:
+      continue
+    settled.add(u)
+    for label, extra in targets.by_node.get(u, []):
+      if label[0] in wanted:
+        reached.append(label)
+        heapq.heappush(heap, (d + extra, -len(reached)))
+    a = indptr[u]
+    b = indptr[u+1]
+    for v, w in zip(indices[a:b].tolist(), weights[a:b].tolist()):
+      dv = d + w
+      if dv < best.get(v, float('inf')):
+        best[v] = dv
+        heapq.heappush(heap, (dv, v))
+  return found
+
+def nearest_source(graph, seeds):
+  ''' Multi-source heap based Dijkstra search, seeded from every (node, distance, label)
+      source at once (e.g. all destinations of a given type).  Every network node reachable
+      from a source is labelled with its nearest source and the distance to it.
+      Returns arrays of distance (inf where unreachable) and label (-1 where unreachable).'''
+  indptr   = graph.indptr
+  indices  = graph.indices
+  weights  = graph.weights
+  inf      = float('inf')
+  node_count = len(indptr) - 1
+  dist     = [inf]*node_count
+  label    = [-1]*node_count
+  settled  = [False]*node_count
+  heap = []
+  for node, d, source in seeds:
+    if node >= 0 and d < dist[node]:
+      dist[node]  = d
+      label[node] = source
+      heap.append((d, node))
+  heapq.heapify(heap)
+  while heap:
+    d, u = heapq.heappop(heap)
+    if settled[u]:
+      continue
+    settled[u] = True
+    source = label[u]
+    a = indptr[u]
+    b = indptr[u+1]
+    for v, w in zip(indices[a:b].tolist(), weights[a:b].tolist()):
+      dv = d + w
+      if dv < dist[v]:
+        dist[v]  = dv
+        label[v] = source
+        heapq.heappush(heap, (dv, v))
+  return np.array(dist), np.array(label, dtype = np.int64)
+
+def source_seeds(targets):
+  ''' Return multi-source search seed (node, distance, label) tuples for a TargetIndex.'''
+  return [(node, d, label) for node, items in targets.by_node.items() for label, d in items]
+
+def locate_nearest(graph, node_distance, node_label, edges, offsets, sources = None):
+  ''' Return the distance to, and label of, the nearest source for locations given by edge and
+      offset, from the node results of nearest_source().  Optionally, a TargetIndex of the sources
+      allows for sources located on the same edge as a location to be reached directly.
+      Distance is inf and label -1 for unlocated or unreachable locations.'''
+  edges    = np.asarray(edges, dtype = np.int64)
+  offsets  = np.asarray(offsets, dtype = float)
+  distance = np.full(len(edges), np.inf)
+  label    = np.full(len(edges), -1, dtype = np.int64)
+  located  = np.flatnonzero(edges >= 0)
+  e  = edges[located]
+  u  = graph.edge_u[e]
+  v  = graph.edge_v[e]
+  du = node_distance[u] + offsets[located]
+  dv = node_distance[v] + graph.edge_length[e] - offsets[located]
+  use_v = dv < du
+  distance[located] = np.where(use_v, dv, du)
+  label[located]    = np.where(use_v, node_label[v], node_label[u])
+  if sources is not None:
+    for i in located:
+      for source, source_offset in sources.by_edge.get(int(edges[i]), []):
+        d = abs(source_offset - offsets[i])
+        if d < distance[i]:
+          distance[i] = d
+          label[i]    = source
+  return distance, label
+
+def within_distance(graph, seeds, limit):
+  ''' Bounded heap based Dijkstra search from seed (node, distance) pairs.
+      Returns a dictionary of node: distance for all nodes within the distance limit.'''
+  indptr   = graph.indptr
+  indices  = graph.indices
+  weights  = graph.weights
+  best     = {}
+  settled  = {}
+  heap = []
+  for node, d in seeds:
+    if node >= 0 and d <= limit and d < best.get(node, float('inf')):
+      best[node] = d
+      heap.append((d, node))
+  heapq.heapify(heap)
+  while heap:
+    d, u = heapq.heappop(heap)
+    if u in settled:
+      continue
+    settled[u] = d
+    a = indptr[u]
+    b = indptr[u+1]
+    for v, w in zip(indices[a:b].tolist(), weights[a:b].tolist()):
+      dv = d + w
+      if dv <= limit and dv < best.get(v, float('inf')):
+        best[v] = dv
+        heapq.heappush(heap, (dv, v))
+  return settled
+
+def targets_within(graph, origin, targets, limit):
+  ''' Return a dictionary of label: distance for all targets (a TargetIndex) within the distance
+      limit of an origin (edge, offset) location, using a bounded network search.'''
+  edge, offset = origin
+  result = {}
+  for label, target_offset in targets.by_edge.get(int(edge), []):
+    d = abs(target_offset - offset)
+    if d <= limit:
+      result[label] = d
+  for node, d in within_distance(graph, location_seeds(graph, edge, offset), limit).items():
+    for label, extra in targets.by_node.get(node, []):
+      d_label = d + extra
+      if d_label <= limit and d_label < result.get(label, float('inf')):
+        result[label] = d_label
+  return result
+
+def reachable_edge_parts(graph, origin, limit):
+  ''' Return the parts of edges reachable within the distance limit of an origin (edge, offset)
+      location, as a list of (edge, start, end) tuples, where start and end are distances along
+      the edge geometry.  Edges are returned whole where fully reachable; edges at the frontier
+      of the search are returned as partial edges (reachable from either or both ends).
+      Parts may overlap (e.g. on the origin edge).'''
+  indptr   = graph.indptr
+  arc_edge = graph.arc_edge
+  edge_u   = graph.edge_u
+  edge_v   = graph.edge_v
+  length   = graph.edge_length
+  edge, offset = origin
+  if edge < 0:
+    return []
+  # the origin edge is directly reachable in both directions from the origin
+  parts = [(int(edge), max(0, offset - limit), min(length[edge], offset + limit))]
+  # remaining distance available to travel along edges leaving each end
+  from_u = {}
+  from_v = {}
+  for u, d in within_distance(graph, location_seeds(graph, edge, offset), limit).items():
+    remaining = limit - d
+    a = indptr[u]
+    b = indptr[u+1]
+    for e in arc_edge[a:b].tolist():
+      if edge_u[e] == u:
+        from_u[e] = max(from_u.get(e, 0), remaining)
+      if edge_v[e] == u:
+        from_v[e] = max(from_v.get(e, 0), remaining)
+  for e in set(from_u).union(from_v):
+    cover_u = from_u.get(e, 0)
+    cover_v = from_v.get(e, 0)
+    if cover_u + cover_v >= length[e]:
+      parts.append((e, 0, length[e]))
+    else:
+      if cover_u > 0:
+        parts.append((e, 0, cover_u))
+      if cover_v > 0:
+        parts.append((e, length[e] - cover_v, length[e]))
+  return parts
+
+def connected_components(graph):
+  ''' Label the connected components of the network graph using union-find over its edges.
+      Returns an array of component number for each node, numbered in decreasing order of
+      node count (so that component 0 is the main network).'''
+  node_count = len(graph.indptr) - 1
+  parent = list(range(node_count))
+  size   = [1]*node_count
+  for u, v in zip(graph.edge_u.tolist(), graph.edge_v.tolist()):
+    # find roots, halving paths as we go
+    while parent[u] != u:
+      parent[u] = parent[parent[u]]
+      u = parent[u]
+    while parent[v] != v:
+      parent[v] = parent[parent[v]]
+      v = parent[v]
+    if u == v:
+      continue
+    # union by size
+    if size[u] < size[v]:
+      u, v = v, u
+    parent[v] = u
+    size[u] += size[v]
+  root = np.array(parent, dtype = np.int64)
+  while True:
+    grandparent = root[root]
+    if (grandparent == root).all():
+      break
+    root = grandparent
+  roots, inverse, counts = np.unique(root, return_inverse = True, return_counts = True)
+  rank = np.empty(len(roots), dtype = np.int64)
+  rank[np.argsort(-counts, kind = 'mergesort')] = np.arange(len(roots))
+  return rank[inverse.ravel()]
+
+def edge_part_coords(graph, edge, start, end):
+  ''' Return the (n,2) coordinates of the part of an edge between distances start and end
+      along its geometry.'''
+  a = graph.vertex_ptr[edge]
+  b = graph.vertex_ptr[edge+1]
+  xy = np.column_stack([graph.vertex_x[a:b], graph.vertex_y[a:b]])
+  measure = np.concatenate([[0], np.cumsum(np.sqrt((np.diff(xy, axis = 0)**2).sum(axis = 1)))])
+  if start <= 0 and end >= measure[-1]:
+    return xy
+  inner = (measure > start) & (measure < end)
+  return np.vstack([[np.interp(start, measure, xy[:,0]), np.interp(start, measure, xy[:,1])],
+                    xy[inner],
+                    [np.interp(end, measure, xy[:,0]), np.interp(end, measure, xy[:,1])]])
@@ -0,0 +1,180 @@
+# Purpose: Long-lived local worker service for the open source network stages (16b, 17b, 18b)
+#          -- loads the pedestrian network graph (network_cache.py) and parcel and destination
+#             locations on the network (network_snaps; see 15b_snap_points_to_network.py) once,
+#             along with each stage's worker state (e.g. destination indices, contraction hierarchy)
+#          -- forks a pool of workers, and result writer processes (result_writer.py), which
+#             inherit this state and are kept running between stages
+#          -- accepts stage jobs over a Unix socket (multiprocessing.connection), running these one
+#             after another, so that a rebuild of all network indicators pays the cost of loading
+#             the network and starting workers once
+#          As workers inherit state by forking, the service is not available on Windows.
+#          Usage:
+#            python network_service.py          start the service (set service_address in the
+#                                               [parallel] section of config.ini)
+#            python network_service.py stop     stop the service, once any running stage completes
+#          While the service is running, stages 16b, 17b and 18b submit their work to it rather
+#          than loading the network themselves.  Restart the service if the network or point
+#          locations change (e.g. 15b_snap_points_to_network.py is re-run).
+# Author:  Carl Higgs
+
+import os
+import sys
+import time
+import importlib
+import multiprocessing
+import psycopg2
+from multiprocessing.connection import Listener, Client
+
+from network_cache import cached_graph
+from network_snap import read_snaps, check_snaps
+from hex_scheduler import pool_size
+from result_writer import start_writers, stop_writers
+from ConfigParser import SafeConfigParser
+
+parser = SafeConfigParser()
+parser.read(os.path.join(sys.path[0],'config.ini'))
+
+# stage scripts which may be run by the service
+service_stages = ['16b_createsausagebuffer_csr', '17b_createodmatrix_csr_closestab', '18b_createodmatrix_csr_count_in_buffer']
+
+# loaded stage modules (in the service, and so in its forked workers)
+stage_modules = {}
+
+def service_address():
+  ''' Return the configured service address (Unix socket file, relative to folderPath), or None
+      if stages are not to be run by a service.'''
+  address = parser.get('parallel', 'service_address').strip()
+  if address == '' or sys.platform == 'win32':
+    return None
+  return os.path.join(parser.get('data', 'folderPath'), address)
+
+def service_authkey():
+  ''' Return the key authenticating connections to the service (the project database password).'''
+  return parser.get('postgresql', 'password').encode('utf-8')
+
+def load_network(connect, graph_cache, gdb, network_edges, destinations = True):
+  ''' Load the network graph and the locations of parcels (and optionally destinations) on it.
+      Returns a dictionary of graph, edge_fid, and parcel and destination (id, hex, edge, offset) arrays.'''
+  print("Loading network graph for {} (building cache if required)... ".format(network_edges)),
+  graph, edge_fid = cached_graph(graph_cache, gdb, network_edges)
+  print("Done ({} nodes, {} edges).".format(len(graph.node_x), len(graph.edge_u)))
+
+  print("Reading parcel{} locations on network... ".format(' and destination' if destinations else '')),
+  conn = psycopg2.connect(**connect)
+  curs = conn.cursor()
+  network = dict(graph = graph, edge_fid = edge_fid, parcel = read_snaps(curs, 'parcel'))
+  check_snaps(graph, network['parcel'][2])
+  if destinations:
+    network['destination'] = read_snaps(curs, 'destination')
+    check_snaps(graph, network['destination'][2])
+  conn.close()
+  print("Done ({} parcels{} located).".format(len(network['parcel'][0]),
+        ', {} destinations'.format(len(network['destination'][0])) if destinations else ''))
+  return network
+
+def service_worker_init(queues):
+  ''' Pool initializer for service workers: initialise the worker of each stage.'''
+  for module in stage_modules.values():
+    module.worker_init(queues)
+
+def submit_stage(script):
+  ''' Run a stage by the service, if it is running.  Returns the stage result, or None if
+      the service is not configured or not running (in which case the stage should be run locally).'''
+  address = service_address()
+  if address is None:
+    return None
+  try:
+    conn = Client(address, authkey = service_authkey())
+  except (IOError, OSError):
+    print("Network service not running at {}; running stage locally.".format(address))
+    return None
+  print("Submitting {} to network service at {}... ".format(script, address))
+  conn.send(('run', os.path.splitext(os.path.basename(script))[0]))
+  status, result = conn.recv()
+  conn.close()
+  if status != 'done':
+    raise Exception("Network service failed to run {}: {}".format(script, result))
+  print("Completed by network service: {}".format(result))
+  return result
+
+def run_job(name, pool, queues, writers):
+  ''' Run a stage in the service, as if its script were run.'''
+  module = stage_modules[name]
+  module.start  = time.time()
+  module.script = '{}.py'.format(name)
+  return module.run_stage(pool, queues, writers)
+
+def serve():
+  ''' Load the network and stage state, start workers and writers, and run stage jobs until stopped.'''
+  address = service_address()
+  if address is None:
+    sys.exit("Set service_address in the [parallel] section of config.ini to run the network service.")
+  if os.path.exists(address):
+    os.remove(address)
+  service_start = time.time()
+  connect = dict(database = parser.get('postgresql', 'database'),
+                 user     = parser.get('postgresql', 'user'),
+                 password = parser.get('postgresql', 'password'))
+  network = load_network(connect,
+                         os.path.join(parser.get('data', 'folderPath'), parser.get('network', 'graph_cache')),
+                         os.path.join(parser.get('data', 'folderPath'), parser.get('data', 'workspace')),
+                         parser.get('roads', 'pedestrian_road_edges'))
+  for name in service_stages:
+    module = importlib.import_module(name)
+    module.stage_state(network)
+    stage_modules[name] = module
+
+  # workers are forked once the network and stage state are loaded, and so inherit these
+  workers = pool_size(parser.get('parallel', 'workers'))
+  queues, writers = start_writers(connect,
+                                  writers    = parser.get('parallel', 'writers'),
+                                  batch_rows = parser.get('parallel', 'write_batch_rows'),
+                                  batch_secs = parser.get('parallel', 'write_batch_secs'))
+  pool = multiprocessing.Pool(workers, initializer = service_worker_init, initargs = (queues,))
+  listener = Listener(address, authkey = service_authkey())
+  print("Network service ready at {} ({} workers; started in {:.2f} mins)".format(address, workers, (time.time() - service_start)/60))
+
+  jobs = 0
+  try:
+    while True:
+      conn = listener.accept()
+      command = conn.recv()
+      if command[0] == 'stop':
+        conn.send(('done', 'stopped after {} stage jobs'.format(jobs)))
+        conn.close()
+        break
+      name = command[1]
+      if name not in stage_modules:
+        conn.send(('error', 'not a service stage: {}'.format(name)))
+        conn.close()
+        continue
+      job_start = time.time()
+      print("\nRunning {} at {}".format(name, time.strftime("%Y%m%d-%H%M%S")))
+      try:
+        result = run_job(name, pool, queues, writers)
+        conn.send(('done', '{} in {:.2f} mins{}'.format(name, (time.time() - job_start)/60,
+                                                        '; {}'.format(result) if result is not None else '')))
+      except:
+        print("ERROR: {}: {}".format(name, sys.exc_info()))
+        conn.send(('error', str(sys.exc_info()[1])))
+      conn.close()
+      jobs += 1
+  finally:
+    listener.close()
+    pool.close()
+    pool.join()
+    stop_writers(queues, writers)
+  print("Network service stopped after {} stage jobs ({:.2f} mins).".format(jobs, (time.time() - service_start)/60))
+
+def stop_service():
+  ''' Request the running service to stop.'''
+  conn = Client(service_address(), authkey = service_authkey())
+  conn.send(('stop',))
+  print(conn.recv()[1])
+  conn.close()
+
+if __name__ == '__main__':
+  if len(sys.argv) > 1 and sys.argv[1] == 'stop':
+    stop_service()
+  else:
+    serve()
@@ -0,0 +1,211 @@
+# Purpose: Spatial snapping index, locating points on the pedestrian network
+#          -- points are located at their closest position along a network edge (not merely at
+#             the closest node), as an edge index and offset (distance along the edge geometry
+#             from its start node), along with the point's distance from the network
+#          -- edge geometry is split in to short segments whose midpoints are held in a k-d tree;
+#             candidate segments are queried for all points at once, and exact point to segment
+#             projections are calculated in vectorised NumPy operations
+#          -- locations are stored once in the network_snaps table (see 15b_snap_points_to_network.py)
+#             so that all network stages re-use the same parcel and destination locations,
+#             rather than each stage re-snapping points independently
+#          -- the network component of each location is stored, so that points located on
+#             islands disconnected from the main network (component 0) are excluded before solving,
+#             and reported in the network_disconnected_points diagnostics table
+# Author:  Carl Higgs
+
+import io
+import collections
+import numpy as np
+from scipy.spatial import cKDTree
+
+# straight line segments of the network edge geometry (split to no longer than max_length)
+#   x0, y0, x1, y1 : segment start and end coordinates
+#   edge           : edge index of segment
+#   measure        : offset along the edge geometry of the segment start
+#   tree           : k-d tree of segment midpoints
+#   half           : half of the maximum segment length (bounds the midpoint to segment distance)
+SegmentIndex = collections.namedtuple('SegmentIndex', ['x0', 'y0', 'x1', 'y1', 'edge', 'measure', 'tree', 'half'])
+
+# Table of point locations on the network
+snap_table = 'network_snaps'
+
+createTable_snaps = '''
+  CREATE TABLE IF NOT EXISTS {0}
+  (point_type varchar NOT NULL,
+   point_id varchar NOT NULL,
+   hex integer,
+   edge integer NOT NULL,
+   edge_offset double precision,
+   snap_distance double precision,
+   component integer,
+   PRIMARY KEY(point_type,point_id)
+   );
+  ALTER TABLE {0} ADD COLUMN IF NOT EXISTS component integer;
+   '''.format(snap_table)
+
+# Diagnostics tables of network components, and of points located off the main network
+component_table    = 'network_components'
+disconnected_table = 'network_disconnected_points'
+
+createTable_components = '''
+  DROP TABLE IF EXISTS {0};
+  CREATE TABLE {0}
+  (component integer PRIMARY KEY,
+   node_count integer,
+   edge_count integer,
+   length double precision
+   );
+   '''.format(component_table)
+
+createTable_disconnected = '''
+  DROP TABLE IF EXISTS {0};
+  CREATE TABLE {0} AS
+    SELECT s.point_type, s.point_id, s.hex, s.component, s.snap_distance, c.node_count, c.edge_count, c.length
+    FROM {1} s LEFT JOIN {2} c USING (component)
+    WHERE s.component > 0;
+   '''.format(disconnected_table, snap_table, component_table)
+
+def build_segment_index(graph, max_length = 50):
+  ''' Build a spatial index of the network graph's edge geometry, as straight line segments
+      of no more than max_length metres.'''
+  ptr = graph.vertex_ptr
+  vx  = graph.vertex_x
+  vy  = graph.vertex_y
+  # consecutive vertex pairs, excluding pairs spanning two edges
+  start = np.setdiff1d(np.arange(len(vx) - 1), ptr[1:-1] - 1)
+  edge  = np.searchsorted(ptr, start, side = 'right') - 1
+  dx = vx[start + 1] - vx[start]
+  dy = vy[start + 1] - vy[start]
+  length = np.sqrt(dx**2 + dy**2)
+  # measure of each segment start along its edge
+  cumulative = np.cumsum(length)
+  measure = cumulative - length
+  measure = measure - (cumulative - length)[np.searchsorted(edge, edge, side = 'left')]
+
+  # split long segments, so that midpoints are within max_length/2 of every part of a segment
+  pieces = np.maximum(1, np.ceil(length/max_length)).astype(np.int64)
+  segment = np.repeat(np.arange(len(start)), pieces)
+  piece = np.arange(len(segment)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+  f0 = piece/pieces[segment].astype(float)
+  f1 = (piece + 1)/pieces[segment].astype(float)
+  x0 = vx[start][segment] + f0*dx[segment]
+  y0 = vy[start][segment] + f0*dy[segment]
+  x1 = vx[start][segment] + f1*dx[segment]
+  y1 = vy[start][segment] + f1*dy[segment]
+  tree = cKDTree(np.column_stack([(x0 + x1)/2, (y0 + y1)/2]))
+  return SegmentIndex(x0 = x0, y0 = y0, x1 = x1, y1 = y1,
+                      edge = edge[segment],
+                      measure = measure[segment] + f0*length[segment],
+                      tree = tree,
+                      half = max_length/2.0)
+
+def snap_points(index, x, y, tolerance, k = 8):
+  ''' Locate points at their closest position on the network, given a SegmentIndex.
+      Returns arrays of edge (-1 where the network is beyond tolerance), offset along the edge
+      and snap distance (from point to network).'''
+  x = np.asarray(x, dtype = float)
+  y = np.asarray(y, dtype = float)
+  tolerance = float(tolerance)
+  segment_count = len(index.edge)
+  best     = np.full(len(x), np.inf)
+  best_seg = np.full(len(x), -1, dtype = np.int64)
+  best_t   = np.zeros(len(x))
+  pending  = np.arange(len(x))
+  while len(pending) > 0:
+    k = min(k, segment_count)
+    dd, ii = index.tree.query(np.column_stack([x[pending], y[pending]]), k = k)
+    dd = dd.reshape(len(pending), -1)
+    ii = ii.reshape(len(pending), -1)
+    # exact distance from each point to each candidate segment
+    px = x[pending][:,None]
+    py = y[pending][:,None]
+    sx = index.x1[ii] - index.x0[ii]
+    sy = index.y1[ii] - index.y0[ii]
+    ss = sx**2 + sy**2
+    t = np.where(ss > 0, ((px - index.x0[ii])*sx + (py - index.y0[ii])*sy)/np.where(ss > 0, ss, 1), 0)
+    t = np.clip(t, 0, 1)
+    d = np.sqrt((index.x0[ii] + t*sx - px)**2 + (index.y0[ii] + t*sy - py)**2)
+    j = np.argmin(d, axis = 1)
+    rows = np.arange(len(pending))
+    d_min = d[rows, j]
+    better = d_min < best[pending]
+    best[pending[better]]     = d_min[better]
+    best_seg[pending[better]] = ii[rows, j][better]
+    best_t[pending[better]]   = t[rows, j][better]
+    # a point is resolved once no unqueried segment could be closer, or all are beyond tolerance
+    furthest = dd[:,-1] - index.half
+    resolved = (best[pending] <= furthest) | (furthest > tolerance) | (k >= segment_count)
+    pending = pending[~resolved]
+    k *= 2
+
+  located = best <= tolerance
+  seg  = best_seg[located]
+  edge = np.full(len(x), -1, dtype = np.int64)
+  offset = np.zeros(len(x))
+  edge[located] = index.edge[seg]
+  offset[located] = index.measure[seg] + best_t[located]*np.sqrt((index.x1[seg] - index.x0[seg])**2 +
+                                                                 (index.y1[seg] - index.y0[seg])**2)
+  return edge, offset, best
+
+def write_snaps(curs, point_type, ids, hexes, edges, offsets, snap_distances, components):
+  ''' Bulk load point locations, and the network component (per edge) on which these are located,
+      to the network_snaps table using COPY (any previous locations for this point type are replaced).'''
+  curs.execute("DELETE FROM {} WHERE point_type = '{}'".format(snap_table, point_type))
+  rows = ['{}\t{}\t{}\t{}\t{:.3f}\t{:.3f}\t{}\n'.format(point_type, id, '\\N' if hex is None else int(hex), int(edge), offset, d, components[edge])
+          for id, hex, edge, offset, d in zip(ids, hexes, edges, offsets, snap_distances) if edge >= 0]
+  curs.copy_from(io.BytesIO(''.join(rows).encode('utf-8')), snap_table,
+                 columns = ('point_type', 'point_id', 'hex', 'edge', 'edge_offset', 'snap_distance', 'component'))
+  return len(rows)
+
+def write_components(curs, graph, node_component):
+  ''' Bulk load a summary of network components (node and edge counts, and length) using COPY.'''
+  curs.execute(createTable_components)
+  edge_component = node_component[graph.edge_u]
+  node_count = np.bincount(node_component)
+  edge_count = np.bincount(edge_component, minlength = len(node_count))
+  length     = np.bincount(edge_component, weights = graph.edge_length, minlength = len(node_count))
+  rows = ['{}\t{}\t{}\t{:.3f}\n'.format(c, node_count[c], edge_count[c], length[c]) for c in range(len(node_count))]
+  curs.copy_from(io.BytesIO(''.join(rows).encode('utf-8')), component_table,
+                 columns = ('component', 'node_count', 'edge_count', 'length'))
+
+def read_snaps(curs, point_type, main_only = True):
+  ''' Read point locations of the given type from the network_snaps table, returning a list of
+      point ids, and arrays of hex, edge and offset.  By default, only points located on the main
+      network component are returned.'''
+  curs.execute("SELECT point_id, coalesce(hex,-1), edge, edge_offset FROM {} WHERE point_type = '{}' {} ORDER BY hex, point_id".format(snap_table, point_type, 'AND component = 0' if main_only else ''))
+  rows = list(curs)
+  ids = [r[0] for r in rows]
+  hexes   = np.array([r[1] for r in rows], dtype = np.int64)
+  edges   = np.array([r[2] for r in rows], dtype = np.int64)
+  offsets = np.array([r[3] for r in rows], dtype = float)
+  return ids, hexes, edges, offsets
+
+def check_snaps(graph, edges):
+  ''' Raise an error if point locations refer to edges not in the network graph (i.e. the network
+      has changed since 15b_snap_points_to_network.py was run).'''
+  if len(edges) > 0 and edges.max() >= len(graph.edge_u):
+    raise ValueError('Point locations in {} do not match the network graph; please re-run 15b_snap_points_to_network.py'.format(snap_table))
+
+def location_groups(graph, edges, offsets, quantum = 0.01):
+  ''' Group points whose network locations are equivalent for network analysis: those at the same
+      offset (to within quantum metres) along the same edge, or at the same node.  A single search
+      from the first member of each group serves all members.
+      Returns a list of arrays of member positions (in the order of edges and offsets), one per group.'''
+  edges   = np.asarray(edges, dtype = np.int64)
+  offsets = np.asarray(offsets, dtype = float)
+  if len(edges) == 0:
+    return []
+  if quantum <= 0:
+    return [np.array([i]) for i in range(len(edges))]
+  key_edge = edges.copy()
+  key_offset = np.round(offsets/quantum).astype(np.int64)
+  # locations at either end of an edge are keyed by node, so as to group these across edges
+  at_u = key_offset == 0
+  at_v = np.round((graph.edge_length[edges] - offsets)/quantum).astype(np.int64) == 0
+  key_edge[at_u] = -1 - graph.edge_u[edges[at_u]]
+  key_edge[at_v] = -1 - graph.edge_v[edges[at_v]]
+  key_offset[at_u | at_v] = 0
+  keys, inverse = np.unique(np.column_stack([key_edge, key_offset]), axis = 0, return_inverse = True)
+  inverse = inverse.ravel()
+  order = np.argsort(inverse, kind = 'mergesort')
+  return np.split(order, np.cumsum(np.bincount(inverse))[:-1])
@@ -0,0 +1,115 @@
+# Purpose: Parallel execution of chunked per-parcel SQL (e.g. spatial aggregation of sausage buffers)
+#          -- pending parcels are partitioned by hex into chunks, so that the parcels of a chunk are
+#             near one another (and so are the features they are aggregated over)
+#          -- chunks are run concurrently on a pool of database connections (threads in the main
+#             process, each holding a connection), rather than in series on one connection
+#          -- the statement is prepared once on each connection, taking the chunk's parcel ids as
+#             an array parameter ($1, e.g. WHERE id = ANY($1)), rather than formatting each chunk
+#             as a literal IN list
+#          -- each chunk is committed once run; the latency of chunks is reported on completion
+#          -- a failed chunk is rolled back and the remaining chunks run; the stage should then
+#             raise an error (check_chunks), rather than be logged as complete
+#          Usage:
+#            chunks = hex_chunks(pending, chunk_size)       (pending: list of (id, hex))
+#            check_chunks(run_chunks(connect, statement, chunks, connections))
+# Author:  Carl Higgs
+
+import sys
+import time
+import threading
+import psycopg2
+from multiprocessing.pool import ThreadPool
+
+from progressor import progressor
+
+def hex_chunks(pending, chunk_size = 500):
+  ''' Partition a list of (id, hex) into chunks of no more than chunk_size ids, ordered by hex:
+      the ids of a hex larger than chunk_size are split over several chunks, and those of
+      consecutive smaller hexes are combined (without splitting a hex).'''
+  chunk_size = max(1, int(chunk_size))
+  by_hex = {}
+  for id, hex in pending:
+    by_hex.setdefault(hex, []).append(id)
+  chunks = []
+  current = []
+  for hex in sorted(by_hex, key = lambda x: (x is None, x)):
+    ids = by_hex[hex]
+    if len(current) + len(ids) > chunk_size and len(current) > 0:
+      chunks.append(current)
+      current = []
+    for i in range(0, len(ids), chunk_size):
+      part = ids[i:i + chunk_size]
+      if len(part) == chunk_size:
+        chunks.append(part)
+      else:
+        current += part
+  if len(current) > 0:
+    chunks.append(current)
+  return chunks
+
+def latency_summary(latency):
+  ''' Return a summary (mean, median, 95th percentile and maximum) of chunk latencies in seconds.'''
+  if len(latency) == 0:
+    return 'no chunks run'
+  ordered = sorted(latency)
+  return 'mean {:.2f}, median {:.2f}, 95th percentile {:.2f}, max {:.2f} secs'.format(
+          sum(ordered)/len(ordered), ordered[len(ordered)//2], ordered[min(len(ordered) - 1, int(0.95*len(ordered)))], ordered[-1])
+
+def run_chunks(connect, statement, chunks, connections = 4, label = 'points processed', param_type = 'text[]'):
+  ''' Run a statement, taking an array of ids ($1 of type param_type), for each chunk of ids,
+      concurrently on a number of database connections.  Returns a dictionary of the ids processed
+      (in chunks run successfully), chunks failed, ids of failed chunks and chunk latencies (secs).'''
+  local  = threading.local()
+  lock   = threading.Lock()
+  opened = []
+  total  = sum(len(chunk) for chunk in chunks)
+  stats  = dict(done = 0, failed = 0, failed_ids = 0, latency = [])
+  run_start = time.time()
+
+  def run(chunk):
+    if not hasattr(local, 'conn'):
+      local.conn = psycopg2.connect(**connect)
+      local.curs = local.conn.cursor()
+      local.curs.execute("PREPARE chunk_statement ({}) AS {}".format(param_type, statement))
+      local.conn.commit()
+      with lock:
+        opened.append(local.conn)
+    chunk_start = time.time()
+    try:
+      local.curs.execute("EXECUTE chunk_statement (%s)", (list(chunk),))
+      local.conn.commit()
+      failed = 0
+    except psycopg2.Error:
+      local.conn.rollback()
+      print("\nChunk of {} ids ({} ... {}) failed: {}".format(len(chunk), chunk[0], chunk[-1], sys.exc_info()[1]))
+      failed = 1
+    with lock:
+      stats['latency'].append(time.time() - chunk_start)
+      stats['failed'] += failed
+      stats['failed_ids'] += failed*len(chunk)
+      stats['done'] += (1 - failed)*len(chunk)
+      progressor(stats['done'] + stats['failed_ids'], total, run_start, "{}/{} {}".format(stats['done'], total, label))
+
+  if total > 0:
+    pool = ThreadPool(max(1, min(int(connections), len(chunks))))
+    try:
+      for result in pool.imap_unordered(run, chunks):
+        pass
+    finally:
+      pool.close()
+      pool.join()
+      for conn in opened:
+        conn.close()
+  mins = (time.time() - run_start)/60
+  print("\n{:,} {} in {} chunks over {} connections in {:.2f} mins{}".format(
+         stats['done'], label, len(chunks), len(opened), mins,
+         '; {} chunks ({} ids) failed'.format(stats['failed'], stats['failed_ids']) if stats['failed'] > 0 else ''))
+  print("Chunk latency: {}".format(latency_summary(stats['latency'])))
+  return stats
+
+def check_chunks(stats):
+  ''' Raise an error if any chunks failed (as per the statistics returned by run_chunks); the ids of
+      these chunks are not processed, so are run by the next run of the stage.'''
+  if stats['failed'] > 0:
+    raise RuntimeError('{} chunks ({} ids) failed (see output above); re-run the stage to process these'.format(
+                       stats['failed'], stats['failed_ids']))
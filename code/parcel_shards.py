@@ -0,0 +1,81 @@
+# Purpose: Build-once, memory-mapped shards of parcels by hex
+#          -- parcel ids and coordinates are read once from the parcel feature class, sorted by
+#             HEX_ID (and parcel id within hex), and written as contiguous NumPy .npy arrays along
+#             with an index of hexes and the offset of each hex's parcels
+#          -- the shard directory is keyed on the state of the parcel feature class (as per network_cache.py),
+#             so shards are only rebuilt when the parcels change
+#          -- workers open the arrays as read-only memory maps and read the parcels of a hex as a
+#             single slice, rather than selecting a hex's parcels by attribute from the full feature
+#             class for every task; for Network Analyst, a hex's parcels (or a subset) are written to
+#             an in_memory feature class (shard_layer)
+# Author:  Carl Higgs
+
+import os
+import shutil
+import tempfile
+import collections
+import numpy as np
+
+from network_cache import source_key
+
+# increment if the shard structure changes, to invalidate existing shards
+shard_version = 1
+
+ParcelShards = collections.namedtuple('ParcelShards', ['hex', 'offset', 'id', 'x', 'y'])
+
+def build_shards(cache_root, gdb, feature, id_field):
+  ''' Build the parcel shards for a feature class, if not already current, returning their directory.'''
+  shard_dir = os.path.join(cache_root, '{}_{}'.format(feature, source_key(gdb, feature, 'shards{}|{}'.format(shard_version, id_field))[:16]))
+  if os.path.isdir(shard_dir):
+    return shard_dir
+  if not os.path.exists(cache_root):
+    os.makedirs(cache_root)
+  import arcpy
+  data = arcpy.da.FeatureClassToNumPyArray(os.path.join(gdb, feature), ['HEX_ID', id_field, 'SHAPE@X', 'SHAPE@Y'])
+  order = np.lexsort((data[id_field], data['HEX_ID']))
+  hexes = data['HEX_ID'][order]
+  hex_list, first = np.unique(hexes, return_index = True)
+  # arrays are written to a temporary directory which is then renamed, so that partially
+  # written shards are never read
+  build_dir = tempfile.mkdtemp(dir = cache_root)
+  np.save(os.path.join(build_dir, 'hex.npy'), hex_list.astype(np.int64))
+  np.save(os.path.join(build_dir, 'offset.npy'), np.append(first, len(hexes)).astype(np.int64))
+  np.save(os.path.join(build_dir, 'id.npy'), data[id_field][order])
+  np.save(os.path.join(build_dir, 'x.npy'), data['SHAPE@X'][order])
+  np.save(os.path.join(build_dir, 'y.npy'), data['SHAPE@Y'][order])
+  try:
+    os.rename(build_dir, shard_dir)
+  except OSError:
+    # built concurrently by another process
+    shutil.rmtree(build_dir)
+  return shard_dir
+
+def load_shards(shard_dir):
+  ''' Open parcel shards as read-only memory mapped arrays.'''
+  return ParcelShards(**dict((field, np.load(os.path.join(shard_dir, '{}.npy'.format(field)), mmap_mode = 'r'))
+                             for field in ParcelShards._fields))
+
+def cached_shards(cache_root, gdb, feature, id_field):
+  ''' Return the parcel shards for a feature class (building these first where the parcels have changed).'''
+  return load_shards(build_shards(cache_root, gdb, feature, id_field))
+
+def hex_rows(shards, hex):
+  ''' Return the rows of the parcels within a hex (ordered by parcel id).'''
+  i = np.searchsorted(shards.hex, hex)
+  if i == len(shards.hex) or shards.hex[i] != hex:
+    return np.arange(0)
+  return np.arange(shards.offset[i], shards.offset[i + 1])
+
+def shard_layer(shards, rows, name, id_field, spatial_reference):
+  ''' Write the parcels of the given rows to an in_memory point feature class (with field id_field),
+      for use as Network Analyst input, returning its path.'''
+  import arcpy
+  out_fc = 'in_memory/{}'.format(name)
+  if arcpy.Exists(out_fc):
+    arcpy.Delete_management(out_fc)
+  ids = shards.id[rows]
+  points = np.rec.fromarrays([np.array(ids, dtype = 'U{}'.format(max(1, max([len(x) for x in ids] or [1])))),
+                              np.asarray(shards.x[rows]), np.asarray(shards.y[rows])],
+                             names = [str(id_field), 'X', 'Y'])
+  arcpy.da.NumPyArrayToFeatureClass(points, out_fc, ('X', 'Y'), spatial_reference)
+  return out_fc
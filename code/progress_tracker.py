@@ -0,0 +1,93 @@
+# Purpose: Progress of parallel stages, aggregated in the main process from worker reports
+#          -- worker processes report increments of work done (e.g. parcels or hex-destination
+#             combinations processed) to a queue, rather than counting rows of the result or
+#             log table in the database after each task
+#          -- a thread in the main process sums these, rendering progress (see progressor.py)
+#             with throughput and ETA, and periodically the status of each worker
+#          Usage: start_progress() in the main process, passing its queue to pool workers through
+#          the pool initializer (progress_init), report_progress() in workers, then stop_progress().
+# Author:  Carl Higgs
+
+import os
+import time
+import threading
+import multiprocessing
+
+from progressor import progressor
+
+try:
+  from Queue import Empty
+except ImportError:
+  from queue import Empty
+
+# queue of the progress aggregator (set in worker processes by progress_init)
+progress_queue = None
+
+def progress_init(queue):
+  ''' Worker process initialiser, giving access to the progress queue.'''
+  global progress_queue
+  progress_queue = queue
+
+def report_progress(units = 1, task = None):
+  ''' Report units of work done by this worker (optionally, on a task) to the progress aggregator.'''
+  if progress_queue is not None:
+    progress_queue.put((os.getpid(), units, task, time.time()))
+
+def worker_status(progress, label):
+  ''' Return a summary of each worker's reported units, tasks and time since last report.'''
+  now = time.time()
+  return '\n'.join("  worker {}: {:,} {} over {} reports; last: {} ({:.0f} secs ago)".format(
+                    pid, worker['units'], label, worker['reports'], worker['task'], now - worker['moment'])
+                   for pid, worker in sorted(progress['workers'].items()))
+
+def aggregate_progress(queue, progress, total, label, interval):
+  ''' Sum progress reports from a queue until a None message is received, rendering progress
+      on each report, and worker status every interval seconds (run as a thread).'''
+  status_time = time.time()
+  while True:
+    try:
+      message = queue.get(timeout = interval)
+    except Empty:
+      message = ()
+    if message is None:
+      break
+    if len(message) > 0:
+      pid, units, task, moment = message
+      worker = progress['workers'].setdefault(pid, dict(units = 0, reports = 0, task = None, moment = moment))
+      worker['units']   += units
+      worker['reports'] += 1
+      worker['task']     = task
+      worker['moment']   = moment
+      progress['done']  += units
+      mins = (time.time() - progress['start'])/60
+      rate = (progress['done'] - progress['initial'])/max(mins, 1e-9)
+      eta  = time.localtime(time.time() + 60*(total - progress['done'])/rate) if rate > 0 else None
+      progressor(progress['done'], total, None, "{:,}/{:,} {}; {:,.1f} per min; ETA: {}; last: {}".format(
+                  progress['done'], total, label, rate, time.strftime("%Y%m%d_%H%M", eta) if eta else '-', task))
+    if interval > 0 and time.time() - status_time >= interval and len(progress['workers']) > 0:
+      print("\n{}".format(worker_status(progress, label)))
+      status_time = time.time()
+
+def start_progress(total, done = 0, label = 'processed', interval = 300):
+  ''' Start aggregating progress towards a total (of which done units were completed previously),
+      reporting the status of each worker every interval seconds (0 for never).
+      Returns the progress (a dictionary of totals and worker status), queue and thread.'''
+  queue = multiprocessing.Queue()
+  progress = dict(done = done, initial = done, start = time.time(), workers = {})
+  progressor(done, total, None, "{:,}/{:,} {}".format(done, total, label))
+  thread = threading.Thread(target = aggregate_progress, args = (queue, progress, total, label, float(interval)))
+  thread.daemon = True
+  thread.start()
+  return progress, queue, thread
+
+def stop_progress(progress, queue, thread, label = 'processed'):
+  ''' Stop aggregating progress, once reports already queued are counted, and print a summary.'''
+  queue.put(None)
+  thread.join()
+  mins = (time.time() - progress['start'])/60
+  print("\n{:,} {} in {:.2f} mins ({:,.1f} per min) over {} workers".format(
+         progress['done'] - progress['initial'], label, mins,
+         (progress['done'] - progress['initial'])/max(mins, 1e-9), len(progress['workers'])))
+  if len(progress['workers']) > 0:
+    print(worker_status(progress, label))
+  return progress
@@ -0,0 +1,198 @@
+# Purpose: Dedicated writer processes for worker results
+#          -- worker processes push batches of result rows (and log statements) onto a queue,
+#             rather than each holding a connection and committing every few hundred rows
+#          -- one or more writer processes consume the queues, bulk loading rows with COPY to a
+#             temporary staging table, from which they are inserted to the target table (ignoring
+#             rows already present, and optionally applying SQL expressions, e.g. to buffer lines)
+#          -- writers commit once a number of rows have been loaded, or a number of seconds have
+#             passed (batch_rows and batch_secs); log statements are executed after the rows
+#             preceding them, in the same transaction, so a task is never logged as complete
+#             before its results are committed
+#          -- each worker process writes to a single writer, so its rows and logs remain in order
+#          -- if a batch fails, it is retried one task (a worker's rows and the log statements
+#             following them) at a time, so only the results of failing tasks are discarded; the
+#             number of these is returned by sync_writers and stop_writers (see check_writes)
+#          -- writers may be kept running across stages (e.g. by network_service.py); sync_writers
+#             waits until rows queued so far are committed
+#          Rows are copied in PostgreSQL's text format (as per bulk_loader.copy_text); values are
+#          converted to text, so geometries may be passed as (E)WKT or hex encoded (E)WKB.
+# Author:  Carl Higgs
+
+import os
+import io
+import sys
+import time
+import multiprocessing
+import psycopg2
+
+from bulk_loader import copy_text
+
+try:
+  from Queue import Empty
+except ImportError:
+  from queue import Empty
+
+# queues of the writer processes (set in worker processes by writer_init)
+writer_queues = []
+
+def task_units(messages):
+  ''' Group a batch of queued messages into those of each task: the messages of a worker process
+      up to and including its next log statements, in the order these tasks were logged.'''
+  units = []
+  open_units = {}
+  for message in messages:
+    unit = open_units.setdefault(message[1], [])
+    unit.append(message)
+    if message[0] == 'sql':
+      units.append(open_units.pop(message[1]))
+  return units + list(open_units.values())
+
+def writer_process(queue, connect, batch_rows, batch_secs, synced = None):
+  ''' Consume (rows, sql or sync) messages from a queue until a None message is received,
+      bulk loading and committing these in batches; sync messages are acknowledged on the
+      synced queue, with the number of tasks whose results failed to be written since the
+      previous acknowledgement, once preceding messages are committed.'''
+  conn = psycopg2.connect(**connect)
+  curs = conn.cursor()
+  messages = []
+  stats = dict(rows = 0, commits = 0, failed = 0, unreported = 0)
+  batch = [0, time.time()]
+
+  def apply(message):
+    if message[0] == 'rows':
+      table, columns, select, count, lines = message[2:]
+      staging = 'staging_{}'.format(table)
+      curs.execute("CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {}) ON COMMIT DELETE ROWS".format(staging, table))
+      curs.copy_from(io.BytesIO(u''.join(lines).encode('utf-8')), staging, columns = columns)
+      curs.execute('''INSERT INTO {0} ({1}) SELECT {2} FROM {3} ON CONFLICT DO NOTHING'''.format(
+                   table, ','.join(columns), ','.join(select if select is not None else columns), staging))
+      curs.execute("TRUNCATE {}".format(staging))
+    else:
+      for statement in message[2]:
+        curs.execute(statement)
+
+  def commit(batch_messages):
+    try:
+      for message in batch_messages:
+        apply(message)
+      conn.commit()
+    except:
+      conn.rollback()
+      return sys.exc_info()[1]
+    stats['rows'] += sum(message[5] for message in batch_messages if message[0] == 'rows')
+    stats['commits'] += 1
+    return None
+
+  def flush():
+    if len(messages) == 0:
+      return
+    error = commit(messages)
+    if error is not None:
+      # the batch is retried one task at a time (its rows and log together), so that only the
+      # results of a failing task are discarded; as it is not logged, the task is re-run
+      print("Writer {}: batch of {} rows failed ({}); retrying each task separately".format(os.getpid(), batch[0], error))
+      for unit in task_units(messages):
+        error = commit(unit)
+        if error is not None:
+          stats['failed'] += 1
+          stats['unreported'] += 1
+          print("Writer {}: results of a task of worker {} ({} rows; log: {}) discarded: {}".format(
+                 os.getpid(), unit[0][1], sum(message[5] for message in unit if message[0] == 'rows'),
+                 '; '.join(statement.strip()[:200] for message in unit if message[0] == 'sql' for statement in message[2]) or 'none',
+                 error))
+    del messages[:]
+    batch[0] = 0
+    batch[1] = time.time()
+
+  while True:
+    try:
+      message = queue.get(timeout = batch_secs)
+    except Empty:
+      flush()
+      continue
+    if message is None:
+      break
+    if message[0] == 'sync':
+      flush()
+      synced.put(stats['unreported'])
+      stats['unreported'] = 0
+      continue
+    if message[0] == 'rows':
+      # rows are kept as lines of COPY text, with their count
+      pid, table, columns, select, rows = message[1:]
+      messages.append(('rows', pid, table, columns, select, len(rows),
+                       [u'\t'.join(copy_text(value) for value in row) + u'\n' for row in rows]))
+      batch[0] += len(rows)
+    else:
+      messages.append(message)
+    if batch[0] >= batch_rows or time.time() - batch[1] >= batch_secs:
+      flush()
+  flush()
+  conn.close()
+  synced.put(stats['unreported'])
+  print("Writer {}: {} rows written in {} commits{}".format(os.getpid(), stats['rows'], stats['commits'],
+        '; results of {} tasks failed'.format(stats['failed']) if stats['failed'] > 0 else ''))
+
+def start_writers(connect, writers = 1, batch_rows = 50000, batch_secs = 10):
+  ''' Start writer processes, returning their queues and processes.'''
+  queues = []
+  processes = []
+  for i in range(max(1, int(writers))):
+    queue = multiprocessing.Queue(maxsize = 200)
+    synced = multiprocessing.Queue()
+    process = multiprocessing.Process(target = writer_process, args = (queue, connect, int(batch_rows), float(batch_secs), synced),
+                                      name = 'ResultWriter-{}'.format(i + 1))
+    process.synced = synced
+    process.start()
+    queues.append(queue)
+    processes.append(process)
+  return queues, processes
+
+def stop_writers(queues, processes):
+  ''' Wait for writer processes to write all queued results and exit, returning the number of
+      tasks whose results failed to be written (since writers were last synced).'''
+  for queue in queues:
+    queue.put(None)
+  failed = sum(process.synced.get() for process in processes)
+  for process in processes:
+    process.join()
+  return failed
+
+def sync_writers(queues, processes):
+  ''' Wait for writer processes to commit all results queued so far (leaving these running),
+      returning the number of tasks whose results failed to be written since the last sync.'''
+  for queue in queues:
+    queue.put(('sync',))
+  return sum(process.synced.get() for process in processes)
+
+def check_writes(failed):
+  ''' Raise an error if the results of any tasks failed to be written (as returned by sync_writers
+      or stop_writers); these tasks are not logged as complete, so are re-run by the next run.'''
+  if failed > 0:
+    raise RuntimeError('results of {} tasks failed to be written and were discarded (see writer output); '
+                       're-run the stage to process these'.format(failed))
+
+def writer_init(queues):
+  ''' Worker process initialiser, giving access to the writer queues.'''
+  global writer_queues
+  writer_queues = queues
+
+def writing():
+  ''' Check whether this process writes via a writer process (i.e. is an initialised worker).'''
+  return len(writer_queues) > 0
+
+def writer_queue():
+  ''' Return the queue of this worker's writer.'''
+  return writer_queues[os.getpid() % len(writer_queues)]
+
+def write_rows(table, columns, rows, select = None):
+  ''' Queue rows (a list of tuples of values for columns) to be written to a table; optionally
+      select is a list of SQL expressions over the columns to be inserted in their place.'''
+  if len(rows) > 0:
+    writer_queue().put(('rows', os.getpid(), table, list(columns), select, rows))
+
+def write_sql(statements):
+  ''' Queue SQL statements (e.g. log entries) to be executed once preceding rows are written.'''
+  if not isinstance(statements, list):
+    statements = [statements]
+  writer_queue().put(('sql', os.getpid(), statements))
@@ -0,0 +1,58 @@
+# Purpose: Work remaining on resuming a stage, as parcels (or hexes) not yet in its result table
+#          -- the pending set is found in the database with an anti-join (NOT EXISTS) of the source
+#             table against the result table (pending_rows), or inlined in a stage's query as a
+#             condition (pending_clause), rather than fetching both lists of ids and filtering one
+#             against the other in Python, or sending the completed ids back as a NOT IN list
+#          -- pending rows are streamed from a server side cursor, in batches, rather than fetched
+#             at once
+#          -- where the pending set must be found client side (e.g. parcels of a hex read from the
+#             parcel shards), completed ids are held in a set, so each test is a hash lookup
+#             (completed_set, pending_items)
+#          Usage:
+#            pending = pending_rows(conn, 'sausagebuffer_1600', 'gnaf_pid', 'dd_nh1600m', ['gnaf_pid', 'hex'])
+#            pending = pending_items(ids, completed_set(curs, table, 'gnaf_pid', 'hex = 7'))
+# Author:  Carl Higgs
+
+# rows fetched per round trip by server side cursors
+stream_rows = 10000
+
+def pending_clause(source, key, done):
+  ''' Return a condition on rows of source (a table name, or alias) whose key is not in table done.'''
+  return 'NOT EXISTS (SELECT 1 FROM {2} WHERE {2}.{1} = {0}.{1})'.format(source, key, done)
+
+def anti_join(source, key, done, columns = None, where = None, order_by = None):
+  ''' Return a query of the rows (columns, or the key if None) of table source whose key is not in
+      table done, optionally also matching a where clause and ordered.'''
+  return 'SELECT {} FROM {} WHERE {}{}{}'.format(
+          ','.join('{}.{}'.format(source, x) for x in (columns or [key])), source,
+          pending_clause(source, key, done),
+          '' if where is None else ' AND ({})'.format(where),
+          '' if order_by is None else ' ORDER BY {}'.format(order_by))
+
+def pending_rows(conn, source, key, done, columns = None, where = None, order_by = None):
+  ''' Generate the rows of table source whose key is not in table done (as per anti_join), streamed
+      from a server side cursor; single column rows are returned as values.'''
+  curs = conn.cursor(name = 'pending_{}'.format(source.split('.')[-1]))
+  curs.itersize = stream_rows
+  curs.execute(anti_join(source, key, done, columns, where, order_by))
+  try:
+    for row in curs:
+      yield row if columns is not None and len(columns) > 1 else row[0]
+  finally:
+    curs.close()
+
+def completed_set(curs, table, key, where = None):
+  ''' Return the set of key values of a result table (optionally, rows matching a where clause).'''
+  curs.execute('SELECT {} FROM {}{}'.format(key, table, '' if where is None else ' WHERE {}'.format(where)))
+  return set(x[0] for x in curs)
+
+def pending_items(items, completed, key = None):
+  ''' Return the items (or those whose key(item) is) not in a set of completed values.'''
+  if key is None:
+    return [x for x in items if x not in completed]
+  return [x for x in items if key(x) not in completed]
+
+def count_rows(curs, table):
+  ''' Return the number of rows of a table.'''
+  curs.execute('SELECT COUNT(*) FROM {}'.format(table))
+  return int(curs.fetchone()[0])
@@ -0,0 +1,60 @@
+# Purpose: Construct network 'sausage' buffers from bounded network traversals
+#          -- collects each origin's reachable edge set (including partial edges at the
+#             frontier of the search distance) using network_graph.reachable_edge_parts()
+#          -- buffers the reachable lines by a given distance using shapely
+#             (where shapely 2 is available, arrays of geometries are buffered in a single
+#              vectorised call)
+#          -- formats geometries as hex encoded EWKB, for bulk loading to PostGIS using COPY
+#             (with shapely 2, arrays of geometries are encoded in a single vectorised call)
+# Author:  Carl Higgs
+
+import numpy as np
+from shapely.geometry import MultiLineString
+
+from network_graph import reachable_edge_parts, edge_part_coords
+from bulk_loader import ewkb
+
+try:
+  # shapely 2 operates on arrays of geometries
+  from shapely import buffer as buffer_array
+  from shapely import set_srid, to_wkb
+except ImportError:
+  buffer_array = None
+
+def sausage_lines(graph, edges, offsets, distance):
+  ''' Return a list of network line geometries (MultiLineString) reachable within
+      distance of each origin location, given as edge and offset (None where the origin
+      is not located).'''
+  lines = []
+  for edge, offset in zip(edges, offsets):
+    if edge < 0:
+      lines.append(None)
+      continue
+    parts = reachable_edge_parts(graph, (int(edge), float(offset)), distance)
+    coords = [edge_part_coords(graph, e, a, b) for e, a, b in parts]
+    lines.append(MultiLineString([c for c in coords if len(c) > 1]))
+  return lines
+
+def buffer_geometries(geometries, line_buffer):
+  ''' Buffer a list of geometries (None values are passed through).'''
+  valid = [i for i, g in enumerate(geometries) if g is not None and not g.is_empty]
+  buffered = [None]*len(geometries)
+  if buffer_array is not None:
+    result = buffer_array(np.array([geometries[i] for i in valid], dtype = object), line_buffer)
+  else:
+    result = [geometries[i].buffer(line_buffer) for i in valid]
+  for i, g in zip(valid, result):
+    buffered[i] = g
+  return buffered
+
+def sausage_buffers(graph, edges, offsets, distance, line_buffer):
+  ''' Return sausage buffer polygons for lists of origin edges and offsets.'''
+  return buffer_geometries(sausage_lines(graph, edges, offsets, distance), line_buffer)
+
+def ewkb_geometries(geometries, srid):
+  ''' Return hex encoded 2D EWKB with the given SRID of a list of geometries, as accepted by the
+      PostGIS geometry input function (e.g. in COPY).'''
+  if buffer_array is not None:
+    return list(to_wkb(set_srid(np.array(geometries, dtype = object), int(srid)),
+                       hex = True, output_dimension = 2, include_srid = True))
+  return [ewkb(g.wkb, srid) for g in geometries]
@@ -0,0 +1,69 @@
+# Purpose: Deferred key and index build for bulk loaded and CREATE TABLE AS tables
+#          -- tables are created UNLOGGED and without keys or indexes (unlogged), so that rows
+#             are loaded without writing to the WAL or maintaining indexes row by row
+#          -- once loaded, the primary key, GiST and other indexes are built in one pass over the
+#             loaded table, it is analyzed (so that joins on it, e.g. by 34b, are planned using
+#             current statistics), and it is switched to LOGGED (finish_table)
+#          -- where a key is not unique (e.g. a CREATE TABLE AS over a join yielding more than one
+#             row for a parcel), a plain index is built in its place and a warning printed, unless
+#             duplicates are to be removed (keeping one row per key)
+#          Usage:
+#            curs.execute(unlogged(createTable))
+#            ... load rows (e.g. bulk_loader.py) ...
+#            finish_table(curs, table, key = 'detail_pid', gist = 'geom')
+#            conn.commit()
+# Author:  Carl Higgs
+
+import re
+import time
+
+create_pattern = re.compile(r'\bCREATE\s+TABLE\b', re.IGNORECASE)
+
+def unlogged(sql):
+  ''' Return SQL with its CREATE TABLE statements creating UNLOGGED tables.'''
+  return create_pattern.sub('CREATE UNLOGGED TABLE', sql)
+
+def key_columns(key):
+  ''' Return a key (a column name, or list of column names) as a comma separated list.'''
+  if isinstance(key, (list, tuple)):
+    return ','.join(key)
+  return key
+
+def duplicate_keys(curs, table, key):
+  ''' Check whether a table has more than one row for any key value.'''
+  curs.execute("SELECT 1 FROM {} GROUP BY {} HAVING COUNT(*) > 1 LIMIT 1".format(table, key_columns(key)))
+  return curs.fetchone() is not None
+
+def finish_table(curs, table, key = None, gist = None, indexes = [], dedupe = False, logged = True):
+  ''' Build a loaded table's primary key (key), GiST index (on column gist) and other indexes (a
+      list of columns, or lists of columns), analyze it and switch it to LOGGED.  If dedupe,
+      rows duplicating the key of another are first deleted.'''
+  finish_start = time.time()
+  print("Finishing table {}... ".format(table)),
+  built = []
+  if key is not None:
+    columns = key_columns(key)
+    if dedupe:
+      curs.execute('''DELETE FROM {0} a USING {0} b WHERE a.ctid > b.ctid AND ({1}) = ({2})'''.format(
+                   table, ','.join('a.{}'.format(x) for x in columns.split(',')), ','.join('b.{}'.format(x) for x in columns.split(','))))
+      if curs.rowcount > 0:
+        built.append('{} duplicates removed'.format(curs.rowcount))
+    if dedupe or not duplicate_keys(curs, table, key):
+      curs.execute("ALTER TABLE {0} DROP CONSTRAINT IF EXISTS {0}_pkey".format(table))
+      curs.execute("ALTER TABLE {0} ADD CONSTRAINT {0}_pkey PRIMARY KEY ({1})".format(table, columns))
+      built.append('primary key')
+    else:
+      print("\nWarning: {} has duplicate values of {}; indexing these without a primary key.".format(table, columns))
+      indexes = [key] + list(indexes)
+  if gist is not None:
+    curs.execute("CREATE INDEX IF NOT EXISTS {0}_gix ON {0} USING GIST ({1})".format(table, gist))
+    built.append('GiST index')
+  for index in indexes:
+    columns = key_columns(index)
+    curs.execute("CREATE INDEX IF NOT EXISTS {0}_{1}_idx ON {0} ({2})".format(table, columns.replace(',', '_'), columns))
+    built.append('index on {}'.format(columns))
+  curs.execute("ANALYZE {}".format(table))
+  if logged:
+    curs.execute("ALTER TABLE {} SET LOGGED".format(table))
+  print("Done ({}analyzed{}; {:.2f} mins).".format(''.join('{}, '.format(x) for x in built),
+        ', logged' if logged else '', (time.time() - finish_start)/60))
@@ -0,0 +1,232 @@
+# Purpose: Guarded execution of hex (or other) tasks in worker processes, so that long runs
+#          finish predictably rather than looping or silently leaving holes
+#          -- each task runs with an optional timeout and is retried with exponential backoff up
+#             to a bounded number of attempts
+#          -- the timeout is enforced from the parent process (run_tasks): the worker process of an
+#             attempt overrunning it is terminated, and replaced by the pool, as a worker may not
+#             stop itself (no SIGALRM on Windows, and signals are not handled within a long
+#             running ArcGIS or other C call); where available, SIGALRM also stops an overrunning
+#             attempt within the worker, so that it is retried without restarting the process
+#          -- a task fails if it raises an exception, times out, or returns other than one of the
+#             worker function's success codes (e.g. 666 or a process id, as returned on error)
+#          -- tasks failing on every attempt are recorded in the task_quarantine table, and are
+#             skipped by later runs of the stage until removed from quarantine
+#          -- a summary of completed, retried and quarantined tasks is reported at stage end
+# Author:  Carl Higgs
+
+import os
+import sys
+import time
+import signal
+import functools
+import collections
+import multiprocessing
+
+quarantine_table = 'task_quarantine'
+
+createTable_quarantine = '''
+  CREATE TABLE IF NOT EXISTS {}
+    (stage varchar NOT NULL,
+     task varchar NOT NULL,
+     attempts integer,
+     error varchar,
+     moment varchar,
+     PRIMARY KEY(stage,task)
+     );
+  '''.format(quarantine_table)
+
+# outcome of a guarded task: the worker function's result, number of attempts made, and the
+# error of the final attempt (None if it succeeded)
+TaskOutcome = collections.namedtuple('TaskOutcome', ['result', 'attempts', 'error'])
+
+# worker function results indicating success (completed, or skipped as previously processed or empty)
+success_codes = (None, 0, 1, 2, 3)
+
+# seconds beyond a task's timeout before the parent terminates its worker process, so that timeouts
+# caught within the worker are reported (and retried) by it
+timeout_grace = 30
+
+# seconds between checks of running tasks' deadlines
+deadline_poll = 1
+
+class TaskTimeout(Exception):
+  pass
+
+def raise_timeout(signum, frame):
+  raise TaskTimeout()
+
+def task_key(task):
+  ''' Return a task (e.g. a hex, or (hex, part, parts) sub-task) as a string, as recorded in quarantine.'''
+  if isinstance(task, tuple):
+    return ','.join(str(x) for x in task)
+  return str(task)
+
+def task_failure(result, success = success_codes):
+  ''' Return the error for a task result (a TaskOutcome, or worker function result), or None if successful.'''
+  if isinstance(result, TaskOutcome):
+    return result.error
+  if result in success:
+    return None
+  return 'returned {}'.format(result)
+
+def run_guarded(func, task, timeout = 0, retries = 2, backoff = 30, success = success_codes, first_attempt = 1, started = None):
+  ''' Run a task, with a timeout (minutes; 0 for none) and up to 'retries' further attempts
+      on failure, waiting backoff seconds before the first retry and doubling thereafter.
+      Attempts are numbered from first_attempt (> 1 where resubmitted after a timeout), and the
+      process id, attempt and start time of each are recorded in the shared dictionary started
+      (if given), for run_tasks to enforce the timeout.  Returns a TaskOutcome.'''
+  alarm = timeout > 0 and hasattr(signal, 'SIGALRM')
+  error = None
+  result = None
+  for attempt in range(first_attempt, retries + 2):
+    if attempt > 1:
+      time.sleep(backoff*2**(attempt - 2))
+    if started is not None:
+      started[task_key(task)] = (os.getpid(), attempt, time.time())
+    remaining = 0
+    if alarm:
+      signal.signal(signal.SIGALRM, raise_timeout)
+      signal.alarm(int(max(timeout*60, 1)))
+    try:
+      result = func(task)
+      error = task_failure(result, success)
+    except TaskTimeout:
+      result, error = None, 'timed out after {:g} mins'.format(timeout)
+    except:
+      result, error = None, '{}: {}'.format(sys.exc_info()[0].__name__, sys.exc_info()[1])
+    finally:
+      if alarm:
+        remaining = signal.alarm(0)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+    if alarm and remaining == 0 and error is not None and not error.startswith('timed out'):
+      # the worker function caught the timeout itself (e.g. a bare except logging an error)
+      error = 'timed out after {:g} mins ({})'.format(timeout, error)
+    if error is None:
+      break
+    print("Task {} failed (attempt {} of {}): {}".format(task, attempt, retries + 1, error))
+  if started is not None:
+    started.pop(task_key(task), None)
+  return TaskOutcome(result, attempt, error)
+
+def guarded(func, timeout = 0, retries = 2, backoff = 30, success = success_codes):
+  ''' Return a picklable task function running func under run_guarded, for use with run_tasks,
+      hex_scheduler.run_largest_first or job_queue.run_queue.'''
+  return functools.partial(run_guarded, func, timeout = float(timeout), retries = int(retries), backoff = float(backoff), success = success)
+
+def guard_settings(func):
+  ''' Return the timeout (mins) and retries of a guarded task function (0, 0 if not guarded).'''
+  if isinstance(func, functools.partial) and func.func is run_guarded:
+    return func.keywords.get('timeout', 0), func.keywords.get('retries', 2)
+  return 0, 0
+
+def timed_task(args):
+  ''' Run a task in a worker process, returning the task, its result and duration (mins).'''
+  func, task = args
+  task_start = time.time()
+  result = func(task)
+  return task, result, (time.time() - task_start)/60
+
+def terminate_overrun(started, timeout):
+  ''' Terminate the worker processes of attempts recorded in started (see run_guarded) which have
+      overrun the timeout (mins), returning a list of their (task key, process id, attempt).'''
+  overrun = []
+  for key, state in list(started.items()):
+    pid, attempt, attempt_start = state
+    # the attempt is checked to be still running, having listed those recorded
+    if time.time() - attempt_start < timeout*60 + timeout_grace or started.get(key) != state:
+      continue
+    try:
+      os.kill(pid, signal.SIGTERM)
+    except OSError:
+      pass
+    started.pop(key, None)
+    overrun.append((key, pid, attempt))
+  return overrun
+
+def abandon(result):
+  ''' Drop the result of a task whose worker process was terminated from its pool's cache, as this
+      will never arrive (and otherwise the pool would wait on it when joined).'''
+  result._cache.pop(result._job, None)
+
+def run_tasks(pool, func, tasks):
+  ''' Generate (task, result, duration in mins) for tasks processed by a pool of workers, in order
+      of completion; tasks are dispatched in the given order.  Where func is a guarded task
+      function with a timeout, this is enforced here: the worker process of an attempt overrunning
+      the timeout is terminated (the pool starting a replacement), and the task resubmitted for
+      its next attempt, or returned as timed out following its last.'''
+  timeout, retries = guard_settings(func)
+  if timeout <= 0:
+    for result in pool.imap_unordered(timed_task, [(func, task) for task in tasks], chunksize = 1):
+      yield result
+    return
+  manager = multiprocessing.Manager()
+  started = manager.dict()
+  pending = {}
+  submitted = {}
+  def submit(task, attempt):
+    pending[task] = pool.apply_async(timed_task, ((functools.partial(func, first_attempt = attempt, started = started), task),))
+  try:
+    for task in tasks:
+      submitted[task] = time.time()
+      submit(task, 1)
+    while len(pending) > 0:
+      finished = [task for task in pending if pending[task].ready()]
+      for task in finished:
+        yield pending.pop(task).get()
+      keys = dict((task_key(task), task) for task in pending)
+      for key, pid, attempt in terminate_overrun(started, timeout):
+        task = keys[key]
+        abandon(pending.pop(task))
+        error = 'timed out after {:g} mins (worker process {} terminated)'.format(timeout, pid)
+        print("Task {} failed (attempt {} of {}): {}".format(task, attempt, retries + 1, error))
+        if attempt <= retries:
+          submit(task, attempt + 1)
+        else:
+          yield task, TaskOutcome(None, attempt, error), (time.time() - submitted[task])/60
+      if len(finished) == 0:
+        time.sleep(deadline_poll)
+  finally:
+    manager.shutdown()
+
+def quarantined(curs, stage):
+  ''' Return the set of tasks (as strings) quarantined for a stage.'''
+  curs.execute(createTable_quarantine)
+  curs.execute("SELECT task FROM {} WHERE stage = %s".format(quarantine_table), (stage,))
+  tasks = set([x[0] for x in list(curs)])
+  curs.connection.commit()
+  return tasks
+
+def exclude_quarantined(curs, stage, costs):
+  ''' Remove quarantined tasks from a dictionary of task: cost, reporting those excluded.'''
+  skip = quarantined(curs, stage)
+  excluded = [task for task in costs if task_key(task) in skip]
+  for task in excluded:
+    del costs[task]
+  if len(excluded) > 0:
+    print("Skipping {} quarantined tasks of {} (see {}; delete these to retry): {}".format(
+           len(excluded), stage, quarantine_table, ', '.join(task_key(task) for task in sorted(excluded, key = task_key))))
+  return costs
+
+def quarantine(curs, stage, task, attempts, error):
+  ''' Record a task which failed on every attempt in quarantine.'''
+  curs.execute(createTable_quarantine)
+  curs.execute('''INSERT INTO {0} VALUES (%s,%s,%s,%s,%s)
+                  ON CONFLICT (stage,task)
+                  DO UPDATE SET attempts={0}.attempts+EXCLUDED.attempts,error=EXCLUDED.error,moment=EXCLUDED.moment'''.format(quarantine_table),
+               (stage, task_key(task), attempts, str(error)[:1000], time.strftime("%Y%m%d-%H%M%S")))
+  curs.connection.commit()
+
+def stage_summary(curs, stage, results):
+  ''' Quarantine failed tasks from a dictionary of task: TaskOutcome (as returned by
+      run_largest_first with a guarded task function), and report a summary of the stage.
+      Returns the list of failed tasks.'''
+  failed  = [task for task, outcome in results.items() if outcome.error is not None]
+  retried = [task for task, outcome in results.items() if outcome.error is None and outcome.attempts > 1]
+  for task in failed:
+    quarantine(curs, stage, task, results[task].attempts, results[task].error)
+  print("\n{}: {} tasks; {} completed ({} after retry); {} failed and quarantined{}".format(
+         stage, len(results), len(results) - len(failed), len(retried), len(failed),
+         ' (see {})'.format(quarantine_table) if len(failed) > 0 else ''))
+  for task in sorted(failed, key = task_key):
+    print("  {}: {}".format(task_key(task), results[task].error))
+  return failed
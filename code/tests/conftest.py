@@ -0,0 +1,8 @@
+# Purpose: pytest configuration; the project modules are imported from the code folder, as when
+#          the stage scripts are run
+# Author:  Carl Higgs
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Purpose: Check the EWKB conversion and COPY text formatting of the bulk loader (bulk_loader.py)
+# Author:  Carl Higgs
+
+import struct
+import binascii
+import pytest
+
+from bulk_loader import ewkb, copy_text, RowStream
+
+def test_point_ewkb():
+  wkb = struct.pack('<BIdd', 1, 1, 2.5, -3.0)
+  assert ewkb(wkb, 3111) == binascii.hexlify(struct.pack('<BIidd', 1, 1 | 0x20000000, 3111, 2.5, -3.0)).decode('ascii')
+  assert ewkb(None, 3111) is None
+
+def test_point_z_dropped():
+  # ISO WKB point Z (1001), big endian
+  wkb = struct.pack('>BIddd', 0, 1001, 2.5, -3.0, 7.0)
+  assert ewkb(wkb, 4326) == binascii.hexlify(struct.pack('>BIidd', 0, 1 | 0x20000000, 4326, 2.5, -3.0)).decode('ascii')
+
+@pytest.mark.parametrize('wkt', ['POINT Z (1 2 3)',
+                                 'LINESTRING M (0 0 5, 1 1 6, 2 0 7)',
+                                 'POLYGON ZM ((0 0 1 2, 4 0 1 2, 4 4 1 2, 0 0 1 2), (1 1 1 2, 2 1 1 2, 2 2 1 2, 1 1 1 2))',
+                                 'MULTIPOLYGON (((0 0, 1 0, 1 1, 0 0)), ((5 5, 6 5, 6 6, 5 5)))',
+                                 'MULTILINESTRING Z ((0 0 1, 1 1 1), (2 2 2, 3 3 3))',
+                                 'GEOMETRYCOLLECTION Z (POINT Z (1 2 3), LINESTRING Z (0 0 1, 1 1 2))'])
+@pytest.mark.parametrize('byte_order', [0, 1])
+def test_ewkb_matches_shapely(wkt, byte_order):
+  shapely = pytest.importorskip('shapely')
+  geometry = shapely.from_wkt(wkt)
+  wkb = shapely.to_wkb(geometry, byte_order = byte_order, flavor = 'iso', include_srid = False)
+  result = shapely.from_wkb(ewkb(wkb, 3111))
+  assert shapely.get_srid(result) == 3111
+  assert not shapely.has_z(result)
+  assert shapely.equals_exact(result, shapely.force_2d(geometry), tolerance = 0)
+
+def test_copy_text():
+  assert copy_text(None) == u'\\N'
+  assert copy_text(12) == u'12'
+  assert copy_text(u'a\tb\nc\\d\r') == u'a\\tb\\nc\\\\d\\r'
+  assert copy_text(u'Wurundjeri Wō') == u'Wurundjeri Wō'
+  assert copy_text(u'Wurundjeri Wō'.encode('utf-8')) == u'Wurundjeri Wō'
+
+def test_row_stream():
+  rows = [(i, u'parcel ā{}'.format(i), None) for i in range(1000)]
+  stream = RowStream(iter(rows))
+  data = b''
+  while True:
+    chunk = stream.read(100)
+    if len(chunk) == 0:
+      break
+    data += chunk
+  lines = data.decode('utf-8').split(u'\n')
+  assert lines[-1] == u'' and len(lines) == len(rows) + 1
+  assert lines[7] == u'7\tparcel ā7\t\\N'
+  assert stream.count == len(rows)
@@ -0,0 +1,81 @@
+# Purpose: Check the candidate destination index (hex_destinations.py) against brute force
+#          searches of randomised parcels and destinations
+# Author:  Carl Higgs
+
+import collections
+import numpy as np
+import pytest
+
+from hex_destinations import (CandidateIndex, hex_extents, extent_distance, ring_candidates, hex_candidates,
+                              certified_lines, line_origins, rows_extent, ring_oids, retry_radius)
+
+Shards = collections.namedtuple('Shards', ['hex', 'offset', 'id', 'x', 'y'])
+
+def random_shards(rng, hexes = 6, per_hex = 20):
+  ''' Return shards of parcels in square hexes 1 km apart.'''
+  x = np.concatenate([rng.uniform(0, 1000, per_hex) + 1000*(h % 3) for h in range(hexes)])
+  y = np.concatenate([rng.uniform(0, 1000, per_hex) + 1000*(h // 3) for h in range(hexes)])
+  return Shards(np.arange(hexes), np.arange(hexes + 1)*per_hex,
+                np.array(['p{}'.format(i) for i in range(hexes*per_hex)]), x, y)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_ring_candidates(seed):
+  rng = np.random.RandomState(seed)
+  shards = random_shards(rng)
+  extents = hex_extents(shards)
+  count = rng.randint(1, 10)
+  dest_x = rng.uniform(-10000, 13000, rng.randint(0, 60))
+  dest_y = rng.uniform(-10000, 12000, len(dest_x))
+  offset, found, radii = ring_candidates(dest_x, dest_y, extents, 500, 1500, count)
+  for i in range(len(shards.hex)):
+    candidates = found[offset[i]:offset[i + 1]]
+    distance = extent_distance(dest_x, dest_y, *[e[i] for e in extents])
+    if np.isinf(radii[i]):
+      # every destination is a candidate
+      assert sorted(candidates) == list(range(len(dest_x)))
+    else:
+      # candidates are exactly the destinations within the radius, being at least the minimum
+      # radius and including at least count destinations
+      assert sorted(candidates) == list(np.flatnonzero(distance <= radii[i]))
+      assert radii[i] >= 1500 and len(candidates) >= count
+
+@pytest.mark.parametrize('seed', range(20))
+def test_certified_retry_finds_closest(seed):
+  ''' Solving (here, with straight line distances) against candidates, then against wider rings for
+      parcels not certified, finds the closest of all destinations for every parcel.'''
+  rng = np.random.RandomState(seed)
+  shards = random_shards(rng)
+  dest_x = rng.uniform(-20000, 23000, rng.randint(1, 30))
+  dest_y = rng.uniform(-20000, 22000, len(dest_x))
+  offset, found, radii = ring_candidates(dest_x, dest_y, hex_extents(shards), 500, 1500, 2)
+  index = CandidateIndex(shards.hex, offset, found, radii, np.arange(len(dest_x)), dest_x, dest_y)
+
+  def solve(rows, oids):
+    lines = []
+    for row in rows:
+      distance = np.hypot(dest_x[oids] - shards.x[row], dest_y[oids] - shards.y[row])
+      lines.append(('{} - {}'.format(shards.id[row], oids[distance.argmin()]), distance.min()))
+    return lines
+
+  for hex in shards.hex:
+    rows = np.arange(shards.offset[hex], shards.offset[hex + 1])
+    oids, radius = hex_candidates(index, hex)
+    lines = solve(rows, oids)
+    result = certified_lines(lines, radius, 0)
+    retry = rows[~np.isin(shards.id[rows], list(line_origins(result)))]
+    while len(retry) > 0 and not np.isinf(radius):
+      oids, radius = ring_oids(index, rows_extent(shards, retry), retry_radius(lines, shards.id[retry], radius, 0))
+      lines = solve(retry, oids)
+      certified = certified_lines(lines, radius, 0)
+      result += certified
+      retry = retry[~np.isin(shards.id[retry], list(line_origins(certified)))]
+    closest = dict((line[0].split('-')[0].strip(' '), line[1]) for line in result)
+    for row in rows:
+      assert np.isclose(closest[shards.id[row]], np.hypot(dest_x - shards.x[row], dest_y - shards.y[row]).min())
+
+def test_retry_radius():
+  lines = [('a - 1', 900.0), ('b - 2', 1200.0), ('c - 3', 100.0)]
+  # bounded by the farthest closest destination found (of parcels retried), plus 2 x tolerance
+  assert retry_radius(lines, ['a', 'b'], 1000, 50) == 1300
+  # doubled where a parcel found no destination
+  assert retry_radius(lines, ['a', 'd'], 1000, 50) == 2000
@@ -0,0 +1,57 @@
+# Purpose: Check the source keys of caches derived from feature classes (network_cache.py) change
+#          with the feature class's own tables only
+# Author:  Carl Higgs
+
+import os
+import sys
+import types
+import pytest
+
+import network_cache
+
+class CatalogRow(object):
+  def __init__(self, fid, name):
+    self.fid, self.name = fid, name
+  def GetFID(self):
+    return self.fid
+  def GetField(self, field):
+    return self.name
+
+class Source(object):
+  def GetLayerByName(self, name):
+    return [CatalogRow(1, 'GDB_SystemCatalog'), CatalogRow(9, 'RoadsCLEAN'), CatalogRow(10, 'roadsAsPoints')]
+
+@pytest.fixture
+def gdb(tmpdir, monkeypatch):
+  ''' A file geodatabase of two tables, with GDAL's system catalog listing faked.'''
+  gdal = types.ModuleType('gdal')
+  gdal.OF_VECTOR = 4
+  gdal.OpenEx = lambda path, flags, open_options = None: Source()
+  osgeo = types.ModuleType('osgeo')
+  osgeo.gdal = gdal
+  monkeypatch.setitem(sys.modules, 'osgeo', osgeo)
+  monkeypatch.setitem(sys.modules, 'osgeo.gdal', gdal)
+  for table in ('a00000009', 'a0000000a'):
+    for extension, content in (('gdbtable', b'rows'), ('gdbtablx', b'\x00\x01\x02\x03')):
+      tmpdir.join('{}.{}'.format(table, extension)).write_binary(content)
+  return str(tmpdir)
+
+def test_feature_tables(gdb):
+  assert [os.path.basename(x) for x in network_cache.feature_tables(gdb, 'RoadsCLEAN')] == ['a00000009.gdbtable', 'a00000009.gdbtablx']
+  assert network_cache.feature_tables(gdb, 'missing') is None
+
+def test_key_ignores_other_tables(gdb):
+  key = network_cache.source_key(gdb, 'RoadsCLEAN', 'graph1')
+  with open(os.path.join(gdb, 'a0000000a.gdbtable'), 'ab') as f:
+    f.write(b'more rows')
+  assert network_cache.source_key(gdb, 'RoadsCLEAN', 'graph1') == key
+  assert network_cache.source_key(gdb, 'RoadsCLEAN', 'graph2') != key
+
+def test_key_detects_same_size_edit(gdb):
+  key = network_cache.source_key(gdb, 'RoadsCLEAN', 'graph1')
+  path = os.path.join(gdb, 'a00000009.gdbtablx')
+  stat = os.stat(path)
+  with open(path, 'wb') as f:
+    f.write(b'\x00\x01\x02\x04')
+  os.utime(path, (stat.st_atime, stat.st_mtime))
+  assert network_cache.source_key(gdb, 'RoadsCLEAN', 'graph1') != key
@@ -0,0 +1,73 @@
+# Purpose: Check contraction hierarchy queries (network_ch.py) against plain Dijkstra searches
+#          of the CSR network graph (network_graph.py), on randomised grid networks
+# Author:  Carl Higgs
+
+import numpy as np
+import pytest
+
+from network_graph import build_graph, nearest_source, within_distance
+from network_ch import build_ch, save_ch, load_ch, phast, many_to_many
+
+def random_graph(seed, n = 15):
+  ''' Return a network graph of a jittered n x n grid, with some edges removed (so that it may be
+      disconnected) and some diagonals added.'''
+  rng = np.random.RandomState(seed)
+  grid = np.dstack(np.meshgrid(np.arange(n)*100.0, np.arange(n)*100.0)) + rng.uniform(-20, 20, (n, n, 2))
+  edges = []
+  for i in range(n):
+    for j in range(n):
+      if j < n - 1 and rng.rand() < 0.85:
+        edges.append(np.array([grid[i, j], grid[i, j + 1]]))
+      if i < n - 1 and rng.rand() < 0.85:
+        edges.append(np.array([grid[i, j], grid[i + 1, j]]))
+      if i < n - 1 and j < n - 1 and rng.rand() < 0.1:
+        edges.append(np.array([grid[i, j], (grid[i, j] + grid[i + 1, j + 1])/2, grid[i + 1, j + 1]]))
+  return build_graph(edges), rng
+
+@pytest.mark.parametrize('seed', range(5))
+def test_phast_matches_dijkstra(seed, tmpdir):
+  graph, rng = random_graph(seed)
+  ch = build_ch(graph)
+  # the hierarchy is used as loaded from file
+  filename = str(tmpdir.join('ch.npz'))
+  save_ch(filename, ch)
+  ch = load_ch(filename, graph)
+  node_count = len(graph.node_x)
+  seeds = [(int(node), float(rng.uniform(0, 50)), label)
+           for label, node in enumerate(rng.choice(node_count, 6, replace = False))]
+  expected_distance, expected_label = nearest_source(graph, seeds)
+  distance, label = phast(ch, seeds)
+  reached = np.isfinite(expected_distance)
+  assert (np.isfinite(distance) == reached).all()
+  assert np.allclose(distance[reached], expected_distance[reached])
+  assert (label[~reached] == -1).all()
+  # labels may differ only where sources are equidistant
+  for node in np.flatnonzero(reached & (label != expected_label)):
+    single = nearest_source(graph, [seed for seed in seeds if seed[2] == label[node]])[0]
+    assert np.isclose(single[node], distance[node])
+
+@pytest.mark.parametrize('seed', range(3))
+def test_many_to_many_matches_dijkstra(seed):
+  graph, rng = random_graph(seed)
+  ch = build_ch(graph)
+  node_count = len(graph.node_x)
+  # sources and targets are located along edges, i.e. seeded from both edge ends
+  sources = [[(int(graph.edge_u[e]), 10.0), (int(graph.edge_v[e]), float(graph.edge_length[e]) - 10.0)]
+             for e in rng.choice(len(graph.edge_u), 12)]
+  targets = [[(int(node), 0.0)] for node in rng.choice(node_count, 10)]
+  result = many_to_many(ch, sources, targets)
+  for i, source in enumerate(sources):
+    reached = within_distance(graph, source, float('inf'))
+    for j, target in enumerate(targets):
+      expected = min(reached.get(node, np.inf) + d for node, d in target)
+      if np.isfinite(expected):
+        assert np.isclose(result[i, j], expected)
+      else:
+        assert np.isinf(result[i, j])
+
+def test_load_ch_rejects_other_graph(tmpdir):
+  graph = random_graph(0)[0]
+  filename = str(tmpdir.join('ch.npz'))
+  save_ch(filename, build_ch(graph))
+  with pytest.raises(ValueError):
+    load_ch(filename, random_graph(1)[0])
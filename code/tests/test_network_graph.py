@@ -0,0 +1,119 @@
+# Purpose: Check the network searches of the CSR network graph (network_graph.py) against all
+#          pairs shortest paths (Floyd-Warshall) on small randomised grid networks
+# Author:  Carl Higgs
+
+import numpy as np
+import pytest
+
+from network_graph import (build_graph, location_seeds, index_targets, closest_by_type, nearest_source,
+                           source_seeds, locate_nearest, within_distance, targets_within, connected_components)
+
+def random_graph(seed, n = 7):
+  ''' Return a network graph of a jittered n x n grid, with some edges removed (so that it may be
+      disconnected) and some bent diagonals added.'''
+  rng = np.random.RandomState(seed)
+  grid = np.dstack(np.meshgrid(np.arange(n)*100.0, np.arange(n)*100.0)) + rng.uniform(-20, 20, (n, n, 2))
+  edges = []
+  for i in range(n):
+    for j in range(n):
+      if j < n - 1 and rng.rand() < 0.8:
+        edges.append(np.array([grid[i, j], grid[i, j + 1]]))
+      if i < n - 1 and rng.rand() < 0.8:
+        edges.append(np.array([grid[i, j], grid[i + 1, j]]))
+      if i < n - 1 and j < n - 1 and rng.rand() < 0.15:
+        edges.append(np.array([grid[i, j], (grid[i, j] + grid[i + 1, j + 1])/2 + 15, grid[i + 1, j + 1]]))
+  return build_graph(edges), rng
+
+def all_pairs(graph):
+  ''' Return the matrix of shortest distances between nodes (Floyd-Warshall).'''
+  node_count = len(graph.node_x)
+  distance = np.full((node_count, node_count), np.inf)
+  np.fill_diagonal(distance, 0)
+  for u in range(node_count):
+    for k in range(graph.indptr[u], graph.indptr[u + 1]):
+      distance[u, graph.indices[k]] = min(distance[u, graph.indices[k]], graph.weights[k])
+  for k in range(node_count):
+    distance = np.minimum(distance, distance[:, k:k + 1] + distance[k:k + 1, :])
+  return distance
+
+def location_distance(graph, distance, a, b):
+  ''' Return the shortest distance between two (edge, offset) locations.'''
+  best = abs(a[1] - b[1]) if a[0] == b[0] else np.inf
+  for node_a, d_a in location_seeds(graph, *a):
+    for node_b, d_b in location_seeds(graph, *b):
+      best = min(best, d_a + distance[node_a, node_b] + d_b)
+  return best
+
+def random_locations(graph, rng, count):
+  ''' Return a list of random (edge, offset) locations.'''
+  edges = rng.randint(0, len(graph.edge_u), count)
+  return [(int(e), float(rng.uniform(0, graph.edge_length[e]))) for e in edges]
+
+@pytest.mark.parametrize('seed', range(4))
+def test_node_searches(seed):
+  graph, rng = random_graph(seed)
+  distance = all_pairs(graph)
+  for origin in rng.choice(len(graph.node_x), 5, replace = False):
+    reached = within_distance(graph, [(int(origin), 0.0)], np.inf)
+    expected = distance[origin]
+    assert set(reached) == set(np.flatnonzero(np.isfinite(expected)))
+    assert np.allclose([reached[node] for node in sorted(reached)], expected[sorted(reached)])
+    # bounded search
+    limit = 250.0
+    bounded = within_distance(graph, [(int(origin), 0.0)], limit)
+    assert set(bounded) == set(np.flatnonzero(expected <= limit))
+  seeds = [(int(node), float(rng.uniform(0, 30)), label)
+           for label, node in enumerate(rng.choice(len(graph.node_x), 4, replace = False))]
+  node_distance, node_label = nearest_source(graph, seeds)
+  expected = np.min([d + distance[node] for node, d, label in seeds], axis = 0)
+  assert np.allclose(node_distance, expected)
+  for node in np.flatnonzero(np.isfinite(expected)):
+    source = [seed for seed in seeds if seed[2] == node_label[node]][0]
+    assert np.isclose(source[1] + distance[source[0], node], expected[node])
+  assert (node_label[np.isinf(expected)] == -1).all()
+
+@pytest.mark.parametrize('seed', range(4))
+def test_location_searches(seed):
+  graph, rng = random_graph(seed)
+  distance = all_pairs(graph)
+  targets = random_locations(graph, rng, 12)
+  labels = [(i % 3, i) for i in range(len(targets))]
+  index = index_targets(graph, [t[0] for t in targets], [t[1] for t in targets], labels)
+  origins = random_locations(graph, rng, 8)
+  for origin in origins:
+    to_target = [location_distance(graph, distance, origin, target) for target in targets]
+    # closest of each type
+    found = closest_by_type(graph, origin, index, [0, 1, 2])
+    for kind in range(3):
+      closest = min(d for d, label in zip(to_target, labels) if label[0] == kind)
+      if np.isfinite(closest):
+        assert np.isclose(found[kind][1], closest)
+        assert np.isclose(to_target[found[kind][0]], closest)
+      else:
+        assert kind not in found
+    # all targets within a limit
+    within = targets_within(graph, origin, index, 300.0)
+    assert set(within) == set(label for d, label in zip(to_target, labels) if d <= 300.0)
+    for label, d in within.items():
+      assert np.isclose(d, to_target[label[1]])
+  # nearest target of all, from a multi-source search
+  sources = index_targets(graph, [t[0] for t in targets], [t[1] for t in targets], range(len(targets)))
+  node_distance, node_label = nearest_source(graph, source_seeds(sources))
+  nearest, label = locate_nearest(graph, node_distance, node_label,
+                                  [o[0] for o in origins] + [-1], [o[1] for o in origins] + [0], sources)
+  for i, origin in enumerate(origins):
+    to_target = [location_distance(graph, distance, origin, target) for target in targets]
+    assert np.isclose(nearest[i], min(to_target)) or (np.isinf(nearest[i]) and np.isinf(min(to_target)))
+    if np.isfinite(nearest[i]):
+      assert np.isclose(to_target[label[i]], nearest[i])
+  # unlocated origin
+  assert np.isinf(nearest[-1]) and label[-1] == -1
+
+@pytest.mark.parametrize('seed', range(4))
+def test_connected_components(seed):
+  graph = random_graph(seed)[0]
+  connected = np.isfinite(all_pairs(graph))
+  component = connected_components(graph)
+  assert (connected == (component[:, None] == component[None, :])).all()
+  counts = np.bincount(component)
+  assert (np.diff(counts) <= 0).all()
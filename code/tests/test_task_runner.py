@@ -0,0 +1,42 @@
+import signal
+import time
+import multiprocessing
+
+import task_runner
+from task_runner import guarded, run_tasks, TaskOutcome
+
+
+def blocking_task(task):
+  # a task the worker's alarm cannot interrupt, as if within a long running C call
+  signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+  if task == 'hang':
+    time.sleep(60)
+  signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGALRM])
+  return 0
+
+
+def test_run_tasks_terminates_overrunning_worker(monkeypatch):
+  monkeypatch.setattr(task_runner, 'timeout_grace', 0)
+  monkeypatch.setattr(task_runner, 'deadline_poll', 0.1)
+  pool = multiprocessing.Pool(2)
+  try:
+    func = guarded(blocking_task, timeout = 0.01, retries = 1, backoff = 0)
+    results = dict((task, result) for task, result, mins in run_tasks(pool, func, ['hang', 'a', 'b', 'c']))
+    # the pool replaces the terminated worker, so remains usable
+    assert pool.apply(blocking_task, ('d',)) == 0
+  finally:
+    pool.terminate()
+  assert results['a'] == TaskOutcome(0, 1, None)
+  assert results['c'] == TaskOutcome(0, 1, None)
+  assert results['hang'].result is None
+  assert results['hang'].attempts == 2
+  assert results['hang'].error.startswith('timed out after 0.01 mins')
+
+
+def test_run_tasks_without_timeout():
+  pool = multiprocessing.Pool(2)
+  try:
+    results = sorted((task, result) for task, result, mins in run_tasks(pool, abs, [-1, -2, 3]))
+  finally:
+    pool.terminate()
+  assert results == [(-2, 2), (-1, 1), (3, 3)]
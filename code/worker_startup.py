@@ -0,0 +1,51 @@
+# Purpose: Explicit start-up of pool worker processes
+#          -- work which each worker requires but which need only be done once (e.g. counts, lists
+#             of hexes or destinations queried from the database or geodatabase) is done by the
+#             main process, and passed to workers as a dictionary of settings
+#          -- each worker runs the stage's setup function with these settings (e.g. to set module
+#             globals, connect to the database, and create Network Analyst layers), as the pool
+#             initializer, rather than repeating this work as module level code on import
+#          -- the start-up time of each worker (from pool creation until its setup is complete,
+#             and of the setup alone) is recorded, and summarised by the main process
+#          Stage scripts should only define settings and functions at module level, so that
+#          importing them in a worker process (e.g. with spawn or forkserver start methods) is fast.
+# Author:  Carl Higgs
+
+import os
+import time
+import multiprocessing
+
+try:
+  from Queue import Empty
+except ImportError:
+  from queue import Empty
+
+def worker_start(setup, settings, pool_start, queue):
+  ''' Pool initializer: run a stage's setup function with settings, and report the worker's
+      start-up time (seconds since pool creation, and for setup) to the main process.'''
+  setup_start = time.time()
+  setup(settings)
+  queue.put((os.getpid(), time.time() - pool_start, time.time() - setup_start))
+
+def start_pool(workers, setup, settings):
+  ''' Create a pool of workers, each initialised by setup(settings) (setup must be a module level
+      function of the stage script).  Returns the pool and the queue of worker start-up times.'''
+  queue = multiprocessing.Queue()
+  pool = multiprocessing.Pool(workers, initializer = worker_start, initargs = (setup, settings, time.time(), queue))
+  return pool, queue
+
+def startup_summary(queue):
+  ''' Report the start-up times of workers (as queued by workers once started), returning a
+      list of (pid, start-up secs, setup secs).'''
+  startups = []
+  while True:
+    try:
+      startups.append(queue.get(timeout = 1))
+    except Empty:
+      break
+  if len(startups) > 0:
+    total = [x[1] for x in startups]
+    setup = [x[2] for x in startups]
+    print("Worker start-up ({} workers): mean {:.2f} secs, max {:.2f} secs (of which setup: mean {:.2f} secs, max {:.2f} secs)".format(
+           len(startups), sum(total)/len(total), max(total), sum(setup)/len(setup), max(setup)))
+  return startups